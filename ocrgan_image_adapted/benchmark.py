@@ -0,0 +1,277 @@
+"""
+BENCHMARKS
+
+Usage: python benchmark.py <benchmark> [train/test options] [--bench_samples N]
+
+    preprocess: per-sample cost of the dataset preprocessing of every --fd_mode.
+    loader:     train loader throughput and batch size in MB for every --host_dtype.
+    cs:         generator training step with persistent CS blocks vs. rebuilding them every forward.
+    grouped:    generator inference with separate lap/res branches vs. groups=2 convolutions.
+    dstep:      training step time and peak memory with five netD passes vs. one concatenated pass.
+    checkpoint: generator step time and peak memory for growing --checkpoint_levels.
+    precision:  test AUC, scores and run time with --precision fp32 vs. bf16 (add --load_weights for the trained model).
+
+dstep and checkpoint run every config in a new process, so that the CPU peak
+memory (RSS growth) of one config does not depend on the configs run before.
+"""
+
+import copy
+import multiprocessing
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from options import Options
+from lib.data.dataloader import make_datasets_FD_aug, make_data, load_data_FD_aug
+from lib.models import load_model
+from lib.models.networks import CS, define_G, migrate_cs_state_dict, set_checkpoint_levels
+from lib.memory import PeakMemory
+
+##
+def bench_preprocess(opt):
+    """ Time train_ds[i] of every --fd_mode on the first --bench_samples images. """
+    results = {}
+    for mode in ('cv2', 'torch', 'fused'):
+        opt.fd_mode = mode
+        dataset, _ = make_datasets_FD_aug(opt)
+        indices = range(min(opt.bench_samples, len(dataset)))
+        dataset[0]
+        times = []
+        for i in indices:
+            start = time.perf_counter()
+            dataset[i]
+            times.append(time.perf_counter() - start)
+        results[mode] = np.mean(times) * 1e3
+        print(f"{mode:>6}: {results[mode]:7.2f} ms/sample  ({1e3 / results[mode]:7.1f} samples/s)")
+    print(f"fused vs cv2: {results['cv2'] / results['fused']:.2f}x faster")
+    print("torch excludes the lap/res split, which runs on the model device.")
+    return results
+
+##
+def bench_loader(opt):
+    """ Time --bench_samples batches of the train loader with float32 and uint8 host tensors. """
+    results = {}
+    for dtype in ('float32', 'uint8'):
+        opt.host_dtype = dtype
+        loader = make_data(opt, *make_datasets_FD_aug(opt)).train
+        batches = iter(loader)
+        batch = next(batches)
+        nbytes = sum(t.numel() * t.element_size() for t in batch)
+        num = min(opt.bench_samples, len(loader) - 1)
+        start = time.perf_counter()
+        for _ in range(num):
+            next(batches)
+        elapsed = time.perf_counter() - start
+        results[dtype] = num * opt.batchsize / elapsed
+        print(f"{dtype:>7}: {nbytes / 2**20:7.2f} MB/batch  {results[dtype]:8.1f} samples/s")
+    return results
+
+class RebuiltCS(nn.Module):
+    """ CS as it used to run: new random layers at every call, evaluated on the CPU. """
+    def forward(self, x):
+        x1, x2 = x
+        cs = CS(x1.size(1), 2)
+        fea_z = cs.fc(cs.gap(x1 + x2).flatten(1).cpu())
+        attention_vec = cs.softmax(torch.stack([fc(fea_z) for fc in cs.fcs], dim=1)).to(x1.device)
+        attention_vec = attention_vec.unsqueeze(-1).unsqueeze(-1)
+        return (x1 * attention_vec[:, 0], x2 * attention_vec[:, 1])
+
+def time_steps(opt, netg, steps):
+    """ Mean time of a generator forward/backward/Adam step on random input. """
+    device = next(netg.parameters()).device
+    optimizer = torch.optim.Adam(netg.parameters(), lr=opt.lr, betas=(opt.beta1, 0.999))
+    lap = torch.randn(opt.batchsize, opt.nc, opt.isize, opt.isize, device=device)
+    res = torch.randn_like(lap)
+    times = []
+    for i in range(steps + 1):
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fake_lap, fake_res = netg((lap, res))
+        loss = (fake_lap + fake_res - lap - res).abs().mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        if i > 0:
+            times.append(time.perf_counter() - start)
+    return np.mean(times) * 1e3
+
+##
+def bench_cs(opt):
+    """ Time --bench_samples generator steps with persistent and per-forward CS blocks. """
+    netg = define_G(opt)
+    legacy = copy.deepcopy(netg)
+    for module in legacy.modules():
+        if hasattr(module, 'cs'):
+            module.cs = RebuiltCS()
+    results = {'rebuilt': time_steps(opt, legacy, opt.bench_samples),
+               'persistent': time_steps(opt, netg, opt.bench_samples)}
+    for name, ms in results.items():
+        print(f"{name:>10}: {ms:8.2f} ms/step")
+    print(f"persistent vs rebuilt: {results['rebuilt'] / results['persistent']:.2f}x faster")
+    return results
+
+##
+def bench_grouped(opt):
+    """ Time --bench_samples no-grad generator forwards of both --netg_arch with the same weights. """
+    opt.netg_arch = 'cs'
+    netg = define_G(opt).eval()
+    opt.netg_arch = 'cs_grouped'
+    grouped = define_G(opt).eval()
+    grouped.load_state_dict(migrate_cs_state_dict(netg.state_dict(), grouped))
+    device = next(netg.parameters()).device
+    lap = torch.randn(opt.batchsize, opt.nc, opt.isize, opt.isize, device=device)
+    res = torch.randn_like(lap)
+    results = {}
+    with torch.no_grad():
+        diff = max((a - b).abs().max().item() for a, b in zip(netg((lap, res)), grouped((lap, res))))
+        for name, net in (('cs', netg), ('cs_grouped', grouped)):
+            net((lap, res))
+            times = []
+            for _ in range(opt.bench_samples):
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+                net((lap, res))
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                times.append(time.perf_counter() - start)
+            results[name] = np.mean(times) * 1e3
+            nops = sum(1 for m in net.modules() if len(list(m.children())) == 0)
+            print(f"{name:>10}: {results[name]:8.2f} ms/batch  {nops:4d} leaf modules")
+    print(f"cs_grouped vs cs: {results['cs'] / results['cs_grouped']:.2f}x faster, max abs diff {diff:.2e}")
+    return results
+
+def legacy_step(model):
+    """ Ocr_Gan_Aug.optimize_params as it used to run: five netD passes and retained graphs.
+
+    optimizer_g steps last, after the netD loss has been backpropagated through
+    the generator, so that the retained graph is still valid on PyTorch >= 1.5.
+    """
+    model.forward_g()
+    model.pred_real, model.feat_real = model.netd(model.input_lap + model.input_res)
+    model.pred_fake, model.feat_fake = model.netd(model.fake)
+    model.pred_fake_aug, model.feat_fake_aug = model.netd(model.fake_aug)
+    model.optimizer_g.zero_grad()
+    model.err_g_adv = model.opt.w_adv * model.l_adv(model.pred_fake, model.real_label)
+    model.err_g_con = model.opt.w_con * model.l_con(model.fake, model.input_lap + model.input_res)
+    model.err_g_lat = model.opt.w_lat * model.l_lat(model.feat_fake, model.feat_real)
+    model.err_g = model.err_g_adv + model.err_g_con + model.err_g_lat
+    model.err_g.backward(retain_graph=True)
+    model.optimizer_d.zero_grad()
+    pred_fake, _ = model.netd(model.fake.detach())
+    pred_fake_aug, _ = model.netd(model.fake_aug.detach())
+    model.err_d = model.l_adv(model.pred_real, model.real_label) + model.l_adv(pred_fake, model.fake_label) \
+        + model.err_g_lat + model.l_adv(pred_fake_aug, model.fake_label)
+    model.err_d.backward(retain_graph=True)
+    model.optimizer_d.step()
+    model.optimizer_g.step()
+
+##
+def isolated(fn, *args):
+    """ Run fn(*args) in a fresh process and return its result.
+
+    PeakMemory measures the RSS growth on the CPU. In a process that already ran
+    another config, the allocator reuses the pages mapped by that config and the
+    growth, hence the peak, is underestimated. A new process per config makes
+    the measurements independent of their order.
+    """
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(fn, args)
+
+def dstep_config(opt, name):
+    """ (ms/step, peak MB) of --bench_samples Ocr_Gan_Aug training steps with the 'legacy' or 'concat' netD passes. """
+    torch.manual_seed(opt.manualseed)
+    model = load_model(opt, None, opt.dataset)
+    for t in (model.input_lap, model.input_res, model.fake_aug):
+        t.copy_(torch.randn_like(t))
+    model.noise.zero_()
+    step = (lambda: legacy_step(model)) if name == 'legacy' else model.optimize_params
+    times = []
+    with PeakMemory(model.device) as mem:
+        for i in range(opt.bench_samples + 1):
+            if model.device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            step()
+            if model.device.type == 'cuda':
+                torch.cuda.synchronize()
+            if i > 0:
+                times.append(time.perf_counter() - start)
+    return np.mean(times) * 1e3, mem.peak / 2**20
+
+def bench_dstep(opt):
+    """ Time --bench_samples training steps of Ocr_Gan_Aug with the legacy and the concatenated netD passes. """
+    results = {}
+    for name in ('legacy', 'concat'):
+        results[name] = isolated(dstep_config, opt, name)
+        print(f"{name:>7}: {results[name][0]:8.2f} ms/step  peak {results[name][1]:8.1f} MB")
+    print(f"concat vs legacy: {results['legacy'][0] / results['concat'][0]:.2f}x faster")
+    return results
+
+##
+def bench_precision(opt):
+    """ Run Ocr_Gan_Aug.test() on the test split with both --precision settings and the same weights. """
+    model = load_model(opt, load_data_FD_aug(opt, opt.dataset), opt.dataset)
+    results, scores = {}, {}
+    for precision in ('fp32', 'bf16'):
+        opt.precision = precision
+        model.seed(opt.manualseed)
+        performance = model.test(plot_hist=False)
+        scores[precision] = model.an_scores.float().cpu()
+        results[precision] = (performance['AUC'], performance['Avg Run Time (ms/batch)'])
+        print(f"{precision:>5}: AUC {results[precision][0]:.4f}  {results[precision][1]:8.2f} ms/batch")
+    print(f"AUC delta (bf16 - fp32): {results['bf16'][0] - results['fp32'][0]:+.4f}, "
+          f"max abs score diff {(scores['bf16'] - scores['fp32']).abs().max().item():.2e}")
+    return results
+
+##
+def checkpoint_config(opt, levels):
+    """ (ms/step, peak MB) of --bench_samples generator steps with `levels` checkpointed levels. """
+    torch.manual_seed(opt.manualseed)
+    netg = define_G(opt)
+    set_checkpoint_levels(netg, levels)
+    with PeakMemory(next(netg.parameters()).device) as mem:
+        ms = time_steps(opt, netg, opt.bench_samples)
+    return ms, mem.peak / 2**20
+
+def bench_checkpoint(opt):
+    """ Time --bench_samples generator steps with 0, 1, 2, ... checkpointed levels and all of them. """
+    depth = int(np.log2(opt.isize))
+    results = {}
+    for levels in sorted({0, 1, 2, 4, depth // 2, depth}):
+        results[levels] = isolated(checkpoint_config, opt, levels)
+    base_ms, base_mb = results[0]
+    for levels, (ms, mb) in results.items():
+        print(f"{levels:>2} levels: {ms:8.2f} ms/step ({ms / base_ms - 1:+6.1%})  "
+              f"peak {mb:8.1f} MB ({mb / base_mb - 1 if base_mb else 0.:+6.1%})")
+    return results
+
+BENCHMARKS = {
+    'preprocess': bench_preprocess,
+    'loader': bench_loader,
+    'cs': bench_cs,
+    'grouped': bench_grouped,
+    'dstep': bench_dstep,
+    'checkpoint': bench_checkpoint,
+    'precision': bench_precision,
+}
+
+def main():
+    parser = Options().parser
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS), help='benchmark to run')
+    parser.add_argument('--bench_samples', type=int, default=64, help='number of samples/batches timed')
+    opt = parser.parse_args()
+    opt.isTrain = True
+    opt.gpu_ids = [int(i) for i in opt.gpu_ids.split(',') if int(i) >= 0] if opt.device != 'cpu' else []
+    if opt.dataroot == '':
+        opt.dataroot = './data/{}'.format(opt.dataset)
+    torch.manual_seed(opt.manualseed)
+    BENCHMARKS[opt.benchmark](opt)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+CASCADE SCORING
+
+Usage: python cascade.py --dataset <class> [train/test options] [--cascade_stage1 feat|<student.pt>] [--cascade_low 0.5,0.8,0.9]
+
+Scores the test split with the full scorer (0.9 * rec + 0.1 * lat), with the
+cheap first stage alone, and with the cascade of both for every band start in
+--cascade_low (see lib/models/cascade.py: CascadeScorer). Prints the AUC,
+fraction of images escalated to the full scorer and images/s of each.
+"""
+
+import os
+
+import torch
+
+from options import Options
+from lib.data.dataloader import load_data_FD_aug
+from lib.models import load_model
+from lib.models.cascade import FeatureDistance, CascadeScorer
+from lib.models.scorer import build_scorer, calibration_batches, load_scorer, evaluate_scorer
+
+##
+def main():
+    """ Calibrate the cascade and compare it with single-stage scoring.
+    """
+    parser = Options().parser
+    parser.add_argument('--netg', default='', help='netG checkpoint. Default: <outf>/<name>/train/weights/netG_best.pth')
+    parser.add_argument('--netd', default='', help='netD checkpoint. Default: <outf>/<name>/train/weights/netD_best.pth')
+    parser.add_argument('--cascade_stage1', default='feat', help='first stage: feat (netD feature distance at reduced resolution) or a scorer file written by distill.py')
+    parser.add_argument('--cascade_scale', type=float, default=0.5, help='input resize factor of the feat first stage')
+    parser.add_argument('--cascade_low', default='0.5,0.8,0.9,0.95', help='comma-separated quantiles of the good-image scores where the uncertainty band starts')
+    parser.add_argument('--cascade_high', type=float, default=0., help='band end, as a multiple of the largest good-image score. 0: no upper exit.')
+    parser.add_argument('--calib_batches', type=int, default=16, help='number of train batches used to calibrate the first stage')
+    opt = parser.parse_args()
+    opt.isTrain = True
+    opt.gpu_ids = [int(i) for i in opt.gpu_ids.split(',') if int(i) >= 0] if opt.device != 'cpu' else []
+    opt.load_weights, opt.scorer = False, ''
+    if opt.name == 'experiment_name':
+        opt.name = "%s/%s" % (opt.model, opt.dataset)
+    weights = os.path.join(opt.outf, opt.name, 'train', 'weights')
+    opt.netg = opt.netg or os.path.join(weights, 'netG_best.pth')
+    opt.netd = opt.netd or os.path.join(weights, 'netD_best.pth')
+    torch.manual_seed(opt.manualseed)
+
+    data = load_data_FD_aug(opt, opt.dataset)
+    model = load_model(opt, data, opt.dataset)
+    full = build_scorer(opt, opt.netg, opt.netd).to(model.device)
+    batches = calibration_batches(model, opt.calib_batches)
+    if opt.cascade_stage1 == 'feat':
+        first = FeatureDistance(full.feat, opt.cascade_scale).to(model.device).eval().fit(batches)
+    else:
+        first = load_scorer(opt.cascade_stage1)
+        first.to(model.device)
+    cascade = CascadeScorer(first, full).calibrate(batches)
+    num = len(data.valid.dataset)
+
+    results = {}
+    for name, scorer in (('full', full), ('stage 1', lambda lap, res: (cascade.stage1(lap, res), None))):
+        auc, ms, _ = evaluate_scorer(model, scorer, model.device)
+        results[name] = (auc, 1. if name == 'full' else 0., num / (ms * len(data.valid) / 1000))
+    for low in [float(q) for q in opt.cascade_low.split(',')]:
+        cascade.set_band(low, opt.cascade_high)
+        auc, ms, _ = evaluate_scorer(model, cascade, model.device)
+        results['cascade %.2f' % low] = (auc, cascade.escalated / max(cascade.seen, 1), num / (ms * len(data.valid) / 1000))
+
+    base = results['full']
+    print("scoring            AUC  escalated    images/s")
+    for name, (auc, escalated, rate) in results.items():
+        print("%-14s  %.4f     %5.1f%%  %10.1f  (AUC %+.4f, %.2fx throughput)" %
+              (name, auc, 100. * escalated, rate, auc - base[0], rate / base[2]))
+    return results
+
+if __name__ == '__main__':
+    main()
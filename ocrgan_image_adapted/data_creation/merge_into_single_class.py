@@ -6,7 +6,9 @@ def merge_datasets(classes, src_root, dest_root):
     subsets = [
         ("train", "good"),
         ("test", "good"),
-        ("test", "bad")
+        ("test", "bad"),
+        # Masks kept by the prepare scripts with --keep_masks, renamed like their images.
+        ("ground_truth", "bad")
     ]
     # Create destination folders
     for subset, status in subsets:
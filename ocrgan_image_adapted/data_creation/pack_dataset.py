@@ -0,0 +1,128 @@
+import os
+import json
+import shutil
+import argparse
+import numpy as np
+import cv2
+
+IMG_EXTENSIONS = [
+    '.jpg', '.JPG', '.jpeg', '.JPEG',
+    '.png', '.PNG', '.ppm', '.PPM', '.bmp', '.BMP',
+    '.tif', '.TIF', '.tiff', '.TIFF'
+]
+
+# Class prefixes added by prepare_*.py and merge_into_single_class.py.
+KNOWN_CLASSES = [
+    "bottle", "cable", "capsule", "carpet", "grid",
+    "hazelnut", "leather", "metal_nut", "pill", "screw",
+    "tile", "toothbrush", "transistor", "wood", "zipper"
+] + [f"dagm_{i}" for i in range(1, 11)] + [f"kos{str(i).zfill(2)}" for i in range(1, 51)]
+
+def list_split(split_dir):
+    """Return [(path, status)] in the same order as make_dataset() in lib/data/datasets.py."""
+    items = []
+    for status in sorted(os.listdir(split_dir)):
+        d = os.path.join(split_dir, status)
+        if not os.path.isdir(d):
+            continue
+        for root, _, fnames in sorted(os.walk(d)):
+            for fname in sorted(fnames):
+                if any(fname.endswith(ext) for ext in IMG_EXTENSIONS):
+                    items.append((os.path.join(root, fname), status))
+    return items
+
+def parse_name(fname, status, default_class):
+    """Split an image name into (class_prefix, defect_type).
+
+    e.g. 'metal_nut_bent_000.png' -> ('metal_nut', 'bent'), 'dagm_10_0576.PNG' -> ('dagm_10', '').
+    """
+    stem = os.path.splitext(fname)[0]
+    class_prefix = default_class
+    matches = [c for c in KNOWN_CLASSES + [default_class] if c and stem.startswith(c + "_")]
+    if matches:
+        class_prefix = max(matches, key=len)
+        # merge_into_single_class.py prepends the class a second time.
+        while stem.startswith(class_prefix + "_"):
+            stem = stem[len(class_prefix) + 1:]
+    if status == "good":
+        return class_prefix, "good"
+    tokens = stem.split("_")
+    while tokens and tokens[-1].isdigit():
+        tokens.pop()
+    return class_prefix, "_".join(tokens)
+
+def pack_split(split_dir, out_prefix, isize=None, default_class=""):
+    """Write <out_prefix>.pack (payloads back to back) and <out_prefix>.idx.json (offset table).
+
+    Without isize, payloads are the original encoded files. With isize, they are raw
+    BGR uint8 arrays resized to isize x isize, so loading needs no decoding at all.
+    """
+    items = list_split(split_dir)
+    classes = sorted(d for d in os.listdir(split_dir) if os.path.isdir(os.path.join(split_dir, d)))
+    class_to_idx = {c: i for i, c in enumerate(classes)}
+
+    records = []
+    offset = 0
+    with open(out_prefix + ".pack", "wb") as blob:
+        for path, status in items:
+            if isize is None:
+                with open(path, "rb") as f:
+                    payload = f.read()
+                shape = None
+            else:
+                img = cv2.imread(path)
+                interp = cv2.INTER_AREA if min(img.shape[:2]) > isize else cv2.INTER_LINEAR
+                img = cv2.resize(img, (isize, isize), interpolation=interp)
+                payload = np.ascontiguousarray(img).tobytes()
+                shape = list(img.shape)
+            blob.write(payload)
+
+            fname = os.path.basename(path)
+            class_prefix, defect = parse_name(fname, status, default_class)
+            records.append({
+                "name": os.path.relpath(path, split_dir),
+                "offset": offset,
+                "length": len(payload),
+                "shape": shape,
+                "label": class_to_idx[status],
+                "class_prefix": class_prefix,
+                "defect": defect,
+            })
+            offset += len(payload)
+
+    index = {
+        "version": 1,
+        "encoding": "encoded" if isize is None else "raw",
+        "isize": isize,
+        "classes": classes,
+        "records": records,
+    }
+    with open(out_prefix + ".idx.json", "w") as f:
+        json.dump(index, f)
+    print(f"  Packed {len(records)} images ({offset / 2**20:.1f} MB) into {out_prefix}.pack")
+
+def pack_dataset(src_root, dest_root, isize=None, splits=("train", "test")):
+    """Pack every split of src_root into dest_root, and copy ground_truth/ (masks kept by --keep_masks) as is."""
+    os.makedirs(dest_root, exist_ok=True)
+    default_class = os.path.basename(os.path.normpath(src_root))
+    for split in splits:
+        split_dir = os.path.join(src_root, split)
+        if not os.path.isdir(split_dir):
+            print(f"  Warning: {split_dir} not found, skipping.")
+            continue
+        print(f"Packing {split_dir}...")
+        pack_split(split_dir, os.path.join(dest_root, split), isize, default_class)
+    # --pixel_eval reads the masks from <dataroot>/ground_truth, next to the packs.
+    masks_dir = os.path.join(src_root, "ground_truth")
+    if os.path.isdir(masks_dir):
+        shutil.copytree(masks_dir, os.path.join(dest_root, "ground_truth"), dirs_exist_ok=True)
+        print(f"Copied {masks_dir}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack a train/test image tree into one file per split.")
+    parser.add_argument("src", help="class folder containing train/ and test/, e.g. data/merged/mvtec_merged")
+    parser.add_argument("dest", help="output folder, used as --dataroot with --data_format packed")
+    parser.add_argument("--isize", type=int, default=None, help="store raw images pre-resized to isize x isize")
+    args = parser.parse_args()
+    pack_dataset(args.src, args.dest, args.isize)
+    print("Dataset packed.")
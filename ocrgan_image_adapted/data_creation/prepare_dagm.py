@@ -1,7 +1,9 @@
+import argparse
 import os
 import shutil
 
-def prepare_dagm_classes(src_root="data/unprocessed/DAGM", dest_root="data/processed/dagm_processed"):
+def prepare_dagm_classes(src_root="data/unprocessed/DAGM", dest_root="data/processed/dagm_processed", keep_masks=False):
+    """ keep_masks: copy the label masks of the test/bad images to dagm_<i>/ground_truth/bad/<image name>.png. """
     for i in range(1, 11):
         class_name = f"Class{i}"
         dagm_name = f"dagm_{i}"
@@ -37,11 +39,11 @@ def prepare_dagm_classes(src_root="data/unprocessed/DAGM", dest_root="data/proce
                     shutil.copy2(img_path, os.path.join(train_good, img))
 
         # --- TEST ---
-        test_label_files = set()
+        test_label_files = {}
         if os.path.exists(test_label):
             for f in os.listdir(test_label):
                 if f.lower().endswith('_label.png'):
-                    test_label_files.add(os.path.splitext(f)[0].replace('_label', ''))
+                    test_label_files[os.path.splitext(f)[0].replace('_label', '')] = f
 
         if os.path.exists(test_src):
             for img in os.listdir(test_src):
@@ -51,10 +53,17 @@ def prepare_dagm_classes(src_root="data/unprocessed/DAGM", dest_root="data/proce
                 img_base = os.path.splitext(img)[0]
                 if img_base in test_label_files:
                     shutil.copy2(img_path, os.path.join(test_bad, img))
+                    if keep_masks:
+                        mask_dir = os.path.join(dest_root, dagm_name, "ground_truth", "bad")
+                        os.makedirs(mask_dir, exist_ok=True)
+                        shutil.copy2(os.path.join(test_label, test_label_files[img_base]), os.path.join(mask_dir, f"{img_base}.png"))
                 else:
                     shutil.copy2(img_path, os.path.join(test_good, img))
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keep_masks', action='store_true', help='keep the label masks of the test/bad images, for pixel-level evaluation')
+    args = parser.parse_args()
     print("Processing the DAGM classes to be ready for OCRGAN :")
-    prepare_dagm_classes()
+    prepare_dagm_classes(keep_masks=args.keep_masks)
     print("Processing done.")
\ No newline at end of file
@@ -1,3 +1,4 @@
+import argparse
 import os
 import shutil
 from PIL import Image
@@ -10,7 +11,8 @@ def is_mask_anomalous(label_path):
         arr = np.array(img)
         return np.any(arr > 0)
 
-def prepare_kolektor_sdd(src_root, dest_root, seed=42):
+def prepare_kolektor_sdd(src_root, dest_root, seed=42, keep_masks=False):
+    """ keep_masks: write the label masks of the bad images to <kos>/ground_truth/bad/<image name>.png. """
     random.seed(seed)
     kos_dirs = [d for d in os.listdir(src_root) if d.startswith('kos')]
     os.makedirs(dest_root, exist_ok=True)
@@ -33,6 +35,12 @@ def prepare_kolektor_sdd(src_root, dest_root, seed=42):
                     continue
                 if is_mask_anomalous(label_path):
                     bad_imgs.append((img_path, fname))
+                    if keep_masks:
+                        mask_dir = os.path.join(dest_root, kos, "ground_truth", "bad")
+                        os.makedirs(mask_dir, exist_ok=True)
+                        with Image.open(label_path) as label:
+                            mask = (np.array(label.convert('L')) > 0).astype(np.uint8) * 255
+                        Image.fromarray(mask).save(os.path.join(mask_dir, f"{base}.png"))
                 else:
                     good_imgs.append((img_path, fname))
 
@@ -68,7 +76,10 @@ def prepare_kolektor_sdd(src_root, dest_root, seed=42):
         print(f"  Copied {len(train_good_samples)} to train/good, {len(test_good_samples)} to test/good, {len(bad_imgs)} to test/bad.")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keep_masks', action='store_true', help='keep the label masks of the test/bad images, for pixel-level evaluation')
+    args = parser.parse_args()
     src_root = "data/unprocessed/KolektorSDD"
     dest_root = "data/processed/KolektorSDD_processed"
-    prepare_kolektor_sdd(src_root, dest_root)
+    prepare_kolektor_sdd(src_root, dest_root, keep_masks=args.keep_masks)
     print("KolektorSDD dataset prepared.")
\ No newline at end of file
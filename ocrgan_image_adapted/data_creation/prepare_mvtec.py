@@ -1,8 +1,10 @@
+import argparse
 import os
 import shutil
 from glob import glob
 
-def prepare_mvtec(src_root, dest_root):
+def prepare_mvtec(src_root, dest_root, keep_masks=False):
+    """ keep_masks: copy the defect masks to <class>/ground_truth/bad/<test/bad image name>. """
     # List all class folders
     for class_name in os.listdir(src_root):
         class_src = os.path.join(src_root, class_name)
@@ -51,12 +53,17 @@ def prepare_mvtec(src_root, dest_root):
                     img_name = os.path.basename(img_path)
                     new_img_name = f"{class_name}_{defect_type}_{img_name}"
                     shutil.copy2(img_path, os.path.join(test_dest_bad, new_img_name))
+                    mask_path = os.path.join(class_src, "ground_truth", defect_type, os.path.splitext(img_name)[0] + "_mask.png")
+                    if keep_masks and os.path.exists(mask_path):
+                        mask_dest = os.path.join(class_dest, "ground_truth", "bad")
+                        os.makedirs(mask_dest, exist_ok=True)
+                        shutil.copy2(mask_path, os.path.join(mask_dest, os.path.splitext(new_img_name)[0] + ".png"))
 
         # Remove ground_truth and txt files in destination
         for root, dirs, files in os.walk(class_dest):
             # Remove ground_truth directories
             for d in dirs:
-                if d == "ground_truth":
+                if d == "ground_truth" and not keep_masks:
                     shutil.rmtree(os.path.join(root, d))
             # Remove .txt files
             for f in files:
@@ -64,7 +71,10 @@ def prepare_mvtec(src_root, dest_root):
                     os.remove(os.path.join(root, f))
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keep_masks', action='store_true', help='keep the ground-truth masks of the test/bad images, for pixel-level evaluation')
+    args = parser.parse_args()
     src_root = "data/unprocessed/mvtec"
     dest_root = "data/processed/mvtec_processed"
-    prepare_mvtec(src_root, dest_root)
+    prepare_mvtec(src_root, dest_root, keep_masks=args.keep_masks)
     print("MVTec dataset prepared.")
\ No newline at end of file
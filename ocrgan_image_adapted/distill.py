@@ -0,0 +1,78 @@
+"""
+STUDENT DISTILLATION
+
+Usage: python distill.py --dataset <class> [train/test options] [--student_widths 8,16,32]
+
+Trains small StudentScorer CNNs (lib/models/student.py) to regress the anomaly
+score and per-pixel error map of a trained model, as computed in
+Ocr_Gan_Aug.test(), on the good images of the train split. Prints MACs,
+parameters, CPU ms/batch and test AUC of the teacher and of every student, and
+saves each student as TorchScript, loadable like the int8 scorer with
+`test.py --scorer <file>` or lib/models/scorer.py: load_scorer.
+"""
+
+import os
+
+import numpy as np
+import torch
+
+from options import Options
+from lib.data.dataloader import load_data_FD_aug
+from lib.models import load_model
+from lib.models.pruning import count_flops
+from lib.models.scorer import build_scorer, calibration_batches, save_scorer, evaluate_scorer
+from lib.models.student import StudentScorer, distill
+
+##
+def main():
+    """ Distill, evaluate and save one student per width.
+    """
+    parser = Options().parser
+    parser.add_argument('--netg', default='', help='netG checkpoint. Default: <outf>/<name>/train/weights/netG_best.pth')
+    parser.add_argument('--netd', default='', help='netD checkpoint. Default: <outf>/<name>/train/weights/netD_best.pth')
+    parser.add_argument('--student_widths', default='8,16,32', help='comma-separated channels of the first student layer, one student each')
+    parser.add_argument('--student_depth', type=int, default=4, help='number of stride-2 layers of the students')
+    parser.add_argument('--distill_epochs', type=int, default=10, help='passes over the train split per student')
+    parser.add_argument('--distill_lr', type=float, default=1e-3, help='initial learning rate of the students')
+    parser.add_argument('--w_map', type=float, default=1., help='weight of the error map loss')
+    opt = parser.parse_args()
+    opt.isTrain = True
+    opt.gpu_ids = [int(i) for i in opt.gpu_ids.split(',') if int(i) >= 0] if opt.device != 'cpu' else []
+    opt.load_weights, opt.scorer = False, ''
+    if opt.name == 'experiment_name':
+        opt.name = "%s/%s" % (opt.model, opt.dataset)
+    weights = os.path.join(opt.outf, opt.name, 'train', 'weights')
+    opt.netg = opt.netg or os.path.join(weights, 'netG_best.pth')
+    opt.netd = opt.netd or os.path.join(weights, 'netD_best.pth')
+    torch.manual_seed(opt.manualseed)
+
+    data = load_data_FD_aug(opt, opt.dataset)
+    model = load_model(opt, data, opt.dataset)
+    teacher = build_scorer(opt, opt.netg, opt.netd)
+    example = tuple(x.cpu() for x in calibration_batches(model, 1)[0])
+
+    # Latency is measured on the CPU for every scorer.
+    results = {}
+    auc, ms, teacher_scores = evaluate_scorer(model, teacher, 'cpu')
+    results['teacher'] = count_flops(teacher, example) + (ms, auc, 1.)
+    teacher.to(model.device)
+
+    for width in [int(w) for w in opt.student_widths.split(',')]:
+        print(">> Distilling student of width %d." % width)
+        student = StudentScorer(opt.nc, width, opt.student_depth).to(model.device)
+        distill(student, teacher, model, opt.distill_epochs, opt.distill_lr, opt.w_map)
+        student.cpu()
+        auc, ms, scores = evaluate_scorer(model, student, 'cpu')
+        corr = np.corrcoef(np.log(teacher_scores.numpy() + 1e-8), np.log(scores.numpy() + 1e-8))[0, 1]
+        results['width %d' % width] = count_flops(student, example) + (ms, auc, corr)
+        save_scorer(student, os.path.join(weights, 'netStudent_w%d.pt' % width), example)
+
+    base = results['teacher']
+    print("scorer       GMACs/img     params   ms/batch       AUC  log-score corr")
+    for name, (macs, params, ms, auc, corr) in results.items():
+        print("%-10s %11.4f %10d %10.2f    %.4f  %.3f  (AUC %+.4f, %.1fx faster)" %
+              (name, macs / 1e9, params, ms, auc, corr, auc - base[3], base[2] / ms))
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+ONNX EXPORT
+
+Usage: python export_onnx.py --dataset <class> [train/test options] [--netg PATH] [--netd PATH]
+
+Writes one ONNX graph computing the anomaly score (0.9 * rec + 0.1 * lat) and
+the per-pixel error map of raw images normalized to [-1, 1]: Laplacian split,
+netG and the feature branch of netD. The graph is then run with ONNX Runtime
+on the test split next to the PyTorch model, to check the scores and AUC match
+and to compare their latency.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+from options import Options
+from lib.data.dataloader import load_data_FD_aug
+from lib.evaluate import roc
+from lib.models.scorer import ImageScorer, OnnxScorer, build_scorer, export_onnx
+
+##
+def compare(loader, scorers, warmup=2):
+    """ Run every scorer on the same test batches.
+
+    Args:
+        loader (DataLoader): Test loader of --fd_mode torch, yielding (image, image, label).
+        scorers (dict): name -> image scorer.
+        warmup (int): Untimed first batches. All batches are timed when the
+            loader has no more than `warmup` of them.
+
+    Returns:
+        [dict]: name -> (scores, error maps, labels, ms/batch)
+    """
+    results = {name: ([], [], [], []) for name in scorers}
+    if len(loader) <= warmup:
+        warmup = 0
+    with torch.no_grad():
+        for i, data in enumerate(loader):
+            img, label = data[0].float(), data[-1]
+            for name, scorer in scorers.items():
+                scores, maps, labels, times = results[name]
+                time_i = time.perf_counter()
+                score, error_map = scorer(img)
+                if i >= warmup:
+                    times.append(time.perf_counter() - time_i)
+                scores.append(score.float())
+                maps.append(error_map.float())
+                labels.append(label)
+    return {name: (torch.cat(s), torch.cat(m), torch.cat(l), np.mean(t) * 1000)
+            for name, (s, m, l, t) in results.items()}
+
+##
+def main():
+    """ Export, check parity and time the ONNX scorer.
+    """
+    parser = Options().parser
+    parser.add_argument('--netg', default='', help='netG checkpoint. Default: <outf>/<name>/train/weights/netG_best.pth')
+    parser.add_argument('--netd', default='', help='netD checkpoint. Default: <outf>/<name>/train/weights/netD_best.pth')
+    parser.add_argument('--onnx_out', default='', help='output ONNX file. Default: <outf>/<name>/train/weights/netScorer.onnx')
+    parser.add_argument('--opset', type=int, default=17, help='ONNX opset version')
+    parser.add_argument('--ort_threads', type=int, default=0, help='ONNX Runtime intra-op threads. 0 uses one per core.')
+    parser.add_argument('--ort_batchsize', type=int, default=0, help='images per ONNX Runtime run. 0 runs whole test batches.')
+    parser.add_argument('--parity_tol', type=float, default=1e-3, help='largest relative score difference between ONNX Runtime and PyTorch')
+    opt = parser.parse_args()
+    opt.isTrain = True
+    opt.device, opt.gpu_ids = 'cpu', []
+    # The graph starts from the image: the loaders skip the lap/res split.
+    opt.fd_mode, opt.host_dtype = 'torch', 'float32'
+    if opt.name == 'experiment_name':
+        opt.name = "%s/%s" % (opt.model, opt.dataset)
+    weights = os.path.join(opt.outf, opt.name, 'train', 'weights')
+    opt.netg = opt.netg or os.path.join(weights, 'netG_best.pth')
+    opt.netd = opt.netd or os.path.join(weights, 'netD_best.pth')
+    opt.onnx_out = opt.onnx_out or os.path.join(weights, 'netScorer.onnx')
+    torch.manual_seed(opt.manualseed)
+
+    data = load_data_FD_aug(opt, opt.dataset)
+    scorer = ImageScorer(build_scorer(opt, opt.netg, opt.netd), opt.nc).eval()
+    if opt.ort_threads > 0:
+        torch.set_num_threads(opt.ort_threads)
+
+    print(">> Exporting %s (opset %d)." % (opt.onnx_out, opt.opset))
+    export_onnx(scorer, opt.onnx_out, next(iter(data.valid))[0].float(), opt.opset)
+    onnx_scorer = OnnxScorer(opt.onnx_out, threads=opt.ort_threads, batchsize=opt.ort_batchsize)
+
+    results = compare(data.valid, {'torch': scorer, 'onnx': onnx_scorer})
+    for name, (scores, _, labels, ms) in results.items():
+        print("%5s: AUC %.4f  %8.2f ms/batch  %8.1f images/s" % (name, roc(labels, scores), ms, opt.batchsize * 1000 / ms))
+    scores, maps = results['torch'][0], results['torch'][1]
+    score_diff = ((results['onnx'][0] - scores).abs() / scores.abs().clamp(min=1e-12)).max().item()
+    map_diff = (results['onnx'][1] - maps).abs().max().item()
+    print("Max relative score diff %.2e, max abs error map diff %.2e, speedup %.2fx" %
+          (score_diff, map_diff, results['torch'][3] / results['onnx'][3]))
+    if score_diff > opt.parity_tol:
+        print("Parity check failed (--parity_tol %.1e)." % opt.parity_tol)
+        sys.exit(1)
+    return results
+
+if __name__ == '__main__':
+    main()
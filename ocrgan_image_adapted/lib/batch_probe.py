@@ -0,0 +1,143 @@
+"""
+BATCH SIZE PROBE
+"""
+
+# pylint: disable=C0301,E1101,W0622,C0103,R0902,R0915
+
+import copy
+import multiprocessing
+import signal
+import time
+
+import torch
+
+from lib.memory import PeakMemory, available_memory, is_out_of_memory
+from lib.models import load_model
+from options import save_options
+
+##
+def time_batch(model, batchsize, steps):
+    """ Run optimize_params on a synthetic batch.
+
+    The warm-up step is measured too: it allocates the activations, gradients
+    and optimizer states that the later steps reuse.
+
+    Args:
+        model (BaseModel_Aug): Model with its optimizers.
+        batchsize (int): Batch size.
+        steps (int): Number of timed steps, after one warm-up step.
+
+    Returns:
+        [tuple]: (samples/s, memory in use before the steps, peak memory added by them), in bytes
+    """
+    opt = model.opt
+    for name in ('input_lap', 'input_res', 'fake_aug'):
+        getattr(model, name).resize_(batchsize, opt.nc, opt.isize, opt.isize).normal_()
+    model.noise.resize_(batchsize, opt.nc, opt.isize, opt.isize).zero_()
+    model.real_label.resize_(batchsize).fill_(1.)
+    model.fake_label.resize_(batchsize).fill_(0.)
+
+    with PeakMemory(model.device) as mem:
+        model.optimize_params()
+        if model.device.type == 'cuda':
+            torch.cuda.synchronize()
+        time_i = time.time()
+        for _ in range(steps):
+            model.optimize_params()
+        if model.device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = time.time() - time_i
+    return batchsize * steps / max(elapsed, 1e-9), mem.base, mem.peak
+
+def _probe_worker(opt, batchsize, steps, conn):
+    """ Process target of probe_in_process: sends time_batch(), or None when out of memory. """
+    try:
+        torch.manual_seed(opt.manualseed)
+        conn.send(time_batch(load_model(opt, None, opt.dataset), batchsize, steps))
+    except RuntimeError as e:
+        if not is_out_of_memory(e):
+            raise
+        conn.send(None)
+    finally:
+        conn.close()
+
+def probe_in_process(opt, batchsize, steps):
+    """ time_batch() with a new model in a fresh process.
+
+    On the CPU, PeakMemory measures the RSS growth, and pages freed by a smaller
+    batch in the same process would be reused and hide the memory of the larger
+    one. A process killed by the OOM killer counts as out of memory.
+
+    Returns:
+        [tuple]: time_batch() result, or None when out of memory.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    recv, send = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_probe_worker, args=(opt, batchsize, steps, send))
+    proc.start()
+    send.close()
+    try:
+        result = recv.recv()
+    except EOFError:
+        result = None
+    proc.join()
+    if proc.exitcode not in (0, -signal.SIGKILL):
+        raise RuntimeError("Probe of batch size %d failed with exit code %d." % (batchsize, proc.exitcode))
+    return result
+
+##
+def probe_batchsize(opt, steps=3, min_gain=0.05):
+    """ Pick the batch size for opt.isize / opt.ngf / opt.nz from synthetic training steps.
+
+    Batch sizes 2, 4, 8, ... up to opt.probe_max_batchsize are timed with a
+    throwaway model, each in a fresh process. Growth stops when the peak memory
+    exceeds the budget, an allocation fails, or the next size is predicted
+    (memory grows linearly with the batch) to exceed the budget. The chosen size is the largest one that
+    fits and raised throughput by at least `min_gain` over the previous choice.
+    With --accum_steps K, the probed size is the size of one pass, and
+    opt.batchsize is set to K times that. The result is written back to opt
+    and to opt.txt.
+
+    Args:
+        opt ([type]): Argument Parser
+        steps (int): Timed steps per batch size.
+        min_gain (float): Relative throughput gain needed to prefer a larger batch.
+
+    Returns:
+        [int]: Chosen opt.batchsize.
+    """
+    probe_opt = copy.deepcopy(opt)
+    probe_opt.micro_batch = 0
+    # The device of BaseModel_Aug (the probe is single-process).
+    device = torch.device("cuda:0" if opt.device != 'cpu' else "cpu")
+    budget = opt.probe_budget_mb * 2**20 if opt.probe_budget_mb > 0 else 0.9 * available_memory(device)
+
+    print(">> Probing the batch size (budget %.0f MB)." % (budget / 2**20))
+    best, best_rate, batchsize = None, 0., 2
+    while batchsize <= opt.probe_max_batchsize:
+        probe_opt.batchsize = batchsize
+        result = probe_in_process(probe_opt, batchsize, steps)
+        if result is None:
+            print("   batch %4d: out of memory" % batchsize)
+            break
+        rate, base, added = result
+        print("   batch %4d: %8.1f samples/s  peak %8.1f MB" % (batchsize, rate, (base + added) / 2**20))
+        if budget > 0 and base + added > budget:
+            break
+        if best is None or rate > best_rate * (1 + min_gain):
+            best, best_rate = batchsize, rate
+        if budget > 0 and added <= 0:
+            print("   Memory use not measurable on this host, stopping.")
+            break
+        # Activations, i.e. the memory added by a step, double with the batch.
+        if budget > 0 and base + 2 * added > budget:
+            break
+        batchsize *= 2
+
+    if best is None:
+        raise RuntimeError("No batch size fits in the memory budget of %.0f MB." % (budget / 2**20))
+    opt.batchsize = best * opt.accum_steps
+    opt.probe = "pass of %d samples, %.1f samples/s" % (best, best_rate)
+    save_options(opt)
+    print("   Using batchsize %d (%s)." % (opt.batchsize, opt.probe))
+    return opt.batchsize
@@ -10,12 +10,18 @@ import numpy as np
 import torch
 import random
 import math
+import time
 from torchvision.transforms import *
 from PIL import Image, ImageDraw
 from torchvision import transforms
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, DistributedSampler
+from torch.utils.data.dataloader import default_collate
 from torchvision.datasets import MNIST, CIFAR10
-from lib.data.datasets import ImageFolder_FD, ImageFolder, ImageFolder_FD_Aug
+from lib.data.datasets import ImageFolder_FD, ImageFolder, ImageFolder_FD_Aug, ImageFolder_Aug, ImageFolder_Fused
+from lib.data.datasets import PackedFolder_FD_Aug, PackedFolder_Aug, PackedFolder_Fused
+from lib.data.fd_cache import FDCache
+from lib.data.manifest import load_dims
+from lib.data.shm_cache import SharedImageCache
 class Cutout(object):
     """Randomly mask out one or more patches from an image.
     Args:
@@ -49,7 +55,7 @@ class Cutout(object):
 
             mask[y1: y2, x1: x2] = 0.
 
-        mask = torch.from_numpy(mask)
+        mask = torch.from_numpy(mask).to(img.dtype)
         mask = mask.expand_as(img)
         img = img * mask
 
@@ -107,6 +113,136 @@ class CutPaste(object):
         
         return img
 
+# RGB <-> YIQ, used to rotate hue without going through HSV.
+_RGB_TO_YIQ = torch.tensor([[0.299, 0.587, 0.114],
+                            [0.596, -0.274, -0.322],
+                            [0.211, -0.523, 0.312]])
+_YIQ_TO_RGB = torch.linalg.inv(_RGB_TO_YIQ)
+
+def _rotate_hue(img, angle):
+    """Rotate the hue of a (B, 3, H, W) batch by per-sample angles (in turns)."""
+    n = img.size(0)
+    theta = angle * 2 * math.pi
+    rot = torch.zeros(n, 3, 3, dtype=img.dtype, device=img.device)
+    rot[:, 0, 0] = 1.
+    rot[:, 1, 1] = theta.cos()
+    rot[:, 1, 2] = -theta.sin()
+    rot[:, 2, 1] = theta.sin()
+    rot[:, 2, 2] = theta.cos()
+    mat = _YIQ_TO_RGB.to(img) @ rot @ _RGB_TO_YIQ.to(img)
+    return torch.bmm(mat, img.flatten(2)).view_as(img).clamp(0., 1.)
+
+class BatchCutPaste(object):
+    """CutPaste followed by Cutout on a whole batch, with tensor ops only.
+
+    Works on collated (B, C, H, W) tensors, normalized to [-1, 1] or uint8, on
+    any device.
+    Each sample gets one patch with its own random size, source and target boxes,
+    and color jitter (brightness, contrast, saturation, and a hue rotation in
+    YIQ space). With cross_image=True, the patch comes from a random image of
+    the same batch. Then one length x length square is cut out of each sample.
+    Only the patches and holes are touched, plus one copy of the batch.
+
+    Args:
+        area_ratio, aspect_ratio, colorJitter: As in CutPaste.
+        n_holes, length: As in Cutout.
+        cross_image (bool): Sample patches from other images of the batch.
+    """
+    def __init__(self, area_ratio=[0.02,0.15], aspect_ratio=0.3, colorJitter=0.1, n_holes=1, length=20, cross_image=True):
+        self.area_ratio = area_ratio
+        self.aspect_ratio = aspect_ratio
+        self.colorJitter = colorJitter
+        self.n_holes = n_holes
+        self.length = length
+        self.cross_image = cross_image
+
+    @staticmethod
+    def _uniform(n, low, high, device):
+        return torch.rand(n, device=device) * (high - low) + low
+
+    @staticmethod
+    def _repeat_weight(cut, size):
+        # 1 for the first cut - 1 entries, 1 / repeats for the last one and its copies.
+        pos = torch.arange(size, device=cut.device).view(1, -1)
+        cut = cut.view(-1, 1)
+        return torch.where(pos < cut - 1, torch.ones_like(pos, dtype=torch.float), 1. / (size - cut + 1).float())
+
+    def _jitter(self, img, mask):
+        # img in [0, 1], mask (B, 1, H, W) weights the pixels of the contrast mean.
+        n, j, dev = img.size(0), self.colorJitter, img.device
+        img = img * self._uniform(n, max(0., 1 - j), 1 + j, dev).view(-1, 1, 1, 1)
+        img = img.clamp(0., 1.)
+        gray = (0.299 * img[:, 0] + 0.587 * img[:, 1] + 0.114 * img[:, 2]).unsqueeze(1)
+        mean = (gray * mask).sum((1, 2, 3), keepdim=True) / mask.sum((1, 2, 3), keepdim=True).clamp(min=1.)
+        c = self._uniform(n, max(0., 1 - j), 1 + j, dev).view(-1, 1, 1, 1)
+        img = (c * img + (1 - c) * mean).clamp(0., 1.)
+        gray = (0.299 * img[:, 0] + 0.587 * img[:, 1] + 0.114 * img[:, 2]).unsqueeze(1)
+        s = self._uniform(n, max(0., 1 - j), 1 + j, dev).view(-1, 1, 1, 1)
+        img = (s * img + (1 - s) * gray).clamp(0., 1.)
+        return _rotate_hue(img, self._uniform(n, -j, j, dev))
+
+    def __call__(self, img):
+        """
+        Args:
+            img (Tensor): Normalized or uint8 batch of size (B, C, H, W).
+        Returns:
+            Tensor: Augmented batch.
+        """
+        B, C, H, W = img.shape
+        dev = img.device
+
+        # Box sizes, as in CutPaste.
+        area = self._uniform(B, self.area_ratio[0], self.area_ratio[1], dev) * H * W
+        aspect = self._uniform(B, self.aspect_ratio, 1 / self.aspect_ratio, dev)
+        cut_w = torch.sqrt(area * aspect).round().long().clamp(1, W)
+        cut_h = torch.sqrt(area / aspect).round().long().clamp(1, H)
+        from_y = (torch.rand(B, device=dev) * (H - cut_h)).long()
+        from_x = (torch.rand(B, device=dev) * (W - cut_w)).long()
+        to_y = (torch.rand(B, device=dev) * (H - cut_h)).long()
+        to_x = (torch.rand(B, device=dev) * (W - cut_w)).long()
+
+        # Crop all patches into one (B, C, max_h, max_w) tensor. Rows and columns
+        # past a patch's own size repeat its last one, so that they can be pasted
+        # as well: they write the same value twice instead of needing a mask.
+        ph, pw = int(cut_h.max()), int(cut_w.max())
+        py = torch.minimum(torch.arange(ph, device=dev).view(1, ph), cut_h.view(-1, 1) - 1).view(B, 1, ph, 1)
+        px = torch.minimum(torch.arange(pw, device=dev).view(1, pw), cut_w.view(-1, 1) - 1).view(B, 1, 1, pw)
+        chan = torch.arange(C, device=dev).view(1, C, 1, 1)
+        src = torch.randperm(B, device=dev) if self.cross_image else torch.arange(B, device=dev)
+        source = ((src.view(B, 1, 1, 1) * C + chan) * H + from_y.view(B, 1, 1, 1) + py) * W + from_x.view(B, 1, 1, 1) + px
+        patch = img.reshape(-1)[source]
+        if self.colorJitter and C == 3:
+            # Weights undo the repeats in the contrast mean.
+            weight = self._repeat_weight(cut_h, ph).view(B, 1, ph, 1) * self._repeat_weight(cut_w, pw).view(B, 1, 1, pw)
+            if img.dtype == torch.uint8:
+                patch = (self._jitter(patch.float() / 255., weight) * 255.).round_().to(torch.uint8)
+            else:
+                patch = self._jitter(patch * 0.5 + 0.5, weight.to(img.dtype)) * 2. - 1.
+
+        # Paste every patch into its target box.
+        out = img.clone().reshape(-1)
+        base = torch.arange(B, device=dev).view(B, 1, 1, 1) * C + chan
+        out[((base * H + to_y.view(B, 1, 1, 1) + py) * W + to_x.view(B, 1, 1, 1) + px).expand_as(patch)] = patch
+
+        # Cutout: zero in [0, 1], i.e. -1 once normalized. Holes crossing the
+        # image border are clipped to it, as in Cutout.
+        side = torch.arange(self.length, device=dev).view(1, -1) - self.length // 2
+        for _ in range(self.n_holes):
+            hy = (torch.randint(H, (B, 1), device=dev) + side).clamp(0, H - 1).view(B, 1, -1, 1)
+            hx = (torch.randint(W, (B, 1), device=dev) + side).clamp(0, W - 1).view(B, 1, 1, -1)
+            out[((base * H + hy) * W + hx).expand(B, C, self.length, self.length)] = 0 if img.dtype == torch.uint8 else -1.
+        return out.view(B, C, H, W)
+
+class BatchAugCollate(object):
+    """Collate a batch, then apply a batch augmentation to its fake_aug entry (second to last)."""
+    def __init__(self, augment):
+        self.augment = augment
+
+    def __call__(self, batch):
+        batch = default_collate(batch)
+        batch[-2] = self.augment(batch[-2])
+        return batch
+
 class Data:
     """ Dataloader containing train and valid sets.
     """
@@ -114,6 +250,134 @@ class Data:
         self.train = train
         self.valid = valid
 
+##
+def make_loader(opt, dataset, shuffle, drop_last, workers=None, prefetch_factor=None, persistent=True, collate_fn=None, batch_size=None, sampler=None):
+    """ Build a DataLoader honouring the loader options.
+
+    Args:
+        opt ([type]): Argument Parser
+        dataset (Dataset): Dataset to load.
+        shuffle (bool): Reshuffle the data at every epoch.
+        drop_last (bool): Drop the last incomplete batch.
+        workers (int): Number of worker processes. Defaults to opt.workers.
+        prefetch_factor (int): Batches loaded in advance by each worker. Defaults to opt.prefetch_factor.
+        persistent (bool): Keep the workers alive between epochs.
+        collate_fn (callable): Batch collation. Defaults to default_collate.
+        batch_size (int): Samples per batch. Defaults to opt.batchsize.
+        sampler (Sampler): Sampler of the dataset, which then does the shuffling.
+
+    Returns:
+        [DataLoader]: dataloader
+    """
+    workers = opt.workers if workers is None else workers
+    prefetch_factor = opt.prefetch_factor if prefetch_factor is None else prefetch_factor
+    batch_size = opt.batchsize if batch_size is None else batch_size
+    kwargs = dict(batch_size=batch_size, shuffle=shuffle and sampler is None, sampler=sampler, drop_last=drop_last,
+                  num_workers=workers, pin_memory=torch.cuda.is_available() and opt.device != 'cpu', collate_fn=collate_fn)
+    if workers > 0:
+        kwargs.update(persistent_workers=persistent, prefetch_factor=prefetch_factor)
+    return DataLoader(dataset=dataset, **kwargs)
+
+##
+def autotune_loader(opt, dataset, collate_fn=None):
+    """ Pick the worker/prefetch setting with the highest throughput.
+
+    Every candidate loads the first opt.autotune_batches batches of the dataset.
+    The first batch, which includes the worker start-up, is not timed.
+    The winner is written back to opt.workers and opt.prefetch_factor.
+
+    Args:
+        opt ([type]): Argument Parser
+        dataset (Dataset): Train dataset.
+    """
+    ncpu = os.cpu_count() or 1
+    workers = sorted({w for w in (0, 2, 4, 8, 16, opt.workers, ncpu) if w <= max(ncpu, opt.workers)})
+    candidates = [(w, p) for w in workers for p in ((2, 4) if w > 0 else (2,))]
+    nbatches = max(2, min(opt.autotune_batches, len(dataset) // opt.batchsize))
+
+    print(">> Autotuning the data loader on %d batches." % nbatches)
+    best, best_rate = (opt.workers, opt.prefetch_factor), 0.
+    for w, p in candidates:
+        loader = make_loader(opt, dataset, shuffle=True, drop_last=True, workers=w, prefetch_factor=p, persistent=False, collate_fn=collate_fn)
+        it = iter(loader)
+        next(it)
+        time_i = time.time()
+        nsamples = 0
+        for _ in range(nbatches - 1):
+            batch = next(it, None)
+            if batch is None:
+                break
+            nsamples += batch[0].size(0)
+        rate = nsamples / max(time.time() - time_i, 1e-9)
+        del it, loader
+        print("   workers: %2d prefetch: %d -> %.1f samples/s" % (w, p, rate))
+        if rate > best_rate:
+            best, best_rate = (w, p), rate
+
+    opt.workers, opt.prefetch_factor = best
+    print("   Using workers: %d prefetch: %d" % best)
+
+##
+def attach_shm_cache(opt, datasets):
+    """ Share one SharedImageCache of opt.shm_cache_mb between datasets.
+
+    The slot size is that of the largest image of all datasets, so that every
+    image fits a slot. With --manifest, the dimensions recorded in the
+    manifests are used; images missing there, and all images without
+    --manifest, have their header read.
+
+    Args:
+        opt ([type]): Argument Parser
+        datasets (list): Datasets reading their images with cv2_loader.
+    """
+    slot_bytes = 0
+    for ds in datasets:
+        dims = load_dims(ds.root) if getattr(opt, 'manifest', False) else {}
+        for path, _ in ds.imgs:
+            if path in dims:
+                w, h = dims[path]
+            else:
+                with Image.open(path) as img:
+                    w, h = img.size
+            if opt.shm_cache_size > 0:
+                scale = opt.shm_cache_size / min(h, w)
+                w, h = round(w * scale), round(h * scale)
+            slot_bytes = max(slot_bytes, w * h * 3)
+    cache = SharedImageCache(opt.shm_cache_mb * 2**20, slot_bytes, opt.shm_cache_size)
+    for ds in datasets:
+        ds.shm_cache = cache
+    print(">> Shared image cache: %d slots of %.2f MB." % (cache.num_slots, slot_bytes / 2**20))
+
+##
+def make_data(opt, train_ds, valid_ds):
+    """ Wrap the train and valid sets into dataloaders.
+
+    Args:
+        opt ([type]): Argument Parser
+        train_ds (Dataset): Train set.
+        valid_ds (Dataset): Valid set.
+
+    Returns:
+        [Data]: dataloaders
+    """
+    if getattr(opt, 'shm_cache_mb', 0) > 0 and hasattr(train_ds, 'shm_cache'):
+        attach_shm_cache(opt, [train_ds, valid_ds])
+    # --batch_aug cpu: augment fake_aug after collation, in the workers.
+    collate_fn = BatchAugCollate(BatchCutPaste()) if getattr(opt, 'batch_aug', 'off') == 'cpu' else None
+    if getattr(opt, 'loader_autotune', False):
+        autotune_loader(opt, train_ds, collate_fn)
+    # Multi-process training: every process loads its own shard of the train
+    # set, in batches of --batchsize. The valid set is only used by rank 0.
+    sampler = None
+    if getattr(opt, 'distributed', False):
+        sampler = DistributedSampler(train_ds, num_replicas=opt.world_size, rank=opt.rank, shuffle=True,
+                                     seed=max(opt.manualseed, 0), drop_last=True)
+    # --accum_steps: the optimizers step once every accum_steps train batches.
+    train_dl = make_loader(opt, train_ds, shuffle=True, drop_last=True, collate_fn=collate_fn,
+                           batch_size=opt.batchsize // getattr(opt, 'accum_steps', 1), sampler=sampler)
+    valid_dl = make_loader(opt, valid_ds, shuffle=False, drop_last=False)
+    return Data(train_dl, valid_dl)
+
 ##
 def load_data(opt, classes):
     """ Load Data
@@ -141,14 +405,11 @@ def load_data(opt, classes):
                                     transforms.ToTensor(),
                                     transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)), ])
 
-    train_ds = ImageFolder(os.path.join(opt.dataroot, 'train'), transform)
-    valid_ds = ImageFolder(os.path.join(opt.dataroot, 'test'), transform)
+    train_ds = ImageFolder(os.path.join(opt.dataroot, 'train'), transform, manifest=opt.manifest)
+    valid_ds = ImageFolder(os.path.join(opt.dataroot, 'test'), transform, manifest=opt.manifest)
 
     ## DATALOADER
-    train_dl = DataLoader(dataset=train_ds, batch_size=opt.batchsize, shuffle=True, drop_last=True)
-    valid_dl = DataLoader(dataset=valid_ds, batch_size=opt.batchsize, shuffle=False, drop_last=False)
-
-    return Data(train_dl, valid_dl)
+    return make_data(opt, train_ds, valid_ds)
 
 def load_data_FD(opt, classes):
     """ Load Data
@@ -176,14 +437,11 @@ def load_data_FD(opt, classes):
                                     transforms.ToTensor(),
                                     transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)), ])
 
-    train_ds = ImageFolder_FD(os.path.join(opt.dataroot, 'train'), transform)
-    valid_ds = ImageFolder_FD(os.path.join(opt.dataroot, 'test'), transform)
+    train_ds = ImageFolder_FD(os.path.join(opt.dataroot, 'train'), transform, manifest=opt.manifest)
+    valid_ds = ImageFolder_FD(os.path.join(opt.dataroot, 'test'), transform, manifest=opt.manifest)
 
     ## DATALOADER
-    train_dl = DataLoader(dataset=train_ds, batch_size=opt.batchsize, shuffle=True, drop_last=True)
-    valid_dl = DataLoader(dataset=valid_ds, batch_size=opt.batchsize, shuffle=False, drop_last=False)
-
-    return Data(train_dl, valid_dl)
+    return make_data(opt, train_ds, valid_ds)
 
 def load_data_FD_aug(opt, classes):
     """ Load Data
@@ -206,6 +464,21 @@ def load_data_FD_aug(opt, classes):
         else:
             opt.dataroot = './data/{}'.format(opt.dataset)
 
+    train_ds, valid_ds = make_datasets_FD_aug(opt)
+
+    ## DATALOADER
+    return make_data(opt, train_ds, valid_ds)
+
+##
+def make_datasets_FD_aug(opt):
+    """ Build the train and valid sets of load_data_FD_aug for opt.fd_mode and opt.data_format.
+
+    Args:
+        opt ([type]): Argument Parser, with opt.dataroot set.
+
+    Returns:
+        [tuple]: (train_ds, valid_ds)
+    """
     transform = transforms.Compose([transforms.Resize(opt.isize),
                                     transforms.CenterCrop(opt.isize),
                                     transforms.ToTensor(),
@@ -219,14 +492,55 @@ def load_data_FD_aug(opt, classes):
                                         #RandomErasing(),
                                         #RandomPolygonErasing(),
                                         transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)), ])
-
-    train_ds = ImageFolder_FD_Aug(os.path.join(opt.dataroot, 'train'), transform, transform_aug)
-    valid_ds = ImageFolder_FD_Aug(os.path.join(opt.dataroot, 'test'), transform, transform_aug)
-
-    ## DATALOADER
-    train_dl = DataLoader(dataset=train_ds, batch_size=opt.batchsize, shuffle=True, drop_last=True)
-    valid_dl = DataLoader(dataset=valid_ds, batch_size=opt.batchsize, shuffle=False, drop_last=False)
-
-    return Data(train_dl, valid_dl)
+    # --fd_mode fused: the dataset already returns isize images, normalized.
+    fused_aug = transforms.Compose([CutPaste(),
+                                    transforms.ToTensor(),
+                                    Cutout(1,20),
+                                    transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)), ])
+    if opt.host_dtype == 'uint8':
+        # Raw uint8 tensors, normalized by set_input on the model device.
+        transform = transforms.Compose([transforms.Resize(opt.isize),
+                                        transforms.CenterCrop(opt.isize),
+                                        transforms.PILToTensor(), ])
+        transform_aug = transforms.Compose([transforms.Resize(opt.isize),
+                                            transforms.CenterCrop(opt.isize),
+                                            CutPaste(),
+                                            transforms.PILToTensor(),
+                                            Cutout(1,20), ])
+        fused_aug = transforms.Compose([CutPaste(),
+                                        transforms.PILToTensor(),
+                                        Cutout(1,20), ])
+    if opt.batch_aug != 'off':
+        # fake_aug is augmented per batch by BatchCutPaste instead.
+        transform_aug = transform
+        fused_aug = None
+
+    if opt.data_format == 'packed':
+        # Splits packed by data_creation/pack_dataset.py: <dataroot>/{train,test}.pack
+        if opt.fd_mode == 'fused':
+            train_ds = PackedFolder_Fused(os.path.join(opt.dataroot, 'train'), opt.isize, fused_aug, normalize=opt.host_dtype != 'uint8')
+            valid_ds = PackedFolder_Fused(os.path.join(opt.dataroot, 'test'), opt.isize, fused_aug, normalize=opt.host_dtype != 'uint8')
+        elif opt.fd_mode == 'torch':
+            train_ds = PackedFolder_Aug(os.path.join(opt.dataroot, 'train'), opt.isize, transform, transform_aug)
+            valid_ds = PackedFolder_Aug(os.path.join(opt.dataroot, 'test'), opt.isize, transform, transform_aug)
+        else:
+            train_ds = PackedFolder_FD_Aug(os.path.join(opt.dataroot, 'train'), transform, transform_aug)
+            valid_ds = PackedFolder_FD_Aug(os.path.join(opt.dataroot, 'test'), transform, transform_aug)
+    elif opt.fd_mode == 'fused':
+        train_ds = ImageFolder_Fused(os.path.join(opt.dataroot, 'train'), opt.isize, fused_aug, manifest=opt.manifest, normalize=opt.host_dtype != 'uint8')
+        valid_ds = ImageFolder_Fused(os.path.join(opt.dataroot, 'test'), opt.isize, fused_aug, manifest=opt.manifest, normalize=opt.host_dtype != 'uint8')
+    elif opt.fd_mode == 'torch':
+        # The lap/res split is done by the model on whole batches.
+        train_ds = ImageFolder_Aug(os.path.join(opt.dataroot, 'train'), opt.isize, transform, transform_aug, manifest=opt.manifest)
+        valid_ds = ImageFolder_Aug(os.path.join(opt.dataroot, 'test'), opt.isize, transform, transform_aug, manifest=opt.manifest)
+    else:
+        train_ds = ImageFolder_FD_Aug(os.path.join(opt.dataroot, 'train'), transform, transform_aug, manifest=opt.manifest)
+        valid_ds = ImageFolder_FD_Aug(os.path.join(opt.dataroot, 'test'), transform, transform_aug, manifest=opt.manifest)
+
+    ## FD CACHE
+    if opt.fd_cache != '' and opt.fd_mode == 'cv2' and opt.data_format == 'folder':
+        for ds in (train_ds, valid_ds):
+            ds.cache = FDCache(opt.fd_cache, ds.root, len(ds), opt.isize)
+    return train_ds, valid_ds
 
 
@@ -14,12 +14,14 @@ from PIL import Image
 import numpy as np
 import os
 import os.path
+import json
 import random
 import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
 import cv2
 from PIL import ImageFile
+from lib.data.manifest import load_split
 
 # pylint: disable=E1101
 
@@ -55,6 +57,59 @@ def make_dataset(dir, class_to_idx):
 
     return images
 
+def scan_split(root, manifest=False):
+    """ find_classes() and make_dataset() of a split, optionally through its cached manifest.
+
+    Args:
+        root (str): Split directory.
+        manifest (bool): Reuse <root>.manifest.json, rescanning only the directories changed since it was written.
+
+    Returns:
+        [tuple]: (classes, class_to_idx, images)
+    """
+    if manifest:
+        return load_split(root, is_image_file)
+    classes, class_to_idx = find_classes(root)
+    return classes, class_to_idx, make_dataset(root, class_to_idx)
+
+def mask_path(image_path):
+    """ Ground-truth mask of a test image, as written by the data_creation scripts with --keep_masks:
+    <dataroot>/ground_truth/<class>/<image name>.png for <dataroot>/test/<class>/<image name>.<ext>.
+    """
+    class_dir, name = os.path.split(image_path)
+    split_dir, class_name = os.path.split(class_dir)
+    return os.path.join(os.path.dirname(split_dir), 'ground_truth', class_name, os.path.splitext(name)[0] + '.png')
+
+def load_mask(image_path, isize):
+    """ Boolean isize x isize mask of a test image, squashed like the image. All False if the image has no mask. """
+    path = mask_path(image_path)
+    if not os.path.exists(path):
+        return np.zeros((isize, isize), dtype=bool)
+    mask = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    return cv2.resize(mask, (isize, isize), interpolation=cv2.INTER_NEAREST) > 0
+
+def resize_shorter(img, size):
+    """ Resize a cv2 image so that its shorter side is `size`. """
+    h, w = img.shape[:2]
+    scale = size / min(h, w)
+    if scale == 1:
+        return img
+    interp = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    return cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=interp)
+
+def cv2_loader(path, cache=None):
+    """ cv2.imread going through an optional SharedImageCache. """
+    if cache is None:
+        return cv2.imread(path)
+    key = cache.key(path, cache.size)
+    img = cache.get(key)
+    if img is None:
+        img = cv2.imread(path)
+        if cache.size > 0:
+            img = resize_shorter(img, cache.size)
+        cache.put(key, img)
+    return img
+
 def pil_loader(path):
     # open path as file to avoid ResourceWarning (https://github.com/python-pillow/Pillow/issues/835)
     with open(path, 'rb') as f:
@@ -77,9 +132,8 @@ def default_loader(path):
         return pil_loader(path)
 
 class ImageFolder(data.Dataset):
-    def __init__(self, root, transform=None):
-        classes, class_to_idx = find_classes(root)
-        imgs = make_dataset(root, class_to_idx)
+    def __init__(self, root, transform=None, manifest=False):
+        classes, class_to_idx, imgs = scan_split(root, manifest)
         if len(imgs) == 0:
             raise(RuntimeError("Found 0 images in subfolders of: " + root + "\n"
                                "Supported image extensions are: " + ",".join(IMG_EXTENSIONS)))
@@ -90,6 +144,8 @@ class ImageFolder(data.Dataset):
         self.classes = classes
         self.class_to_idx = class_to_idx
         self.transform = transform
+        # Optional SharedImageCache of decoded images, shared by all workers.
+        self.shm_cache = None
         # self.target_transform = target_transform
         # self.loader = loader
 
@@ -102,7 +158,7 @@ class ImageFolder(data.Dataset):
             tuple: (image, target) where target is class_index of the target class.
         """
         path, target = self.imgs[index]
-        img = cv2.imread(path)
+        img = cv2_loader(path, self.shm_cache)
         img = Image.fromarray(img)
         if self.transform is not None:
             img = self.transform(img)
@@ -130,10 +186,46 @@ def FD(img):
     temp_pyrUp = Image.fromarray(temp_pyrUp)
     return temp_lap, temp_pyrUp
 
+# cv2.imread flags decoding JPEGs at 1/2, 1/4 and 1/8 of their resolution.
+REDUCED_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+def imread_reduced(path, size):
+    """ cv2.imread a JPEG at the smallest DCT scale whose sides are still >= size.
+
+    Other formats, which have no scaled decoding, are read at full resolution.
+    """
+    with Image.open(path) as header:
+        fmt, (w, h) = header.format, header.size
+    if fmt == 'JPEG':
+        for factor, flag in REDUCED_FLAGS:
+            if min(w, h) // factor >= size:
+                return cv2.imread(path, flag)
+    return cv2.imread(path)
+
+def FD_fused(img, isize):
+    """ Resize once to isize and decompose there, into one shared buffer.
+
+    Same steps as FD(), but the image is squashed straight to isize x isize
+    instead of 256 x 256 and then resized again by the transforms.
+
+    Args:
+        img (np.ndarray): BGR uint8 image of any size.
+        isize (int): Output size.
+
+    Returns:
+        [np.ndarray]: uint8 array of shape (3, isize, isize, 3) holding lap, res
+            and the resized image, which is also the augmentation source.
+    """
+    buf = np.empty((3, isize, isize, 3), dtype=np.uint8)
+    interp = cv2.INTER_AREA if min(img.shape[:2]) > isize else cv2.INTER_LINEAR
+    cv2.resize(img, (isize, isize), dst=buf[2], interpolation=interp)
+    cv2.pyrUp(cv2.pyrDown(buf[2]), dst=buf[1], dstsize=(isize, isize))
+    cv2.subtract(buf[2], buf[1], dst=buf[0])
+    return buf
+
 class ImageFolder_FD(data.Dataset):
-    def __init__(self, root, transform=None):
-        classes, class_to_idx = find_classes(root)
-        imgs = make_dataset(root, class_to_idx)
+    def __init__(self, root, transform=None, manifest=False):
+        classes, class_to_idx, imgs = scan_split(root, manifest)
         if len(imgs) == 0:
             raise(RuntimeError("Found 0 images in subfolders of: " + root + "\n"
                                "Supported image extensions are: " + ",".join(IMG_EXTENSIONS)))
@@ -144,6 +236,7 @@ class ImageFolder_FD(data.Dataset):
         self.classes = classes
         self.class_to_idx = class_to_idx
         self.transform = transform
+        self.shm_cache = None
         
 
     def __getitem__(self, index):
@@ -155,7 +248,7 @@ class ImageFolder_FD(data.Dataset):
             tuple: (image, target) where target is class_index of the target class.
         """
         path, target = self.imgs[index]
-        img = cv2.imread(path)
+        img = cv2_loader(path, self.shm_cache)
         lap, res = FD(img)
         if self.transform is not None:
             lap = self.transform(lap)
@@ -173,9 +266,8 @@ class ImageFolder_FD(data.Dataset):
         return len(self.imgs)
 
 class ImageFolder_FD_Aug(data.Dataset):
-    def __init__(self, root, transform=None, transform_aug=None):
-        classes, class_to_idx = find_classes(root)
-        imgs = make_dataset(root, class_to_idx)
+    def __init__(self, root, transform=None, transform_aug=None, cache=None, manifest=False):
+        classes, class_to_idx, imgs = scan_split(root, manifest)
         if len(imgs) == 0:
             raise(RuntimeError("Found 0 images in subfolders of: " + root + "\n"
                                "Supported image extensions are: " + ",".join(IMG_EXTENSIONS)))
@@ -187,6 +279,9 @@ class ImageFolder_FD_Aug(data.Dataset):
         self.class_to_idx = class_to_idx
         self.transform = transform
         self.transform_aug = transform_aug
+        # Optional FDCache holding the decomposed planes of every image.
+        self.cache = cache
+        self.shm_cache = None
         
 
     def __getitem__(self, index):
@@ -198,9 +293,15 @@ class ImageFolder_FD_Aug(data.Dataset):
             tuple: (image, target) where target is class_index of the target class.
         """
         path, target = self.imgs[index]
-        img = cv2.imread(path)
-        lap, res = FD(img)
-        img = Image.fromarray(img)
+        planes = self.cache.get(index, path) if self.cache is not None else None
+        if planes is not None:
+            lap, res, img = planes
+        else:
+            img = self.load(index)
+            lap, res = FD(img)
+            img = Image.fromarray(img)
+            if self.cache is not None:
+                lap, res, img = self.cache.put(index, path, lap, res, img)
         if self.transform is not None:
             fake_aug = self.transform_aug(img)
             lap = self.transform(lap)
@@ -214,5 +315,190 @@ class ImageFolder_FD_Aug(data.Dataset):
     # def __setitem__(self, index, value):
     #     self.noise[index] = value
 
+    def load(self, index):
+        """ Decode image `index` as a BGR uint8 array. """
+        return cv2_loader(self.imgs[index][0], self.shm_cache)
+
     def __len__(self):
         return len(self.imgs)
+
+class ImageFolder_Aug(data.Dataset):
+    """ Same samples as ImageFolder_FD_Aug, without the frequency split.
+
+    The image is resized (squashed, like FD()) straight to isize and returned
+    whole; the model splits it into lap/res on its device with
+    lib.models.networks.FrequencyDecomposition.
+    """
+    def __init__(self, root, isize, transform=None, transform_aug=None, manifest=False):
+        classes, class_to_idx, imgs = scan_split(root, manifest)
+        if len(imgs) == 0:
+            raise(RuntimeError("Found 0 images in subfolders of: " + root + "\n"
+                               "Supported image extensions are: " + ",".join(IMG_EXTENSIONS)))
+
+        self.root = root
+        self.imgs = imgs
+        self.isize = isize
+        self.classes = classes
+        self.class_to_idx = class_to_idx
+        self.transform = transform
+        self.transform_aug = transform_aug
+        self.shm_cache = None
+
+    def __getitem__(self, index):
+        """
+        Args:
+            index (int): Index
+
+        Returns:
+            tuple: (image, fake_aug, target) where target is class_index of the target class.
+        """
+        path, target = self.imgs[index]
+        img = self.load(index)
+        interp = cv2.INTER_AREA if min(img.shape[:2]) > self.isize else cv2.INTER_LINEAR
+        small = Image.fromarray(cv2.resize(img, (self.isize, self.isize), interpolation=interp))
+        img = Image.fromarray(img)
+        if self.transform is not None:
+            fake_aug = self.transform_aug(img)
+            small = self.transform(small)
+
+        return small, fake_aug, target
+
+    def load(self, index):
+        """ Decode image `index` as a BGR uint8 array. """
+        return cv2_loader(self.imgs[index][0], self.shm_cache)
+
+    def __len__(self):
+        return len(self.imgs)
+
+class ImageFolder_Fused(data.Dataset):
+    """ Same samples as ImageFolder_FD_Aug, with one decode and one resize.
+
+    JPEGs are decoded at a reduced scale when that still covers isize, the
+    image is resized once to isize and decomposed with FD_fused(). lap, res and
+    the augmentation source are normalized together from the shared buffer, so
+    the only per-sample PIL work left is the CutPaste of transform_aug.
+
+    Args:
+        root (str): Split directory.
+        isize (int): Image size.
+        transform_aug: CutPaste/Cutout transform taking the isize PIL image. If
+            None, the source is returned unchanged (e.g. for --batch_aug).
+        manifest (bool): List the images through scan_split()'s manifest.
+        normalize (bool): Return [-1, 1] floats, or uint8 tensors to be normalized on the model device.
+    """
+    def __init__(self, root, isize, transform_aug=None, manifest=False, normalize=True):
+        classes, class_to_idx, imgs = scan_split(root, manifest)
+        if len(imgs) == 0:
+            raise(RuntimeError("Found 0 images in subfolders of: " + root + "\n"
+                               "Supported image extensions are: " + ",".join(IMG_EXTENSIONS)))
+
+        self.root = root
+        self.imgs = imgs
+        self.isize = isize
+        self.classes = classes
+        self.class_to_idx = class_to_idx
+        self.transform_aug = transform_aug
+        self.normalize = normalize
+        self.shm_cache = None
+
+    def __getitem__(self, index):
+        """
+        Args:
+            index (int): Index
+
+        Returns:
+            tuple: (lap, res, fake_aug, target) where target is class_index of the target class.
+        """
+        target = self.imgs[index][1]
+        buf = FD_fused(self.load(index), self.isize)
+        planes = torch.from_numpy(buf).permute(0, 3, 1, 2)
+        if self.normalize:
+            planes = planes.float().div_(127.5).sub_(1.)
+        lap, res, fake_aug = planes
+        if self.transform_aug is not None:
+            fake_aug = self.transform_aug(Image.fromarray(buf[2]))
+
+        return lap, res, fake_aug, target
+
+    def load(self, index):
+        """ Decode image `index` as a BGR uint8 array, at reduced scale if possible. """
+        if self.shm_cache is not None:
+            return cv2_loader(self.imgs[index][0], self.shm_cache)
+        return imread_reduced(self.imgs[index][0], self.isize)
+
+    def __len__(self):
+        return len(self.imgs)
+
+class PackedImages():
+    """ Read-only view of a split packed by data_creation/pack_dataset.py.
+
+    <root>.pack holds the payloads back to back and <root>.idx.json the offset
+    table with labels, class prefixes and defect types. The pack is memory-mapped
+    once per process, so all workers share the page cache of a single file.
+    """
+    def __init__(self, root):
+        self.path = root + '.pack'
+        with open(root + '.idx.json', 'r') as f:
+            index = json.load(f)
+        self.encoding = index['encoding']
+        self.isize = index['isize']
+        self.classes = index['classes']
+        self.records = index['records']
+        self._blob = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_blob'] = None
+        return state
+
+    def __len__(self):
+        return len(self.records)
+
+    def decode(self, index):
+        """ Decode record `index` as a BGR uint8 array. """
+        if self._blob is None:
+            self._blob = np.memmap(self.path, dtype=np.uint8, mode='r')
+        rec = self.records[index]
+        payload = self._blob[rec['offset']:rec['offset'] + rec['length']]
+        if self.encoding == 'raw':
+            return np.array(payload).reshape(rec['shape'])
+        return cv2.imdecode(np.asarray(payload), cv2.IMREAD_COLOR)
+
+def _init_packed(dataset, root, transform, transform_aug):
+    dataset.pack = PackedImages(root)
+    if len(dataset.pack) == 0:
+        raise(RuntimeError("Found 0 images in pack: " + root + ".pack"))
+    dataset.root = root
+    dataset.imgs = [(rec['name'], rec['label']) for rec in dataset.pack.records]
+    dataset.classes = dataset.pack.classes
+    dataset.class_to_idx = {c: i for i, c in enumerate(dataset.classes)}
+    dataset.transform = transform
+    dataset.transform_aug = transform_aug
+
+class PackedFolder_FD_Aug(ImageFolder_FD_Aug):
+    """ ImageFolder_FD_Aug reading from a packed split instead of a directory tree. """
+    def __init__(self, root, transform=None, transform_aug=None):
+        _init_packed(self, root, transform, transform_aug)
+        self.cache = None
+
+    def load(self, index):
+        return self.pack.decode(index)
+
+class PackedFolder_Aug(ImageFolder_Aug):
+    """ ImageFolder_Aug reading from a packed split instead of a directory tree. """
+    def __init__(self, root, isize, transform=None, transform_aug=None):
+        _init_packed(self, root, transform, transform_aug)
+        self.isize = isize
+
+    def load(self, index):
+        return self.pack.decode(index)
+
+class PackedFolder_Fused(ImageFolder_Fused):
+    """ ImageFolder_Fused reading from a packed split instead of a directory tree. """
+    def __init__(self, root, isize, transform_aug=None, normalize=True):
+        _init_packed(self, root, None, transform_aug)
+        self.isize = isize
+        self.normalize = normalize
+
+    def load(self, index):
+        return self.pack.decode(index)
@@ -0,0 +1,136 @@
+"""
+ON-DISK CACHE OF FREQUENCY DECOMPOSITIONS
+"""
+
+# pylint: disable=C0301,E1101,W0622,C0103,R0902,R0915
+
+import hashlib
+import os
+
+import numpy as np
+from PIL import Image
+from torchvision import transforms
+
+##
+def path_key(path):
+    """ Cache key of an image file.
+
+    Args:
+        path (str): Image path.
+
+    Returns:
+        [tuple]: (64-bit hash of the absolute path, mtime in ns)
+    """
+    digest = hashlib.blake2b(os.path.abspath(path).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True), os.stat(path).st_mtime_ns
+
+class FDCache():
+    """ Memory-mapped cache of the lap/res planes produced by FD().
+
+    Every dataset index owns one slot in a fixed-size shard file. A slot holds
+    three uint8 planes of shape (isize, isize, 3): lap, res and the source image
+    used by the augmentation branch, all already resized and center-cropped to
+    isize. Next to each shard, a key file stores the (path hash, mtime) of the
+    image a slot was built from, so renamed, re-indexed or modified files are
+    rebuilt on their next access.
+
+    Args:
+        cache_dir (str): Root directory of the cache.
+        root (str): Dataset root, used to separate train/test and datasets.
+        num_items (int): Number of images in the dataset.
+        isize (int): Size of the cached planes.
+        shard_size (int): Number of slots per shard file.
+    """
+    NUM_PLANES = 3
+
+    def __init__(self, cache_dir, root, num_items, isize, shard_size=256):
+        tag = hashlib.blake2b(os.path.abspath(root).encode('utf-8'), digest_size=8).hexdigest()
+        self.dir = os.path.join(os.path.expanduser(cache_dir), f'{tag}_{isize}')
+        self.isize = isize
+        self.num_items = num_items
+        self.shard_size = shard_size
+        self.slot_shape = (self.NUM_PLANES, isize, isize, 3)
+        self.resize = transforms.Compose([transforms.Resize(isize), transforms.CenterCrop(isize)])
+
+        # Pre-allocate (sparse) shard files in the main process, so that the
+        # DataLoader workers only ever open them in r+ mode.
+        os.makedirs(self.dir, exist_ok=True)
+        num_shards = (num_items + shard_size - 1) // shard_size
+        for shard in range(num_shards):
+            self._allocate(self._plane_file(shard), shard_size * int(np.prod(self.slot_shape)))
+            self._allocate(self._key_file(shard), shard_size * 2 * 8)
+
+        self._planes = {}
+        self._keys = {}
+
+    def __getstate__(self):
+        # Memory maps are re-opened lazily in every worker.
+        state = self.__dict__.copy()
+        state['_planes'] = {}
+        state['_keys'] = {}
+        return state
+
+    @staticmethod
+    def _allocate(path, nbytes):
+        if not os.path.exists(path) or os.path.getsize(path) != nbytes:
+            with open(path, 'wb') as f:
+                f.truncate(nbytes)
+
+    def _plane_file(self, shard):
+        return os.path.join(self.dir, f'shard_{shard:05d}.u8')
+
+    def _key_file(self, shard):
+        return os.path.join(self.dir, f'shard_{shard:05d}.key')
+
+    def _open(self, shard):
+        if shard not in self._planes:
+            self._planes[shard] = np.memmap(self._plane_file(shard), dtype=np.uint8, mode='r+',
+                                            shape=(self.shard_size,) + self.slot_shape)
+            self._keys[shard] = np.memmap(self._key_file(shard), dtype=np.int64, mode='r+',
+                                          shape=(self.shard_size, 2))
+        return self._planes[shard], self._keys[shard]
+
+    ##
+    def get(self, index, path):
+        """ Read the planes of an image.
+
+        Args:
+            index (int): Dataset index of the image.
+            path (str): Image path.
+
+        Returns:
+            [tuple]: (lap, res, img) PIL images, or None on a miss.
+        """
+        key = path_key(path)
+        planes, keys = self._open(index // self.shard_size)
+        slot = index % self.shard_size
+        if tuple(keys[slot]) != key:
+            return None
+        out = np.array(planes[slot])
+        # A concurrent writer may have replaced the slot while copying.
+        if tuple(keys[slot]) != key:
+            return None
+        return tuple(Image.fromarray(p) for p in out)
+
+    ##
+    def put(self, index, path, lap, res, img):
+        """ Resize the planes of an image to isize and store them.
+
+        Args:
+            index (int): Dataset index of the image.
+            path (str): Image path.
+            lap, res, img (PIL.Image): Outputs of FD() and the source image.
+
+        Returns:
+            [tuple]: The resized (lap, res, img) PIL images.
+        """
+        key = path_key(path)
+        out = tuple(self.resize(p) for p in (lap, res, img))
+        planes, keys = self._open(index // self.shard_size)
+        slot = index % self.shard_size
+        # Invalidate the slot before writing, publish the key last.
+        keys[slot] = 0
+        for i, p in enumerate(out):
+            planes[slot, i] = np.asarray(p)
+        keys[slot] = key
+        return out
@@ -0,0 +1,164 @@
+"""
+CACHED DATASET MANIFESTS
+"""
+
+# pylint: disable=C0301,E1101,W0622,C0103,R0902,R0915
+
+import json
+import os
+
+from PIL import Image
+
+MANIFEST_VERSION = 2
+
+##
+def manifest_path(root):
+    """ Manifest file of a split directory: <root>.manifest.json, next to it. """
+    return os.path.normpath(os.path.abspath(root)) + '.manifest.json'
+
+def _image_dims(path):
+    """ (width, height) of an image from its header, [-1, -1] if unreadable. """
+    try:
+        with Image.open(path) as img:
+            return list(img.size)
+    except (OSError, ValueError):
+        return [-1, -1]
+
+def _scan_dir(path, is_image_file=None):
+    """ List one directory.
+
+    Args:
+        path (str): Directory.
+        is_image_file (callable): Filter on file names. The headers of the
+            images are read for their dimensions; other files get None.
+
+    Returns:
+        [dict]: {'mtime': ns, 'dirs': [names], 'files': [names], 'sizes': [bytes], 'mtimes': [ns], 'dims': [[w, h]]}
+    """
+    dirs, files = [], []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir():
+                dirs.append(entry.name)
+            else:
+                try:
+                    st = entry.stat()
+                    files.append([entry.name, st.st_size, st.st_mtime_ns])
+                except OSError:
+                    # Broken link: listed like os.walk() does, without a size.
+                    files.append([entry.name, -1, -1])
+    dirs.sort()
+    files.sort()
+    # Column lists parse much faster than one list per file.
+    return {'mtime': os.stat(path).st_mtime_ns, 'dirs': dirs,
+            'files': [f[0] for f in files], 'sizes': [f[1] for f in files], 'mtimes': [f[2] for f in files],
+            'dims': [_image_dims(os.path.join(path, f[0])) if is_image_file and is_image_file(f[0]) else None for f in files]}
+
+##
+def update_tree(root, old_dirs, is_image_file=None):
+    """ Bring the directory listings of a tree up to date.
+
+    Only directories are stat'ed. A directory is listed again only when its
+    mtime changed, i.e. when entries were added, removed or renamed in it, so
+    the cost is O(directories + changes) rather than O(files).
+
+    Args:
+        root (str): Tree root.
+        old_dirs (dict): Listings of a previous call, keyed by path relative to root.
+        is_image_file (callable): Images whose dimensions are recorded, see _scan_dir().
+
+    Returns:
+        [tuple]: (new listings, number of directories listed again)
+    """
+    dirs, rescanned = {}, 0
+    stack = ['.']
+    while stack:
+        rel = stack.pop()
+        path = os.path.normpath(os.path.join(root, rel))
+        old = old_dirs.get(rel)
+        if old is not None and os.stat(path).st_mtime_ns == old['mtime']:
+            listing = old
+        else:
+            listing = _scan_dir(path, is_image_file)
+            rescanned += 1
+        dirs[rel] = listing
+        stack.extend(os.path.normpath(os.path.join(rel, d)) for d in listing['dirs'])
+    return dirs, rescanned
+
+##
+def load_split(root, is_image_file):
+    """ List the images of a split through its manifest, updating it if needed.
+
+    Gives the same (classes, class_to_idx, images) as find_classes() and
+    make_dataset(). The manifest also records the image dimensions, read from
+    the headers of new images only (see load_dims). Files modified in place do
+    not change their directory's mtime, so their recorded size, mtime and
+    dimensions may be stale.
+
+    Args:
+        root (str): Split directory, e.g. <dataroot>/train.
+        is_image_file (callable): Filter on file names.
+
+    Returns:
+        [tuple]: (classes, class_to_idx, images)
+    """
+    root = os.path.expanduser(root)
+    path = manifest_path(root)
+    manifest = {}
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('root') != os.path.abspath(root) or 'images' not in manifest:
+        manifest = {'dirs': {}}
+
+    dirs, rescanned = update_tree(root, manifest['dirs'], is_image_file)
+    if rescanned or set(dirs) != set(manifest['dirs']):
+        classes = list(dirs['.']['dirs'])
+        images, dims = [], []
+        for label, target in enumerate(classes):
+            # Same order as sorted(os.walk(d)): directories by path, then file names.
+            subdirs = sorted(rel for rel in dirs if rel == target or rel.startswith(target + os.sep))
+            for rel in subdirs:
+                for fname, fdims in zip(dirs[rel]['files'], dirs[rel]['dims']):
+                    if is_image_file(fname):
+                        images.append((os.path.join(rel, fname), label))
+                        dims.append(fdims)
+        manifest = {'version': MANIFEST_VERSION, 'root': os.path.abspath(root), 'classes': classes,
+                    'images': [img[0] for img in images], 'labels': [img[1] for img in images], 'dims': dims, 'dirs': dirs}
+        try:
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(manifest, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            print('   Could not write manifest %s: %s' % (path, e))
+
+    classes = manifest['classes']
+    class_to_idx = {classes[i]: i for i in range(len(classes))}
+    prefix = os.path.join(root, '')
+    images = list(zip([prefix + rel for rel in manifest['images']], manifest['labels']))
+    return classes, class_to_idx, images
+
+##
+def load_dims(root):
+    """ Dimensions of the images of a split, as recorded by load_split() in its manifest.
+
+    Args:
+        root (str): Split directory, listed with load_split() before.
+
+    Returns:
+        [dict]: image path (as listed by load_split) -> (width, height). Empty without a manifest.
+    """
+    root = os.path.expanduser(root)
+    try:
+        with open(manifest_path(root), 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    prefix = os.path.join(root, '')
+    return {prefix + rel: tuple(d) for rel, d in zip(manifest['images'], manifest['dims']) if d and d[0] > 0}
@@ -0,0 +1,137 @@
+"""
+SHARED-MEMORY IMAGE CACHE
+"""
+
+# pylint: disable=C0301,E1101,W0622,C0103,R0902,R0915
+
+import hashlib
+import multiprocessing
+import os
+import weakref
+
+import numpy as np
+
+# Columns of the slot table.
+KEY, NBYTES, H, W, C, LAST_USED = range(6)
+# Entries of the counter table.
+TICK, HITS, MISSES, EVICTIONS, BYPASSED = range(5)
+
+def _release(shms, unlink):
+    for shm in shms:
+        shm.close()
+        if unlink:
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+
+class SharedImageCache():
+    """ Byte-budgeted LRU cache of decoded uint8 images in POSIX shared memory.
+
+    The cache is created once in the main process and handed to the datasets.
+    DataLoader workers re-attach to the same segments when the dataset is sent
+    to them, so every worker sees the images decoded by the others and memory
+    does not grow with the number of workers.
+
+    Images are stored in fixed-size slots of `slot_bytes`. Images larger than a
+    slot are returned without being cached and counted as bypassed. When all
+    slots are used, the least recently used one is evicted.
+
+    Args:
+        budget_bytes (int): Total size of the image slots.
+        slot_bytes (int): Size of one slot, i.e. of the largest cacheable image.
+        size (int): Shorter side images are resized to before caching. 0 keeps the full resolution.
+    """
+    def __init__(self, budget_bytes, slot_bytes, size=0):
+        from multiprocessing import shared_memory
+
+        self.size = size
+        self.slot_bytes = int(slot_bytes)
+        self.num_slots = max(1, int(budget_bytes) // self.slot_bytes)
+        self.lock = multiprocessing.Lock()
+
+        data = shared_memory.SharedMemory(create=True, size=self.num_slots * self.slot_bytes)
+        meta = shared_memory.SharedMemory(create=True, size=(self.num_slots * 6 + 5) * 8)
+        self.names = (data.name, meta.name)
+        self._bind(data, meta)
+        self.slots[:] = 0
+        self.counters[:] = 0
+        self._finalizer = weakref.finalize(self, _release, (data, meta), True)
+
+    def _bind(self, data, meta):
+        self._shms = (data, meta)
+        self.data = np.ndarray((self.num_slots, self.slot_bytes), dtype=np.uint8, buffer=data.buf)
+        table = np.ndarray((self.num_slots * 6 + 5,), dtype=np.int64, buffer=meta.buf)
+        self.slots = table[:self.num_slots * 6].reshape(self.num_slots, 6)
+        self.counters = table[self.num_slots * 6:]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ('_shms', 'data', 'slots', 'counters', '_finalizer'):
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        from multiprocessing import shared_memory
+
+        self.__dict__.update(state)
+        shms = tuple(shared_memory.SharedMemory(name=name) for name in self.names)
+        self._bind(*shms)
+        self._finalizer = weakref.finalize(self, _release, shms, False)
+
+    @staticmethod
+    def key(path, size=0):
+        """ Non-zero 64-bit key of an image path and cache resolution. """
+        digest = hashlib.blake2b(('%s|%d' % (os.path.abspath(path), size)).encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little', signed=True) or 1
+
+    ##
+    def get(self, key):
+        """ Copy of the cached image, or None on a miss. """
+        with self.lock:
+            self.counters[TICK] += 1
+            found = np.flatnonzero(self.slots[:, KEY] == key)
+            if len(found) == 0:
+                self.counters[MISSES] += 1
+                return None
+            slot = found[0]
+            self.slots[slot, LAST_USED] = self.counters[TICK]
+            self.counters[HITS] += 1
+            nbytes, h, w, c = self.slots[slot, NBYTES:LAST_USED]
+            return self.data[slot, :nbytes].reshape(h, w, c).copy()
+
+    ##
+    def put(self, key, img):
+        """ Insert an image, evicting the least recently used slot if needed. """
+        if img.nbytes > self.slot_bytes:
+            with self.lock:
+                self.counters[BYPASSED] += 1
+            return
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        if img.ndim == 2:
+            img = img[:, :, None]
+        with self.lock:
+            self.counters[TICK] += 1
+            if np.any(self.slots[:, KEY] == key):
+                return
+            empty = np.flatnonzero(self.slots[:, KEY] == 0)
+            if len(empty) > 0:
+                slot = empty[0]
+            else:
+                slot = int(np.argmin(self.slots[:, LAST_USED]))
+                self.counters[EVICTIONS] += 1
+            self.data[slot, :img.nbytes] = img.reshape(-1)
+            self.slots[slot] = (key, img.nbytes) + img.shape + (self.counters[TICK],)
+
+    ##
+    def stats(self):
+        """ Hit/miss/eviction counters and occupancy. """
+        with self.lock:
+            used = int(np.count_nonzero(self.slots[:, KEY]))
+            return {'hits': int(self.counters[HITS]),
+                    'misses': int(self.counters[MISSES]),
+                    'evictions': int(self.counters[EVICTIONS]),
+                    'bypassed': int(self.counters[BYPASSED]),
+                    'used_slots': used,
+                    'num_slots': self.num_slots,
+                    'used_mb': used * self.slot_bytes / 2**20}
@@ -0,0 +1,117 @@
+"""
+MULTI-PROCESS TRAINING
+
+train.py launched by torchrun runs one process per device (or per group of
+CPU cores) with DistributedDataParallel:
+
+    torchrun --standalone --nproc_per_node 4 train.py --device cpu ...
+
+Without torchrun (WORLD_SIZE unset or 1), every function here is a no-op and
+training runs in a single process as before.
+"""
+
+# pylint: disable=C0301,E1101,W0622,C0103,R0902,R0915
+
+import os
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+
+##
+def init_distributed(opt):
+    """ Join the torchrun process group.
+
+    Sets opt.world_size, opt.rank, opt.local_rank and opt.distributed. With
+    --device cpu the cores are split between the processes of the machine
+    (torch.set_num_threads), otherwise every process uses cuda:<local rank>.
+
+    Args:
+        opt (argparse.Namespace): Options, with --dist_backend.
+
+    Returns:
+        [argparse.Namespace]: opt
+    """
+    opt.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    opt.rank = int(os.environ.get('RANK', 0))
+    opt.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    opt.distributed = opt.world_size > 1
+    if not opt.distributed:
+        return opt
+
+    if opt.device == 'cpu':
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', opt.world_size))
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    else:
+        opt.gpu_ids = [opt.local_rank]
+        torch.cuda.set_device(opt.local_rank)
+    if not dist.is_initialized():
+        dist.init_process_group(backend=opt.dist_backend, init_method='env://')
+    return opt
+
+##
+def is_main_process(opt):
+    """ Whether this process logs, evaluates and writes checkpoints (rank 0). """
+    return getattr(opt, 'rank', 0) == 0
+
+##
+def barrier(opt):
+    """ Wait for all processes. """
+    if getattr(opt, 'distributed', False):
+        dist.barrier()
+
+##
+def wrap_ddp(net, device):
+    """ Wrap a network in DistributedDataParallel.
+
+    Buffers are not broadcast from rank 0 at every forward: BatchNorm running
+    statistics stay per process and are averaged by average_norm_stats().
+
+    Args:
+        net (nn.Module): Network, on `device`.
+        device (torch.device): Device of this process.
+
+    Returns:
+        [DistributedDataParallel]: Wrapped network.
+    """
+    device_ids = [device.index] if device.type == 'cuda' else None
+    return DistributedDataParallel(net, device_ids=device_ids, broadcast_buffers=False)
+
+##
+def unwrap(net):
+    """ Network inside a DistributedDataParallel wrapper, or `net` itself. """
+    return getattr(net, 'module', net)
+
+##
+def all_reduce_mean(tensor, opt):
+    """ Mean of `tensor` over the processes (the tensor itself in a single process). """
+    if not getattr(opt, 'distributed', False):
+        return tensor
+    tensor = tensor.detach().clone()
+    dist.all_reduce(tensor)
+    return tensor / opt.world_size
+
+##
+def average_norm_stats(net, opt):
+    """ Average the BatchNorm running statistics of `net` over the processes.
+
+    Every process normalizes its own shard of the batch during training, so
+    the running statistics differ between processes. Averaging them before
+    evaluation and checkpointing gives the same network on every rank.
+    """
+    if not getattr(opt, 'distributed', False):
+        return
+    for module in net.modules():
+        if isinstance(module, nn.modules.batchnorm._BatchNorm) and module.track_running_stats:
+            for buffer in (module.running_mean, module.running_var):
+                dist.all_reduce(buffer)
+                buffer.div_(opt.world_size)
+
+##
+def broadcast_parameters(net, opt):
+    """ Copy the parameters and buffers of rank 0 to all processes. """
+    if not getattr(opt, 'distributed', False):
+        return
+    for tensor in list(net.parameters()) + list(net.buffers()):
+        dist.broadcast(tensor.data, src=0)
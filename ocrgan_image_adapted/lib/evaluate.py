@@ -6,6 +6,8 @@ Returns:
 from __future__ import print_function
 
 import os
+import numpy as np
+from scipy import ndimage
 from sklearn.metrics import roc_curve, auc, precision_recall_curve, precision_score, f1_score, recall_score
 from scipy.optimize import brentq
 from scipy.interpolate import interp1d
@@ -86,3 +88,69 @@ def save_curve(labels, scores, saveto):
     plt.legend(loc="lower right")
     plt.savefig(os.path.join(saveto, "PR-bottle.png"))
     plt.show()
+
+##
+class PixelMetrics():
+    """ Streaming pixel-level AUROC and PRO of anomaly maps against ground-truth masks.
+
+    Maps are never stored: every update() adds the pixel scores to fixed-size
+    histograms over `bins` log-spaced score levels between `low` and `high`
+    (scores outside are clipped to the first/last bin), so memory does not
+    depend on the number of maps. Thresholds are the bin edges.
+        pos/neg: histograms of anomalous/normal pixels, giving the ROC curve.
+        pro:     per bin b, the sum over all connected defect regions of the
+                 fraction of the region scored in bin b or above, giving the
+                 mean per-region overlap at every threshold.
+
+        metrics = PixelMetrics()
+        metrics.update(error_maps, masks)
+        pixel_auroc, pro = metrics.compute()
+
+    Args:
+        bins (int): Number of score bins.
+        low (float): Upper edge of the first bin.
+        high (float): Lower edge of the last bin.
+    """
+    def __init__(self, bins=4096, low=1e-6, high=4.):
+        self.bins = bins
+        self.edges = np.logspace(np.log10(low), np.log10(high), bins - 1)
+        self.pos = np.zeros(bins, dtype=np.int64)
+        self.neg = np.zeros(bins, dtype=np.int64)
+        self.pro = np.zeros(bins, dtype=np.float64)
+        self.regions = 0
+
+    def update(self, maps, masks):
+        """ Add a batch of (B, H, W) anomaly maps and boolean masks of the same shape. """
+        for score_map, mask in zip(np.asarray(maps), np.asarray(masks, dtype=bool)):
+            idx = np.searchsorted(self.edges, score_map.ravel(), side='right')
+            flat = mask.ravel()
+            self.pos += np.bincount(idx[flat], minlength=self.bins)
+            self.neg += np.bincount(idx[~flat], minlength=self.bins)
+            labels, num = ndimage.label(mask)
+            if num == 0:
+                continue
+            region = labels.ravel()[flat] - 1
+            hist = np.bincount(region * self.bins + idx[flat], minlength=num * self.bins).reshape(num, self.bins)
+            above = hist[:, ::-1].cumsum(axis=1)[:, ::-1]
+            self.pro += (above / hist.sum(axis=1, keepdims=True)).sum(axis=0)
+            self.regions += num
+
+    def compute(self, fpr_limit=0.3):
+        """ (pixel AUROC, PRO integrated up to `fpr_limit` and divided by it).
+
+        Either is NaN when the maps had no anomalous (or no normal) pixel.
+        """
+        tp = np.concatenate([[0], self.pos[::-1].cumsum()])
+        fp = np.concatenate([[0], self.neg[::-1].cumsum()])
+        if tp[-1] == 0 or fp[-1] == 0:
+            return float('nan'), float('nan')
+        tpr, fpr = tp / tp[-1], fp / fp[-1]
+        pixel_auroc = auc(fpr, tpr)
+
+        pro = np.concatenate([[0], self.pro[::-1] / max(self.regions, 1)])
+        keep = fpr <= fpr_limit
+        x, y = fpr[keep], pro[keep]
+        if x[-1] < fpr_limit:
+            x = np.append(x, fpr_limit)
+            y = np.append(y, np.interp(fpr_limit, fpr, pro))
+        return pixel_auroc, auc(x, y) / fpr_limit
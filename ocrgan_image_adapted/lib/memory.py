@@ -0,0 +1,94 @@
+"""
+PEAK MEMORY MEASUREMENT
+"""
+
+# pylint: disable=C0301,E1101,W0622,C0103,R0902,R0915
+
+import os
+import threading
+
+import torch
+
+def current_rss():
+    """ Resident set size of this process, in bytes (0 where /proc is missing). """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+def is_out_of_memory(error):
+    """ Whether a RuntimeError is a CUDA or CPU allocation failure. """
+    message = str(error)
+    return 'out of memory' in message or "can't allocate memory" in message
+
+def available_memory(device):
+    """ Memory a process may use on `device`, in bytes.
+
+    CUDA: total memory of the device. CPU: MemAvailable from /proc/meminfo plus
+    the current RSS of this process (0 where /proc is missing).
+    """
+    device = torch.device(device)
+    if device.type == 'cuda':
+        return torch.cuda.get_device_properties(device).total_memory
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024 + current_rss()
+    except (OSError, ValueError):
+        pass
+    return 0
+
+class PeakMemory():
+    """ Peak memory used by the code run inside the context.
+
+    On CUDA devices the allocator statistics are used: peak is the highest
+    memory allocated by tensors during the context. On the CPU, a thread samples
+    the resident set size every `interval` seconds: peak is the highest RSS
+    reached above the RSS at entry. Memory freed by earlier work stays mapped in
+    the allocator and is reused without raising the RSS, so compare CPU peaks
+    measured in fresh processes only. `base` is the memory in use at entry.
+
+        with PeakMemory(device) as mem:
+            model.optimize_params()
+        print(mem.peak / 2**20)
+
+    Args:
+        device (torch.device): Device whose memory is measured.
+        interval (float): RSS sampling period, in seconds.
+    """
+    def __init__(self, device, interval=1e-3):
+        self.device = torch.device(device)
+        self.interval = interval
+        self.peak = 0
+        self.base = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss() - self.base)
+
+    def __enter__(self):
+        self.peak = 0
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self.base = torch.cuda.memory_allocated(self.device)
+        else:
+            self.base = current_rss()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            self.peak = torch.cuda.max_memory_allocated(self.device) - self.base
+        else:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, current_rss() - self.base)
+        return False
@@ -1,6 +1,7 @@
 """ BaseModel
 """
 from collections import OrderedDict
+import contextlib
 import os
 import time
 import numpy as np
@@ -12,10 +13,14 @@ import torch.nn as nn
 import torch.utils.data
 import torchvision.utils as vutils
 
-from lib.models.networks import NetD, weights_init, define_G, define_D, get_scheduler
+from lib.models.networks import NetD, weights_init, define_G, define_D, get_scheduler, FrequencyDecomposition, migrate_cs_state_dict, strip_module_prefix
+from lib.models.pruning import set_generator_widths
 from lib.visualizer import Visualizer
+from lib.data.dataloader import BatchCutPaste
 from lib.loss import l2_loss
+from lib.memory import is_out_of_memory
 from lib.evaluate import roc
+from lib.distributed import is_main_process, barrier, unwrap, average_norm_stats, broadcast_parameters
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
@@ -36,7 +41,12 @@ class BaseModel_Aug():
         self.data = data
         self.trn_dir = os.path.join(self.opt.outf, self.opt.name, 'train')
         self.tst_dir = os.path.join(self.opt.outf, self.opt.name, 'test')
-        self.device = torch.device("cuda:0" if self.opt.device != 'cpu' else "cpu")
+        # Multi-process training: one device per process, cuda:<local rank>.
+        self.device = torch.device("cuda:%d" % getattr(opt, 'local_rank', 0) if self.opt.device != 'cpu' else "cpu")
+        self.fd = FrequencyDecomposition(opt.nc).to(self.device)
+        self.batch_aug = BatchCutPaste() if opt.batch_aug == 'device' else None
+        self.micro_batch = opt.micro_batch
+        self.loss_scale = 1.
 
     ##
     def seed(self, seed_value):
@@ -58,26 +68,54 @@ class BaseModel_Aug():
         torch.backends.cudnn.deterministic = True
 
     ##
-    def set_input(self, input:torch.Tensor, noise:bool=False):
+    def autocast(self):
+        """ Autocast context of the netG/netD forward passes: bfloat16 with --precision bf16, a no-op otherwise.
+        """
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.opt.precision == 'bf16')
+
+    ##
+    def to_device(self, x):
+        """ Move an image batch to the device, normalizing uint8 batches (--host_dtype uint8) there.
+
+        Args:
+            x (Tensor): Batch in [-1, 1], or uint8 in [0, 255].
+
+        Returns:
+            [FloatTensor]: Batch in [-1, 1] on self.device.
+        """
+        x = x.to(self.device, non_blocking=True)
+        if x.dtype == torch.uint8:
+            x = x.float().div_(127.5).sub_(1.)
+        return x
+
+    ##
+    def set_input(self, input:torch.Tensor, noise:bool=False, augment:bool=False):
         """ Set input and ground truth
 
         Args:
             input (FloatTensor): Input data for batch i.
+            augment (bool): Apply the --batch_aug device augmentation to fake_aug.
         """
         with torch.no_grad():
-            self.input_lap.resize_(input[0].size()).copy_(input[0])
-            self.input_res.resize_(input[1].size()).copy_(input[1])
-            self.fake_aug.resize_(input[2].size()).copy_(input[2])
-            self.gt.resize_(input[3].size()).copy_(input[3])
+            # --fd_mode torch: the batch is (img, fake_aug, target).
+            if self.opt.fd_mode == 'torch':
+                input = self.fd(self.to_device(input[0])) + tuple(input[1:])
+
+            self.input_lap.resize_(input[0].size()).copy_(self.to_device(input[0]))
+            self.input_res.resize_(input[1].size()).copy_(self.to_device(input[1]))
+            self.fake_aug.resize_(input[2].size()).copy_(self.to_device(input[2]))
+            self.gt.resize_(input[3].size()).copy_(input[3], non_blocking=True)
             self.label.resize_(input[3].size())
+            if augment and self.batch_aug is not None:
+                self.fake_aug.copy_(self.batch_aug(self.fake_aug))
 
             # Add noise to the input.
             if noise: self.noise.data.copy_(torch.randn(self.noise.size()))
 
             # Copy the first batch as the fixed input.
             if self.total_steps == self.opt.batchsize:
-                self.fixed_input_lap.resize_(input[0].size()).copy_(input[0])
-                self.fixed_input_res.resize_(input[1].size()).copy_(input[1])
+                self.fixed_input_lap.resize_(input[0].size()).copy_(self.input_lap)
+                self.fixed_input_res.resize_(input[1].size()).copy_(self.input_res)
 
     ##
     def get_errors(self):
@@ -100,8 +138,29 @@ class BaseModel_Aug():
         """ Initialize the weights of netD
         """
         self.netd.apply(weights_init)
+        # Every process drew its own weights: keep those of rank 0.
+        broadcast_parameters(self.netd, self.opt)
         print('Reloading d net')
 
+    ##
+    def sync_gradients(self, sync):
+        """ Context of a micro-batch forward/backward pass.
+
+        In multi-process training, the gradients of netG and netD are averaged
+        over the processes (DistributedDataParallel) only in the backward pass
+        of the last micro-batch before an optimizer step; the other passes
+        accumulate them locally (no_sync).
+
+        Args:
+            sync (bool): Average the gradients in this backward pass.
+        """
+        stack = contextlib.ExitStack()
+        if not sync:
+            for net in (self.netg, self.netd):
+                if hasattr(net, 'no_sync'):
+                    stack.enter_context(net.no_sync())
+        return stack
+
     ##
     def get_current_images(self):
         """ Returns current images.
@@ -129,12 +188,14 @@ class BaseModel_Aug():
         if not os.path.exists(weight_dir):
             os.makedirs(weight_dir)
 
+        # Weights of the networks themselves, without the DistributedDataParallel wrapper.
+        netg, netd = unwrap(self.netg), unwrap(self.netd)
         if is_best:
-            torch.save({'epoch': epoch, 'state_dict': self.netg.state_dict()}, f'{weight_dir}/netG_best.pth')
-            torch.save({'epoch': epoch, 'state_dict': self.netd.state_dict()}, f'{weight_dir}/netD_best.pth')
+            torch.save({'epoch': epoch, 'state_dict': netg.state_dict()}, f'{weight_dir}/netG_best.pth')
+            torch.save({'epoch': epoch, 'state_dict': netd.state_dict()}, f'{weight_dir}/netD_best.pth')
         else:
-            torch.save({'epoch': epoch, 'state_dict': self.netd.state_dict()}, f"{weight_dir}/netD_{epoch}.pth")
-            torch.save({'epoch': epoch, 'state_dict': self.netg.state_dict()}, f"{weight_dir}/netG_{epoch}.pth")
+            torch.save({'epoch': epoch, 'state_dict': netd.state_dict()}, f"{weight_dir}/netD_{epoch}.pth")
+            torch.save({'epoch': epoch, 'state_dict': netg.state_dict()}, f"{weight_dir}/netG_{epoch}.pth")
 
     def load_weights(self, epoch=None, is_best:bool=False, path=None):
         """ Load pre-trained weights of NetG and NetD
@@ -165,29 +226,99 @@ class BaseModel_Aug():
 
         # Load the weights of netg and netd.
         print('>> Loading weights...')
-        weights_g = torch.load(path_g)['state_dict']
-        weights_d = torch.load(path_d)['state_dict']
+        checkpoint_g = torch.load(path_g)
+        weights_g = strip_module_prefix(checkpoint_g['state_dict'])
+        weights_d = strip_module_prefix(torch.load(path_d)['state_dict'])
+        netg, netd = unwrap(self.netg), unwrap(self.netd)
+        # Generators written by prune.py record their channel counts.
+        if 'widths' in checkpoint_g:
+            set_generator_widths(netg, checkpoint_g['widths'])
         try:
-            self.netg.load_state_dict(weights_g)
-            self.netd.load_state_dict(weights_d)
+            netg.load_state_dict(migrate_cs_state_dict(weights_g, netg))
+            netd.load_state_dict(weights_d)
         except IOError:
             raise IOError("netG weights not found")
         print('   Done.')
 
+    ##
+    def lower_micro_batch(self, error):
+        """ Halve self.micro_batch (and opt.micro_batch) after an out-of-memory error.
+
+        Args:
+            error (RuntimeError): Error raised by optimize_params.
+
+        Returns:
+            [bool]: False if the error is not an out-of-memory error, the
+                micro-batch is already a single sample, or training is
+                multi-process.
+        """
+        if not is_out_of_memory(error):
+            return False
+        if getattr(self.opt, 'distributed', False):
+            # The other processes would still run the old number of backward
+            # passes and wait forever in their gradient all-reduce: fail fast,
+            # torchrun then stops them all.
+            print(f"[OOM] Rank {self.opt.rank}: out of memory, set a smaller --micro_batch")
+            return False
+        size = self.input_lap.size(0)
+        current = self.micro_batch if 0 < self.micro_batch < size else size
+        if current <= 1:
+            return False
+        self.micro_batch = self.opt.micro_batch = current // 2
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        print(f"[OOM] Lowering the micro-batch from {current} to {self.micro_batch} samples")
+        return True
+
     ##
     def train_one_epoch(self):
         """ Train the model for one epoch.
+
+        With --accum_steps K, the train loader yields batches of batchsize / K
+        samples and the optimizers step once every K batches, so the effective
+        batch size stays --batchsize. A trailing incomplete cycle is dropped.
+        On an out-of-memory error, the micro-batch is halved in place and the
+        batch retried; if gradients of earlier batches of the cycle were lost,
+        the rest of the cycle is skipped instead. In multi-process training
+        the error is raised, and only rank 0 shows progress and saves images.
         """
 
         self.netg.train()
         epoch_iter = 0
-        for data in tqdm(self.data.train, leave=False, total=len(self.data.train)):
-            self.total_steps += self.opt.batchsize
-            epoch_iter += self.opt.batchsize
-
-            self.set_input(data)
-            self.optimize_params()
-
+        accum = self.opt.accum_steps
+        skip_cycle = False
+        main = is_main_process(self.opt)
+        sampler = getattr(self.data.train, 'sampler', None)
+        if hasattr(sampler, 'set_epoch'):
+            # DistributedSampler: a new shuffle of the shards every epoch.
+            sampler.set_epoch(self.epoch)
+        for i, data in enumerate(tqdm(self.data.train, leave=False, total=len(self.data.train), disable=not main)):
+            self.total_steps += self.opt.batchsize // accum
+            epoch_iter += self.opt.batchsize // accum
+
+            first, last = i % accum == 0, i % accum == accum - 1
+            if first:
+                skip_cycle = False
+            if skip_cycle:
+                continue
+            self.set_input(data, augment=True)
+            while True:
+                try:
+                    self.optimize_params(zero_grad=first, step=last)
+                    break
+                except RuntimeError as e:
+                    if not self.lower_micro_batch(e):
+                        raise
+                    if not first:
+                        skip_cycle = True
+                        break
+            if skip_cycle:
+                continue
+
+            if not main:
+                continue
             if self.total_steps % self.opt.print_freq == 0:
                 errors = self.get_errors()
                 if self.opt.display:
@@ -200,28 +331,47 @@ class BaseModel_Aug():
                 if self.opt.display:
                     self.visualizer.display_current_images(reals, fakes, fake_lap, fake_res)
 
-        print(">> Training model %s. Epoch %d/%d" % (self.name, self.epoch+1, self.opt.niter))
+        if main:
+            print(">> Training model %s. Epoch %d/%d" % (self.name, self.epoch+1, self.opt.niter))
 
     ##
     def train(self):
         """ Train the model
+
+        In multi-process training, the BatchNorm running statistics are
+        averaged over the processes after every epoch, then rank 0 tests the
+        model and writes the checkpoints while the other processes wait. Only
+        rank 0 returns the best AUC (0 elsewhere).
         """
 
         ##
         # TRAIN
         self.total_steps = 0
         best_auc = 0
+        main = is_main_process(self.opt)
 
         # Train for niter epochs.
-        print(f">> Training {self.name} on {self.classes} to detect {self.opt.note}")
+        if main:
+            print(f">> Training {self.name} on {self.classes} to detect {self.opt.note}")
         for self.epoch in range(self.opt.iter, self.opt.niter):
             self.train_one_epoch()
-            res = self.test()
-            if res['AUC'] > best_auc:
-                best_auc = res['AUC']
-                self.save_weights(self.epoch)
-            self.visualizer.print_current_performance(res, best_auc)
-        print(">> Training model %s.[Done]" % self.name)
+            average_norm_stats(self.netg, self.opt)
+            average_norm_stats(self.netd, self.opt)
+            if main:
+                shm_cache = getattr(self.data.train.dataset, 'shm_cache', None)
+                if shm_cache is not None:
+                    stats = shm_cache.stats()
+                    print("   SHM cache: %s" % stats)
+                    if stats['bypassed'] > 0:
+                        print("   [Warning] SHM cache: %d images bypassed, larger than a slot." % stats['bypassed'])
+                res = self.test()
+                if res['AUC'] > best_auc:
+                    best_auc = res['AUC']
+                    self.save_weights(self.epoch)
+                self.visualizer.print_current_performance(res, best_auc)
+            barrier(self.opt)
+        if main:
+            print(">> Training model %s.[Done]" % self.name)
         return best_auc
 
     ##
@@ -239,9 +389,9 @@ class BaseModel_Aug():
             # Load the weights of netg and netd if requested.
             if getattr(self.opt, "load_weights", False):
                 path = f"./output/{self.name.lower()}/{self.opt.dataset}/train/weights/netG.pth"
-                pretrained_dict = torch.load(path, map_location=self.device)['state_dict']
+                pretrained_dict = strip_module_prefix(torch.load(path, map_location=self.device)['state_dict'])
                 try:
-                    self.netg.load_state_dict(pretrained_dict)
+                    unwrap(self.netg).load_state_dict(migrate_cs_state_dict(pretrained_dict, unwrap(self.netg)))
                 except IOError:
                     raise IOError("netG weights not found")
                 print('   Loaded weights.')
@@ -0,0 +1,111 @@
+""" Cascade
+
+Two-stage scoring: a cheap first stage scores every image, and only images in
+an uncertainty band are scored again by the full Scorer.
+"""
+
+# pylint: disable=C0301,E1101,W0622,C0103,R0902,R0915
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+class FeatureDistance(nn.Module):
+    """ Distance of the netD features of a downscaled image to their mean over good images.
+
+    The image lap + res is resized by `scale` and run through netD.feat up to
+    its last convolution, whose 4x4 kernel needs the full input size. The score
+    is the mean squared difference to the average feature map of the images
+    given to fit(). No generator pass is needed.
+
+    Args:
+        feat (nn.Module): netD.feat.
+        scale (float): Resize factor of the input.
+
+    Returns (from forward):
+        [tuple]: (scores (B,), None)
+    """
+    def __init__(self, feat, scale=0.5):
+        super(FeatureDistance, self).__init__()
+        self.feat = feat[:-1]
+        self.scale = scale
+        self.register_buffer('center', torch.zeros(0))
+
+    def features(self, lap, res):
+        x = lap + res
+        if self.scale != 1:
+            x = F.interpolate(x, scale_factor=self.scale, mode='bilinear', align_corners=False)
+        return self.feat(x).float()
+
+    def fit(self, batches):
+        """ Average feature map of (lap, res) batches of good images. """
+        with torch.no_grad():
+            feats = torch.cat([self.features(lap, res) for lap, res in batches])
+        self.center = feats.mean(0, keepdim=True)
+        return self
+
+    def forward(self, lap, res):
+        return torch.pow(self.features(lap, res) - self.center, 2).flatten(1).mean(1), None
+
+class CascadeScorer():
+    """ Early-exit scoring with a first stage and the full Scorer.
+
+    calibrate() maps first-stage scores to the units of the full scorer with a
+    least-squares fit log(full) = a * log(first) + b on good images, and sets
+    the band from the calibrated good-image scores:
+        low  = quantile `low` of the good scores
+        high = `high` times the largest good score (no upper exit if high is 0)
+    Images whose calibrated score is below low exit as normal and images above
+    high exit as anomalous, both with their calibrated score. The others get
+    the full score. `escalated` / `seen` count the images.
+
+    Args:
+        first (callable): (lap, res) -> (scores, maps), e.g. FeatureDistance or a student.
+        full (callable): (lap, res) -> (scores, maps), the full Scorer.
+        low (float): Quantile of the good scores where the band starts.
+        high (float): Multiple of the largest good score where the band ends.
+
+    Returns (from __call__):
+        [tuple]: (scores (B,), None)
+    """
+    def __init__(self, first, full, low=0.9, high=0.):
+        self.first = first
+        self.full = full
+        self.low_quantile = low
+        self.high_factor = high
+        self.a, self.b = 1., 0.
+        self.good = None
+        self.low, self.high = -float('inf'), float('inf')
+        self.escalated, self.seen = 0, 0
+
+    def stage1(self, lap, res):
+        """ Calibrated first-stage scores. """
+        score = self.first(lap, res)[0].float()
+        return torch.exp(self.a * torch.log(score + 1e-12) + self.b)
+
+    def calibrate(self, batches):
+        """ Fit the score mapping and the band on (lap, res) batches of good images. """
+        with torch.no_grad():
+            first = torch.cat([self.first(lap, res)[0].float().cpu() for lap, res in batches])
+            full = torch.cat([self.full(lap, res)[0].float().cpu() for lap, res in batches])
+        self.a, self.b = np.polyfit(np.log(first.numpy() + 1e-12), np.log(full.numpy() + 1e-12), 1)
+        self.good = torch.exp(self.a * torch.log(first + 1e-12) + self.b)
+        return self.set_band(self.low_quantile, self.high_factor)
+
+    def set_band(self, low, high):
+        """ Band from quantile `low` to `high` times the largest good score, after calibrate(). """
+        self.low_quantile, self.high_factor = low, high
+        self.low = torch.quantile(self.good, low).item()
+        self.high = high * self.good.max().item() if high > 0 else float('inf')
+        self.escalated, self.seen = 0, 0
+        return self
+
+    def __call__(self, lap, res):
+        score = self.stage1(lap, res)
+        idx = ((score >= self.low) & (score <= self.high)).nonzero().flatten()
+        if len(idx) > 0:
+            score[idx] = self.full(lap[idx], res[idx])[0].float()
+        self.escalated += len(idx)
+        self.seen += len(score)
+        return score, None
@@ -1,7 +1,10 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.nn.parallel
+from torch.utils.checkpoint import checkpoint, set_checkpoint_early_stop
 import functools
+from collections import OrderedDict
 from torch.optim import lr_scheduler
 from torch.nn import init
 import numpy as np
@@ -26,9 +29,8 @@ class Encoder(nn.Module):
     DCGAN ENCODER NETWORK
     """
 
-    def __init__(self, isize, nz, nc, ndf, ngpu, n_extra_layers=0, add_final_conv=True):
+    def __init__(self, isize, nz, nc, ndf, n_extra_layers=0, add_final_conv=True):
         super(Encoder, self).__init__()
-        self.ngpu = ngpu
         assert isize % 16 == 0, "isize has to be a multiple of 16"
 
         main = nn.Sequential()
@@ -68,11 +70,7 @@ class Encoder(nn.Module):
         self.main = main
 
     def forward(self, input):
-        if isinstance(input.data, torch.cuda.FloatTensor) and self.ngpu > 1:
-            output = nn.parallel.data_parallel(self.main, input, range(self.ngpu))
-        else:
-            output = self.main(input)
-
+        output = self.main(input)
         return output
 
 ##
@@ -80,9 +78,8 @@ class Decoder(nn.Module):
     """
     DCGAN DECODER NETWORK
     """
-    def __init__(self, isize, nz, nc, ngf, ngpu, n_extra_layers=0):
+    def __init__(self, isize, nz, nc, ngf, n_extra_layers=0):
         super(Decoder, self).__init__()
-        self.ngpu = ngpu
         assert isize % 16 == 0, "isize has to be a multiple of 16"
 
         cngf, tisize = ngf // 2, 4
@@ -126,10 +123,7 @@ class Decoder(nn.Module):
         self.main = main
 
     def forward(self, input):
-        if isinstance(input.data, torch.cuda.FloatTensor) and self.ngpu > 1:
-            output = nn.parallel.data_parallel(self.main, input, range(self.ngpu))
-        else:
-            output = self.main(input)
+        output = self.main(input)
         return output
 
 
@@ -146,7 +140,6 @@ class BasicDiscriminator(nn.Module):
         ngf = opt.ngf
         ndf = opt.ndf
         n_extra_layers = 0
-        self.ngpu = opt.ngpu
         assert isize % 16 == 0, "isize has to be a multiple of 16"
 
         feat = nn.Sequential()
@@ -190,13 +183,29 @@ class BasicDiscriminator(nn.Module):
         self.feat = feat
         self.clas = clas
 
-    def forward(self, input):
-        if isinstance(input.data, torch.cuda.FloatTensor) and self.ngpu > 1:
-            feat = nn.parallel.data_parallel(self.feat, input, range(self.ngpu))
-            clas = nn.parallel.data_parallel(self.clas, feat, range(self.ngpu))
+    def forward(self, input, segments=1):
+        """ Classify and embed a batch.
+
+        Args:
+            input (Tensor): Batch of images.
+            segments (int): Number of equal sub-batches concatenated in `input`.
+                In training mode, BatchNorm normalizes (and updates its running
+                statistics with) each one separately, so one call gives the
+                same outputs as one call per sub-batch.
+        """
+        if segments > 1 and self.training:
+            feat = input
+            for layer in self.feat:
+                if isinstance(layer, nn.BatchNorm2d):
+                    feat = torch.cat([layer(x) for x in feat.chunk(segments)], 0)
+                else:
+                    feat = layer(feat)
         else:
             feat =  self.feat(input)
-            clas = self.clas(feat)
+        # The sigmoid feeding BCELoss always runs in float32: under bf16
+        # autocast it would saturate to exactly 0 or 1.
+        with torch.autocast(device_type=feat.device.type, enabled=False):
+            clas = self.clas(feat.float())
         clas = clas.view(-1, 1).squeeze(1)
         return clas, feat
 
@@ -208,7 +217,7 @@ class NetD(nn.Module):
 
     def __init__(self, opt):
         super(NetD, self).__init__()
-        model = Encoder(opt.isize, 1, opt.nc, opt.ngf, opt.ngpu, opt.extralayers)
+        model = Encoder(opt.isize, 1, opt.nc, opt.ngf, opt.extralayers)
         layers = list(model.main.children())
 
         self.features = nn.Sequential(*layers[:-1])
@@ -232,9 +241,9 @@ class NetG(nn.Module):
 
     def __init__(self, opt):
         super(NetG, self).__init__()
-        self.encoder1 = Encoder(opt.isize, opt.nz, opt.nc, opt.ngf, opt.ngpu, opt.extralayers)
-        self.decoder = Decoder(opt.isize, opt.nz, opt.nc, opt.ngf, opt.ngpu, opt.extralayers)
-        self.encoder2 = Encoder(opt.isize, opt.nz, opt.nc, opt.ngf, opt.ngpu, opt.extralayers)
+        self.encoder1 = Encoder(opt.isize, opt.nz, opt.nc, opt.ngf, opt.extralayers)
+        self.decoder = Decoder(opt.isize, opt.nz, opt.nc, opt.ngf, opt.extralayers)
+        self.encoder2 = Encoder(opt.isize, opt.nz, opt.nc, opt.ngf, opt.extralayers)
 
     def forward(self, x):
         latent_i = self.encoder1(x)
@@ -242,6 +251,44 @@ class NetG(nn.Module):
         latent_o = self.encoder2(gen_imag)
         return gen_imag, latent_i, latent_o
 
+##
+class FrequencyDecomposition(nn.Module):
+    """
+    BATCHED LAPLACIAN SPLIT
+
+    Torch port of lib.data.datasets.FD() working on whole (B, C, H, W) batches
+    of images normalized to [-1, 1]. Returns (lap, res), normalized the same way:
+        res = pyrUp(pyrDown(img))
+        lap = saturate(img - res)
+    Intermediate results are rounded to uint8 levels and borders are reflected
+    (BORDER_REFLECT_101) as in OpenCV. On the same input image the output is
+    identical to FD() up to float rounding (max abs error below 1e-5, i.e. well
+    under one uint8 level of 2/255). The split is computed at the input size, so
+    images resized straight to isize no longer go through the 256x256 detour.
+    """
+
+    def __init__(self, nc=3):
+        super(FrequencyDecomposition, self).__init__()
+        self.nc = nc
+        k = torch.tensor([1., 4., 6., 4., 1.]) / 16.
+        kernel = (k[:, None] * k[None, :]).expand(nc, 1, 5, 5).contiguous()
+        self.register_buffer('kernel', kernel, persistent=False)
+        self.register_buffer('unpool', torch.ones(nc, 1, 1, 1), persistent=False)
+
+    def blur(self, x):
+        return F.conv2d(F.pad(x, (2, 2, 2, 2), mode='reflect'), self.kernel, groups=self.nc)
+
+    def forward(self, input):
+        img = torch.floor((input + 1.) * 127.5 + 0.5)
+        # pyrDown: blur, then drop odd rows and columns.
+        down = torch.floor(self.blur(img)[:, :, ::2, ::2] + 0.5)
+        # pyrUp: zero-insertion (a strided 1x1 transposed conv), then blur * 4.
+        up = F.conv_transpose2d(down, self.unpool, stride=2, groups=self.nc)
+        up = F.pad(up, (0, 1, 0, 1))
+        up = torch.floor(4. * self.blur(up) + 0.5).clamp(0., 255.)
+        lap = (img - up).clamp(0., 255.)
+        return lap / 127.5 - 1., up / 127.5 - 1.
+
 
 ###############################################################################
 # Helper Functions
@@ -297,19 +344,76 @@ def init_weights(net, init_type='normal', gain=0.02):
 
 ##
 def init_net(net, init_type='normal', gpu_ids=[]):
+    # Multi-device training runs one process per device with
+    # DistributedDataParallel (see lib/distributed.py), not DataParallel.
     if len(gpu_ids) > 0:
         assert(torch.cuda.is_available())
         net.to(gpu_ids[0])
-        net = torch.nn.DataParallel(net, gpu_ids)
     init_weights(net, init_type)
     return net
 
+##
+def run_checkpointed(fn, modules, *inputs):
+    """ fn(*inputs) with activation checkpointing.
+
+    Activations inside fn are dropped after the forward pass and recomputed
+    during the backward pass. The running statistics of the norm layers in
+    `modules` are restored after the recomputation, so they are updated once
+    per forward, as without checkpointing. The recomputation runs fn to the
+    end (no early stop, the default of torch otherwise), or the restore would
+    be skipped. fn must not modify its inputs in place.
+    """
+    norms = [m for module in modules for m in module.modules()
+             if isinstance(m, nn.modules.batchnorm._NormBase) and m.running_mean is not None]
+    calls = []
+    def run(*args):
+        stats = [(m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone()) for m in norms] if calls else None
+        out = fn(*args)
+        if stats is not None:
+            for m, (mean, var, num) in zip(norms, stats):
+                m.running_mean.copy_(mean)
+                m.running_var.copy_(var)
+                m.num_batches_tracked.copy_(num)
+        calls.append(True)
+        return out
+    with set_checkpoint_early_stop(False):
+        return checkpoint(run, *inputs, use_reentrant=False)
+
+##
+def set_checkpoint_levels(net, levels):
+    """ Checkpoint the activations of the `levels` outermost U-Net levels of a generator.
+
+    Outer levels hold the largest activations. Each checkpointed level drops
+    the activations of its own down and up paths after the forward pass and
+    recomputes them during the backward pass. A negative `levels` checkpoints
+    every level.
+
+    Args:
+        net (nn.Module): UnetGenerator_CS or UnetGenerator_CS_Grouped, possibly wrapped in DistributedDataParallel.
+        levels (int): Number of levels, from the outermost one.
+    """
+    block = getattr(net, 'module', net).model
+    depth = 0
+    while block is not None:
+        block.checkpoint = levels < 0 or depth < levels
+        block = block.submodule[0] if block.submodule is not None else None
+        depth += 1
+
+##
+def set_requires_grad(net, requires_grad):
+    for param in net.parameters():
+        param.requires_grad = requires_grad
+
 ##
 def define_G(opt, norm='batch', use_dropout=False, init_type='normal', training=True):
     netG = None
     norm_layer = get_norm_layer(norm_type=norm)
     num_layer = int(np.log2(opt.isize))
-    netG = UnetGenerator_CS(opt.nc, opt.nc, num_layer, opt.ngf, norm_layer=norm_layer, use_dropout=use_dropout,training=training)
+    if getattr(opt, 'netg_arch', 'cs') == 'cs_grouped':
+        netG = UnetGenerator_CS_Grouped(opt.nc, opt.nc, num_layer, opt.ngf, norm_layer=norm_layer, use_dropout=use_dropout, training=training)
+    else:
+        netG = UnetGenerator_CS(opt.nc, opt.nc, num_layer, opt.ngf, norm_layer=norm_layer, use_dropout=use_dropout,training=training)
+    set_checkpoint_levels(netG, getattr(opt, 'checkpoint_levels', 0))
     return init_net(netG, init_type, opt.gpu_ids)
 ##
 def define_D(opt, norm='batch', use_sigmoid=False, init_type='normal'):
@@ -543,10 +647,20 @@ class UnetSkipConnectionBlock(nn.Module):
             return torch.cat([x, self.model(x)], 1)
 
 class CS(nn.Module):
-    def __init__(self, features, WH, r, L=32):
+    """ Channel selection between the lap and res branches.
+
+    A softmax over the two branches, computed per channel from the global
+    average of their sum, weights each branch.
+
+    Args:
+        features (int): Number of channels of each branch.
+        r (int): Reduction ratio of the hidden layer.
+        L (int): Minimum width of the hidden layer.
+    """
+    def __init__(self, features, r=2, L=32):
         super(CS, self).__init__()
         d = max(int(features/r), L)
-        self.gap = nn.AvgPool2d(int(WH))
+        self.gap = nn.AdaptiveAvgPool2d(1)
         self.fc = nn.Linear(int(features), d)
         self.fcs = nn.ModuleList([])
         for i in range(2):
@@ -556,24 +670,46 @@ class CS(nn.Module):
         self.softmax = nn.Softmax(dim=1)
     def forward(self, x):
         x1, x2 = x
-        x = x1 + x2
-        #pdb.set_trace()
-        fea_s = self.gap(x).squeeze_()
-        fea_z = self.fc(fea_s.cpu())
-        for i, fc in enumerate(self.fcs):
-            vector = fc(fea_z).unsqueeze_(dim=1)
-            if i == 0:
-                attention_vec = vector
-            else:
-                attention_vec = torch.cat([attention_vec, vector], dim=1)
-        attention_vec = self.softmax(attention_vec)
-        attention_vec = attention_vec.unsqueeze(-1).unsqueeze(-1)
-        #pdb.set_trace()
-        attention_vec = attention_vec.transpose(0,1).cuda()
-        out_x1 = x1 * attention_vec[0]
-        out_x2 = x2 * attention_vec[1]
+        fea_s = self.gap(x1 + x2).flatten(1)
+        fea_z = self.fc(fea_s)
+        attention_vec = torch.stack([fc(fea_z) for fc in self.fcs], dim=1)
+        attention_vec = self.softmax(attention_vec).unsqueeze(-1).unsqueeze(-1)
+        out_x1 = x1 * attention_vec[:, 0]
+        out_x2 = x2 * attention_vec[:, 1]
         return (out_x1, out_x2)
 
+##
+def migrate_cs_state_dict(state_dict, net):
+    """ Adapt a generator checkpoint to the layout of `net`.
+
+    Checkpoints of UnetGenerator_CS and UnetGenerator_CS_Grouped are converted
+    into each other. CS weights missing from checkpoints saved before CS was a
+    submodule are filled in: those checkpoints drew a new random CS at every
+    forward, so there is no trained attention to restore and the freshly
+    initialized weights of `net` are used instead.
+
+    Args:
+        state_dict (dict): Checkpoint of a UnetGenerator_CS or UnetGenerator_CS_Grouped.
+        net (nn.Module): Generator the checkpoint is loaded into.
+
+    Returns:
+        [dict]: State dict loadable with strict=True.
+    """
+    own = net.state_dict()
+    own_split = any('.down_lap.' in k for k in own)
+    ckpt_split = any('.down_lap.' in k for k in state_dict)
+    if own_split and not ckpt_split:
+        state_dict = split_cs_state_dict(state_dict)
+    elif ckpt_split and not own_split:
+        state_dict = group_cs_state_dict(state_dict)
+    missing = [k for k in own if k not in state_dict and '.cs.' in k]
+    if missing:
+        print('   Checkpoint has no CS weights, keeping the initialized ones.')
+        state_dict = dict(state_dict)
+        for k in missing:
+            state_dict[k] = own[k]
+    return state_dict
+
 class UnetSkipConnectionBlock_CS(nn.Module):
     def __init__(self, layer_num, outer_nc, inner_nc, input_nc=None,
                  submodule=None, outermost=False, innermost=False, norm_layer=nn.BatchNorm2d, use_dropout=False, training=True):
@@ -657,6 +793,8 @@ class UnetSkipConnectionBlock_CS(nn.Module):
             self.submodule = nn.Sequential(*[submodule])
         self.up_lap = nn.Sequential(*up_lap)
         self.up_res = nn.Sequential(*up_res)
+        self.cs = CS(inner_nc, 2)
+        self.checkpoint = False
 
         #self.model_res = nn.Sequential(*model_res)
         #self.model_lap = nn.Sequential(*model_lap)
@@ -665,14 +803,13 @@ class UnetSkipConnectionBlock_CS(nn.Module):
         #pdb.set_trace()
         input_lap = input[0]
         input_res = input[1]
+        if self.checkpoint and torch.is_grad_enabled():
+            return self.forward_checkpointed(input_lap, input_res)
         if self.outermost:
             d_lap = self.down_lap(input_lap)
             d_res = self.down_res(input_res)
-            b,features,w_,h_ = d_lap.shape
-            CS_block = CS(features,w_,2)
-            #pdb.set_trace()
             d = (d_lap, d_res)
-            d_lap, d_res = CS_block(d)
+            d_lap, d_res = self.cs(d)
             if self.submodule == None:
                 out_lap = self.up_lap(d_lap)
                 out_res = self.up_res(d_res)
@@ -686,11 +823,8 @@ class UnetSkipConnectionBlock_CS(nn.Module):
         else:
             d_lap = self.down_lap(input_lap)
             d_res = self.down_res(input_res)
-            b,features,w_,h_ = d_lap.shape
-            CS_block = CS(features,w_,2)
-            #pdb.set_trace()
             d = (d_lap, d_res)
-            d_lap, d_res = CS_block(d)
+            d_lap, d_res = self.cs(d)
             if self.submodule == None:
                 out_lap = self.up_lap(d_lap)
                 out_res = self.up_res(d_res)
@@ -702,6 +836,188 @@ class UnetSkipConnectionBlock_CS(nn.Module):
                 out_res = self.up_res(u_res)
             return (torch.cat([input_lap, out_lap], 1), torch.cat([input_res, out_res], 1))
 
+    def forward_checkpointed(self, input_lap, input_res):
+        """ forward() with the down and up paths of this level under activation checkpointing.
+
+        The in-place activations heading down_*/up_* run outside the
+        checkpoints, so that the recomputation sees the same inputs. They act
+        on the same tensors as in forward(), so the skip connections do too.
+        """
+        head = 0 if self.outermost else 1
+        input_lap = self.down_lap[:head](input_lap)
+        input_res = self.down_res[:head](input_res)
+        d_lap, d_res = run_checkpointed(lambda a, b: self.cs((self.down_lap[head:](a), self.down_res[head:](b))),
+                                        [self.down_lap, self.down_res], input_lap, input_res)
+        if self.submodule is not None:
+            d_lap, d_res = self.submodule((d_lap, d_res))
+        u_lap, u_res = self.up_lap[:1](d_lap), self.up_res[:1](d_res)
+        out_lap, out_res = run_checkpointed(lambda a, b: (self.up_lap[1:](a), self.up_res[1:](b)),
+                                            [self.up_lap, self.up_res], u_lap, u_res)
+        if self.outermost:
+            return (out_lap, out_res)
+        return (torch.cat([input_lap, out_lap], 1), torch.cat([input_res, out_res], 1))
+
+class UnetGenerator_CS_Grouped(nn.Module):
+    """ UnetGenerator_CS with both branches stacked along the channel axis.
+
+    Every level runs the lap and res paths as one groups=2 convolution, with
+    one norm layer over the stacked channels (BatchNorm and InstanceNorm are
+    per channel, so that is the same as one norm per branch). This halves the
+    number of conv, norm and activation ops. Same inputs, outputs and math as
+    UnetGenerator_CS; convert weights with group_cs_state_dict /
+    split_cs_state_dict.
+    """
+    def __init__(self, input_nc, output_nc, num_downs, ngf=64,
+                 norm_layer=nn.BatchNorm2d, use_dropout=False, training=True):
+        super(UnetGenerator_CS_Grouped, self).__init__()
+
+        # construct unet structure
+        unet_block = UnetSkipConnectionBlock_CS_Grouped(ngf * 8, ngf * 8, input_nc=None, submodule=None, norm_layer=norm_layer, innermost=True)
+        for i in range(num_downs - 5):
+            unet_block = UnetSkipConnectionBlock_CS_Grouped(ngf * 8, ngf * 8, input_nc=None, submodule=unet_block, norm_layer=norm_layer)
+        unet_block = UnetSkipConnectionBlock_CS_Grouped(ngf * 4, ngf * 8, input_nc=None, submodule=unet_block, norm_layer=norm_layer)
+        unet_block = UnetSkipConnectionBlock_CS_Grouped(ngf * 2, ngf * 4, input_nc=None, submodule=unet_block, norm_layer=norm_layer)
+        unet_block = UnetSkipConnectionBlock_CS_Grouped(ngf, ngf * 2, input_nc=None, submodule=unet_block, norm_layer=norm_layer)
+        unet_block = UnetSkipConnectionBlock_CS_Grouped(output_nc, ngf, input_nc=input_nc, submodule=unet_block, outermost=True, norm_layer=norm_layer)
+
+        self.model = unet_block
+        self.output_nc = output_nc
+
+    def forward(self, input):
+        out = self.model(torch.cat(input, 1))
+        return (out[:, :self.output_nc], out[:, self.output_nc:])
+
+class CS_Grouped(CS):
+    """ CS on a stacked (B, 2 * C, H, W) tensor: lap channels first, then res. """
+    def forward(self, x):
+        # Shapes through size() calls only, so that the module stays traceable (torch.fx, ONNX).
+        stacked = x.view(x.size(0), 2, -1, x.size(2), x.size(3))
+        fea_z = self.fc(self.gap(stacked.sum(1)).flatten(1))
+        attention_vec = torch.stack([fc(fea_z) for fc in self.fcs], dim=1)
+        attention_vec = self.softmax(attention_vec).unsqueeze(-1).unsqueeze(-1)
+        return (stacked * attention_vec).view_as(x)
+
+class UnetSkipConnectionBlock_CS_Grouped(nn.Module):
+    """ UnetSkipConnectionBlock_CS on stacked lap/res channels.
+
+    down/up hold the same layers as down_lap/up_lap, with doubled channels and
+    groups=2. Skip connections keep each branch together: the output is laid
+    out as [input_lap, out_lap, input_res, out_res].
+    """
+    def __init__(self, outer_nc, inner_nc, input_nc=None,
+                 submodule=None, outermost=False, innermost=False, norm_layer=nn.BatchNorm2d):
+        super(UnetSkipConnectionBlock_CS_Grouped, self).__init__()
+        self.outermost = outermost
+        if type(norm_layer) == functools.partial:
+            use_bias = norm_layer.func == nn.InstanceNorm2d
+        else:
+            use_bias = norm_layer == nn.InstanceNorm2d
+        if input_nc is None:
+            input_nc = outer_nc
+        downconv = nn.Conv2d(input_nc * 2, inner_nc * 2, kernel_size=4,
+                             stride=2, padding=1, bias=use_bias, groups=2)
+        downrelu = nn.LeakyReLU(0.2, True)
+        downnorm = norm_layer(inner_nc * 2)
+        uprelu = nn.ReLU(True)
+        upnorm = norm_layer(outer_nc * 2)
+
+        if outermost:
+            upconv = nn.ConvTranspose2d(inner_nc * 4, outer_nc * 2,
+                                        kernel_size=4, stride=2,
+                                        padding=1, groups=2)
+            down = [downconv]
+            up = [uprelu, upconv, nn.Tanh()]
+        elif innermost:
+            upconv = nn.ConvTranspose2d(inner_nc * 2, outer_nc * 2,
+                                        kernel_size=4, stride=2,
+                                        padding=1, bias=use_bias, groups=2)
+            down = [downrelu, downconv]
+            up = [uprelu, upconv, upnorm]
+        else:
+            upconv = nn.ConvTranspose2d(inner_nc * 4, outer_nc * 2,
+                                        kernel_size=4, stride=2,
+                                        padding=1, bias=use_bias, groups=2)
+            down = [downrelu, downconv, downnorm]
+            up = [uprelu, upconv, upnorm]
+
+        self.down = nn.Sequential(*down)
+        self.submodule = None if submodule is None else nn.Sequential(submodule)
+        self.up = nn.Sequential(*up)
+        self.cs = CS_Grouped(inner_nc, 2)
+        self.checkpoint = False
+
+    def forward(self, input):
+        if self.checkpoint and torch.is_grad_enabled():
+            # As UnetSkipConnectionBlock_CS.forward_checkpointed.
+            head = 0 if self.outermost else 1
+            input = self.down[:head](input)
+            d = run_checkpointed(lambda x: self.cs(self.down[head:](x)), [self.down], input)
+            if self.submodule is not None:
+                d = self.submodule(d)
+            out = run_checkpointed(self.up[1:], [self.up], self.up[:1](d))
+        else:
+            d = self.cs(self.down(input))
+            if self.submodule is not None:
+                d = self.submodule(d)
+            out = self.up(d)
+        if self.outermost:
+            return out
+        n, h, w = input.size(0), input.size(2), input.size(3)
+        return torch.cat([input.view(n, 2, -1, h, w), out.view(n, 2, -1, h, w)], 2).view(n, -1, h, w)
+
+##
+def group_cs_state_dict(state_dict):
+    """ Convert a UnetGenerator_CS state dict to UnetGenerator_CS_Grouped.
+
+    The lap and res parameters and buffers of every down/up layer are
+    concatenated along dim 0, lap first, which is the layout of a groups=2
+    Conv2d/ConvTranspose2d and of a norm layer over the stacked channels.
+
+    Args:
+        state_dict (dict): State dict of a UnetGenerator_CS.
+
+    Returns:
+        [OrderedDict]: State dict of a UnetGenerator_CS_Grouped.
+    """
+    grouped = OrderedDict()
+    for k, v in state_dict.items():
+        parts = k.split('.')
+        branch = [i for i, p in enumerate(parts) if p in ('down_lap', 'up_lap', 'down_res', 'up_res')]
+        if not branch:
+            grouped[k] = v
+            continue
+        i = branch[0]
+        if parts[i].endswith('_res'):
+            continue
+        name = parts[i][:-len('_lap')]
+        res = state_dict['.'.join(parts[:i] + [name + '_res'] + parts[i + 1:])]
+        # num_batches_tracked is the same scalar in both branches.
+        grouped['.'.join(parts[:i] + [name] + parts[i + 1:])] = v if v.dim() == 0 else torch.cat([v, res], 0)
+    return grouped
+
+##
+def split_cs_state_dict(state_dict):
+    """ Convert a UnetGenerator_CS_Grouped state dict back to UnetGenerator_CS.
+
+    Args:
+        state_dict (dict): State dict of a UnetGenerator_CS_Grouped.
+
+    Returns:
+        [OrderedDict]: State dict of a UnetGenerator_CS.
+    """
+    split = OrderedDict()
+    for k, v in state_dict.items():
+        parts = k.split('.')
+        branch = [i for i, p in enumerate(parts) if p in ('down', 'up')]
+        if not branch:
+            split[k] = v
+            continue
+        i = branch[0]
+        lap, res = (v, v) if v.dim() == 0 else v.chunk(2, 0)
+        split['.'.join(parts[:i] + [parts[i] + '_lap'] + parts[i + 1:])] = lap.clone()
+        split['.'.join(parts[:i] + [parts[i] + '_res'] + parts[i + 1:])] = res.clone()
+    return split
+
 # Defines the PatchGAN discriminator with the specified arguments.
 class NLayerDiscriminator(nn.Module):
     def __init__(self, input_nc, ndf=64, n_layers=3, norm_layer=nn.BatchNorm2d, use_sigmoid=False):
@@ -773,3 +1089,10 @@ class PixelDiscriminator(nn.Module):
 
     def forward(self, input):
         return self.net(input)
+
+##
+def strip_module_prefix(state_dict):
+    """ State dict without the "module." key prefix of checkpoints saved from
+    DataParallel networks (before multi-device training used DistributedDataParallel).
+    """
+    return {k[len('module.'):] if k.startswith('module.') else k: v for k, v in state_dict.items()}
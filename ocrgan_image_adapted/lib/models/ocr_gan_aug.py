@@ -13,11 +13,14 @@ import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 
-from lib.models.networks import NetD, weights_init, define_G, define_D, get_scheduler
+from lib.models.networks import NetD, weights_init, define_G, define_D, get_scheduler, migrate_cs_state_dict, set_requires_grad, strip_module_prefix
 from lib.visualizer import Visualizer
 from lib.loss import l2_loss
-from lib.evaluate import roc, pre_recall, save_curve
+from lib.evaluate import roc, pre_recall, save_curve, PixelMetrics
+from lib.data.datasets import load_mask, mask_path
 from lib.models.basemodel_aug import BaseModel_Aug
+from lib.models.scorer import load_scorer
+from lib.distributed import wrap_ddp, unwrap, all_reduce_mean
 import pdb
 
 class Ocr_Gan_Aug(BaseModel_Aug):
@@ -39,15 +42,24 @@ class Ocr_Gan_Aug(BaseModel_Aug):
         # Create and initialize networks.
         self.netg = define_G(self.opt, norm='batch', use_dropout=False, init_type='normal')
         self.netd = define_D(self.opt, norm='batch', use_sigmoid=False, init_type='normal')
+        self.scorer = load_scorer(self.opt.scorer) if self.opt.scorer != '' else None
 
         ##
         if self.opt.resume != '':
             print("\nLoading pre-trained networks.")
             self.opt.iter = torch.load(os.path.join(self.opt.resume, 'netG.pth'))['epoch']
-            self.netg.load_state_dict(torch.load(os.path.join(self.opt.resume, 'netG.pth'))['state_dict'])
-            self.netd.load_state_dict(torch.load(os.path.join(self.opt.resume, 'netD.pth'))['state_dict'])
+            self.netg.load_state_dict(migrate_cs_state_dict(strip_module_prefix(torch.load(os.path.join(self.opt.resume, 'netG.pth'))['state_dict']), self.netg))
+            self.netd.load_state_dict(strip_module_prefix(torch.load(os.path.join(self.opt.resume, 'netD.pth'))['state_dict']))
             print("\tDone.\n")
 
+        ##
+        # Multi-process training (torchrun): gradients of netG and netD are
+        # averaged over the processes. DistributedDataParallel broadcasts the
+        # weights of rank 0 when wrapping, so all processes start alike.
+        if getattr(self.opt, 'distributed', False):
+            self.netg = wrap_ddp(self.netg.to(self.device), self.device)
+            self.netd = wrap_ddp(self.netd.to(self.device), self.device)
+
         if self.opt.verbose:
             print(self.netg)
             print(self.netd)
@@ -90,79 +102,159 @@ class Ocr_Gan_Aug(BaseModel_Aug):
     def forward_g(self):
         """ Forward propagate through netG
         """
-        self.fake_lap, self.fake_res = self.netg((self.input_lap + self.noise, self.input_res + self.noise))
+        with self.autocast():
+            fake_lap, fake_res = self.netg((self.input_lap + self.noise, self.input_res + self.noise))
+        self.fake_lap, self.fake_res = fake_lap.float(), fake_res.float()
         self.fake = self.fake_lap + self.fake_res
 
     def forward_d(self):
-        """ Forward propagate through netD
+        """ Forward propagate real, fake and fake_aug through netD as one batch.
+
+        fake is detached: this pass only feeds the netD loss. Each third of the
+        batch is normalized on its own (see BasicDiscriminator.forward), so the
+        outputs match three separate netd calls.
         """
-        self.pred_real, self.feat_real = self.netd(self.input_lap + self.input_res)
-        self.pred_fake, self.feat_fake = self.netd(self.fake)
-        self.pred_fake_aug, self.feat_fake_aug = self.netd(self.fake_aug)
+        batch = torch.cat([self.input_lap + self.input_res, self.fake.detach(), self.fake_aug], 0)
+        with self.autocast():
+            pred, feat = self.netd(batch, segments=3)
+        feat = feat.float()
+        self.pred_real, self.pred_fake, self.pred_fake_aug = pred.chunk(3, 0)
+        self.feat_real, self.feat_fake, self.feat_fake_aug = feat.chunk(3, 0)
 
     def backward_g(self):
         """ Backpropagate netg
+
+        netD is frozen: its gradients from the generator loss were discarded
+        anyway, and this skips computing them. The pass bypasses the
+        DistributedDataParallel wrapper of netD, whose gradients are only
+        reduced in backward_d.
         """
-        # Device consistency
-        self.pred_fake = self.pred_fake.to(self.device)
-        self.real_label = self.real_label.to(self.device)
-        self.fake = self.fake.to(self.device)
-        self.input_lap = self.input_lap.to(self.device)
-        self.input_res = self.input_res.to(self.device)
-        self.feat_fake = self.feat_fake.to(self.device)
-        self.feat_real = self.feat_real.to(self.device)
+        set_requires_grad(self.netd, False)
+        with self.autocast():
+            pred_fake, feat_fake = unwrap(self.netd)(self.fake)
+        feat_fake = feat_fake.float()
+        set_requires_grad(self.netd, True)
 
-        self.err_g_adv = self.opt.w_adv * self.l_adv(self.pred_fake, self.real_label)
+        self.err_g_adv = self.opt.w_adv * self.l_adv(pred_fake, self.real_label[:pred_fake.size(0)])
         self.err_g_con = self.opt.w_con * self.l_con(self.fake, self.input_lap + self.input_res)
-        self.err_g_lat = self.opt.w_lat * self.l_lat(self.feat_fake, self.feat_real)
+        self.err_g_lat = self.opt.w_lat * self.l_lat(feat_fake, self.feat_real.detach())
 
         self.err_g = self.err_g_adv + self.err_g_con + self.err_g_lat
-        self.err_g.backward(retain_graph=True)
+        (self.err_g * self.loss_scale).backward()
 
     def backward_d(self):
+        """ Backpropagate netd
+        """
+        n = self.pred_real.size(0)
         # Fake
-        pred_fake, _ = self.netd(self.fake.detach())
-        pred_fake_aug, _ = self.netd(self.fake_aug.detach())
-        pred_fake = pred_fake.to(self.device)
-        pred_fake_aug = pred_fake_aug.to(self.device)
-        self.fake_label = self.fake_label.to(self.device)
-        self.real_label = self.real_label.to(self.device)
-        self.feat_real = self.feat_real.to(self.device)
-        self.feat_fake = self.feat_fake.to(self.device)
-        self.pred_real = self.pred_real.to(self.device)
-
-        self.err_d_fake = self.l_adv(pred_fake, self.fake_label)
-        self.err_d_fake_aug = self.l_adv(pred_fake_aug, self.fake_label)
+        self.err_d_fake = self.l_adv(self.pred_fake, self.fake_label[:n])
+        self.err_d_fake_aug = self.l_adv(self.pred_fake_aug, self.fake_label[:n])
 
         # Real
-        self.err_d_real = self.l_adv(self.pred_real, self.real_label)
+        self.err_d_real = self.l_adv(self.pred_real, self.real_label[:n])
+
+        # Latent: the err_g_lat term, differentiated w.r.t. netD only.
+        err_d_lat = self.opt.w_lat * self.l_lat(self.feat_fake, self.feat_real)
 
         # Combine losses.
-        self.err_d = self.err_d_real + self.err_d_fake + self.err_g_lat + self.err_d_fake_aug
-        self.err_d.backward(retain_graph=True)
+        self.err_d = self.err_d_real + self.err_d_fake + err_d_lat + self.err_d_fake_aug
+        (self.err_d * self.loss_scale).backward()
 
-    def update_netg(self):
-        """ Update Generator Network.
-        """
-        self.optimizer_g.zero_grad()
-        self.backward_g()
-        self.optimizer_g.step()
+    def optimize_params(self, zero_grad=True, step=True):
+        """ Optimize netD and netG  networks.
+
+        netD runs twice per micro-batch: once on real, fake and fake_aug
+        concatenated, for the netD loss, and once on fake with the generator
+        graph attached, for the netG loss. Both use the netD weights from before
+        the step, as before, and no graph outlives its backward pass.
 
-    def update_netd(self):
-        """ Update Discriminator Network.
+        The batch is processed in micro-batches of self.micro_batch samples
+        (--micro_batch, 0 for the whole batch). Their gradients are accumulated,
+        weighted by their share of the batch and divided by --accum_steps, so
+        the optimizers see the gradient of the mean loss over the effective
+        batch. BatchNorm, however, normalizes every micro-batch with its own
+        statistics and updates its running statistics once per micro-batch.
+
+        In multi-process training, every process runs this on its own shard of
+        the batch and the gradients are averaged over the processes in the
+        backward passes of the last micro-batch before a step (see
+        sync_gradients). BatchNorm statistics stay per process.
+
+        Args:
+            zero_grad (bool): Clear the gradients first (first batch of an --accum_steps cycle).
+            step (bool): Step the optimizers after the backward passes (last batch of the cycle).
         """
-        self.optimizer_d.zero_grad()
-        self.backward_d()
-        self.optimizer_d.step()
-        if self.err_d < 1e-5:
-            self.reinit_d()
+        if zero_grad:
+            self.optimizer_g.zero_grad()
+            self.optimizer_d.zero_grad()
+
+        full = (self.input_lap, self.input_res, self.fake_aug, self.noise)
+        size = self.input_lap.size(0)
+        micro = self.micro_batch if 0 < self.micro_batch < size else size
+        names = ('err_d', 'err_g', 'err_g_adv', 'err_g_con', 'err_g_lat')
+        errors = dict.fromkeys(names, 0.)
+        fakes = []
+        try:
+            for start in range(0, size, micro):
+                self.input_lap, self.input_res, self.fake_aug, self.noise = (t[start:start + micro] for t in full)
+                share = self.input_lap.size(0) / size
+                self.loss_scale = share / self.opt.accum_steps
+                with self.sync_gradients(step and start + micro >= size):
+                    self.forward()
+                    self.backward_g()
+                    self.backward_d()
+                fakes.append((self.fake_lap.detach(), self.fake_res.detach()))
+                for name in names:
+                    errors[name] = errors[name] + share * getattr(self, name).detach()
+        finally:
+            self.input_lap, self.input_res, self.fake_aug, self.noise = full
+
+        # Batch-level results, for get_errors() and get_current_images().
+        for name in names:
+            setattr(self, name, errors[name])
+        self.fake_lap = torch.cat([f[0] for f in fakes], 0)
+        self.fake_res = torch.cat([f[1] for f in fakes], 0)
+        self.fake = self.fake_lap + self.fake_res
 
-    def optimize_params(self):
-        """ Optimize netD and netG  networks.
+        if step:
+            self.optimizer_g.step()
+            self.optimizer_d.step()
+            # All processes take the same decision, on the mean netD loss.
+            if all_reduce_mean(self.err_d, self.opt) < 1e-5:
+                self.reinit_d()
+
+    def score_batch(self):
+        """ Anomaly scores of the current input batch.
+
+        Returns:
+            [FloatTensor]: 0.9 * rec + 0.1 * lat for every image.
         """
-        self.forward()
-        self.update_netg()
-        self.update_netd()
+        with self.autocast():
+            fake_lap, fake_res = self.netg((self.input_lap, self.input_res))
+            self.fake_lap, self.fake_res = fake_lap.float(), fake_res.float()
+            self.fake = self.fake_lap + self.fake_res
+
+            _, self.feat_real = self.netd(self.input_lap + self.input_res)
+            _, self.feat_fake = self.netd(self.fake)
+        self.feat_real, self.feat_fake = self.feat_real.float(), self.feat_fake.float()
+
+        # Device consistency for test
+        self.input_lap = self.input_lap.to(self.device)
+        self.input_res = self.input_res.to(self.device)
+        self.fake = self.fake.to(self.device)
+        self.feat_real = self.feat_real.to(self.device)
+        self.feat_fake = self.feat_fake.to(self.device)
+
+        # Calculate the anomaly score.
+        si = self.input_lap.size()
+        sz = self.feat_real.size()
+        rec = (self.input_lap + self.input_res - self.fake).view(si[0], si[1] * si[2] * si[3])
+        lat = (self.feat_real - self.feat_fake).view(sz[0], sz[1] * sz[2] * sz[3])
+        rec = torch.mean(torch.pow(rec, 2), dim=1)
+        lat = torch.mean(torch.pow(lat, 2), dim=1)
+        # Per-pixel error, averaged over channels: rec is its spatial mean.
+        self.error_map = torch.pow(self.input_lap + self.input_res - self.fake, 2).mean(dim=1)
+        return 0.9 * rec + 0.1 * lat
 
     def test(self, plot_hist=True):
         """ Test model.
@@ -189,6 +281,20 @@ class Ocr_Gan_Aug(BaseModel_Aug):
             self.gt_labels = torch.zeros(size=(len(self.data.valid.dataset),), dtype=torch.long, device=self.device)
             self.features = torch.zeros(size=(len(self.data.valid.dataset), self.opt.nz), dtype=torch.float32, device=self.device)
 
+            pixel_metrics = None
+            if self.opt.pixel_eval:
+                dataset = self.data.valid.dataset
+                # Packs list names relative to the split (<class>/<image>): resolve
+                # them against <dataroot>/test, so that mask_path finds <dataroot>/ground_truth.
+                root = dataset.root if hasattr(dataset, 'pack') else ''
+                image_paths = [os.path.join(root, path) for path, _ in dataset.imgs]
+                num_masks = sum(os.path.exists(mask_path(path)) for path in image_paths)
+                if num_masks == 0:
+                    # Without masks every pixel would count as normal.
+                    raise IOError("--pixel_eval: no ground-truth masks in %s (data_creation scripts with --keep_masks, "
+                                  "then pack_dataset.py for packs)" % os.path.dirname(os.path.dirname(mask_path(image_paths[0]))))
+                pixel_metrics = PixelMetrics()
+
             print("   Testing %s" % self.name)
             self.times = []
             self.total_steps = 0
@@ -200,27 +306,12 @@ class Ocr_Gan_Aug(BaseModel_Aug):
 
                 # Forward - Pass
                 self.set_input(data)
-                self.fake_lap, self.fake_res = self.netg((self.input_lap, self.input_res))
-                self.fake = self.fake_lap + self.fake_res
-
-                _, self.feat_real = self.netd(self.input_lap + self.input_res)
-                _, self.feat_fake = self.netd(self.fake)
-
-                # Device consistency for test
-                self.input_lap = self.input_lap.to(self.device)
-                self.input_res = self.input_res.to(self.device)
-                self.fake = self.fake.to(self.device)
-                self.feat_real = self.feat_real.to(self.device)
-                self.feat_fake = self.feat_fake.to(self.device)
-
-                # Calculate the anomaly score.
-                si = self.input_lap.size()
-                sz = self.feat_real.size()
-                rec = (self.input_lap + self.input_res - self.fake).view(si[0], si[1] * si[2] * si[3])
-                lat = (self.feat_real - self.feat_fake).view(sz[0], sz[1] * sz[2] * sz[3])
-                rec = torch.mean(torch.pow(rec, 2), dim=1)
-                lat = torch.mean(torch.pow(lat, 2), dim=1)
-                error = 0.9 * rec + 0.1 * lat
+                if self.scorer is not None:
+                    # Deployed scorer (--scorer), run on the CPU.
+                    error, error_map = self.scorer(self.input_lap.cpu(), self.input_res.cpu())
+                    error, self.error_map = error.float().to(self.device), error_map[:, 0].float()
+                else:
+                    error = self.score_batch()
 
                 time_o = time.time()
 
@@ -229,8 +320,14 @@ class Ocr_Gan_Aug(BaseModel_Aug):
 
                 self.times.append(time_o - time_i)
 
+                # Pixel metrics, from the masks of the images of this batch.
+                if pixel_metrics is not None:
+                    start = i * self.opt.batchsize
+                    masks = np.stack([load_mask(path, self.opt.isize) for path in image_paths[start:start + error.size(0)]])
+                    pixel_metrics.update(self.error_map.float().cpu().numpy(), masks)
+
                 # Save test images.
-                if self.opt.save_test_images:
+                if self.opt.save_test_images and self.scorer is None:
                     dst = os.path.join(self.opt.outf, self.opt.name, 'test', 'images')
                     if not os.path.isdir(dst): os.makedirs(dst)
                     real_vis, fake_vis, fake_lap_vis, fake_res_vis = self.get_current_images()
@@ -238,6 +335,7 @@ class Ocr_Gan_Aug(BaseModel_Aug):
                     vutils.save_image(fake_vis, '%s/fake_%03d.png' % (dst, i + 1), normalize=True)
                     vutils.save_image(fake_lap_vis, '%s/fake_lap_%03d.png' % (dst, i + 1), normalize=True)
                     vutils.save_image(fake_res_vis, '%s/fake_res_%03d.png' % (dst, i + 1), normalize=True)
+                    vutils.save_image(self.error_map.unsqueeze(1), '%s/error_%03d.png' % (dst, i + 1), normalize=True)
             # Measure inference time.
             self.times = np.array(self.times)
             self.times = np.mean(self.times[:100] * 1000)
@@ -247,6 +345,8 @@ class Ocr_Gan_Aug(BaseModel_Aug):
                              (torch.max(self.an_scores) - torch.min(self.an_scores))
             auc = roc(self.gt_labels, self.an_scores)
             performance = OrderedDict([('Avg Run Time (ms/batch)', self.times), ('AUC', auc)])
+            if pixel_metrics is not None:
+                performance['Pixel AUROC'], performance['PRO'] = pixel_metrics.compute()
             if self.opt.load_weights:
                 self.visualizer.print_current_performance(performance, auc)
 
@@ -0,0 +1,257 @@
+"""
+CHANNEL PRUNING OF UnetGenerator_CS
+
+Every level of the generator has two prunable channel sets, pruned in the lap
+and res branches alike:
+    inner: outputs of the down convolutions, weighted per channel by CS, read
+           by the down convolutions of the next level and by the up convolution.
+    outer: outputs of the up convolution (all levels but the outermost), read
+           by the up convolution of the level above, after the skip channels.
+"""
+
+# pylint: disable=C0301,E1101,W0622,C0103,R0902,R0915
+
+import torch
+import torch.nn as nn
+
+from lib.models.networks import UnetGenerator_CS
+
+NORMS = (nn.BatchNorm2d, nn.InstanceNorm2d)
+
+##
+def generator_levels(netg):
+    """ UnetSkipConnectionBlock_CS levels of a UnetGenerator_CS, outermost first. """
+    netg = getattr(netg, 'module', netg)
+    if not isinstance(netg, UnetGenerator_CS):
+        raise NotImplementedError("Pruning needs --netg_arch cs, not %s" % type(netg).__name__)
+    levels = [netg.model]
+    while levels[-1].submodule is not None:
+        levels.append(levels[-1].submodule[0])
+    return levels
+
+def _find(seq, types):
+    """ Index in `seq` of the first layer of one of `types`, or None. """
+    for i, layer in enumerate(seq):
+        if isinstance(layer, types):
+            return i
+    return None
+
+def _slice_conv(conv, out_idx, in_idx):
+    """ Copy of a Conv2d/ConvTranspose2d restricted to the output and input channels given. """
+    transposed = isinstance(conv, nn.ConvTranspose2d)
+    weight = conv.weight.data
+    weight = weight[in_idx][:, out_idx] if transposed else weight[out_idx][:, in_idx]
+    new = type(conv)(len(in_idx), len(out_idx), conv.kernel_size, stride=conv.stride,
+                     padding=conv.padding, bias=conv.bias is not None)
+    new.weight.data.copy_(weight)
+    if conv.bias is not None:
+        new.bias.data.copy_(conv.bias.data[out_idx])
+    return new.to(conv.weight.device)
+
+def _slice_norm(norm, idx):
+    """ Copy of a BatchNorm2d/InstanceNorm2d restricted to the channels given. """
+    new = type(norm)(len(idx), eps=norm.eps, momentum=norm.momentum, affine=norm.affine,
+                     track_running_stats=norm.track_running_stats)
+    for name, tensor in list(norm.named_parameters()) + list(norm.named_buffers()):
+        if tensor.dim() > 0:
+            getattr(new, name).data.copy_(tensor.data[idx])
+        else:
+            getattr(new, name).data.copy_(tensor.data)
+    return new.to(next(norm.buffers(), torch.zeros(0)).device)
+
+def _slice_linear(linear, out_idx, in_idx):
+    """ Copy of a Linear restricted to the output and input features given. """
+    new = nn.Linear(len(in_idx), len(out_idx), bias=linear.bias is not None)
+    new.weight.data.copy_(linear.weight.data[out_idx][:, in_idx])
+    if linear.bias is not None:
+        new.bias.data.copy_(linear.bias.data[out_idx])
+    return new.to(linear.weight.device)
+
+##
+def generator_widths(netg):
+    """ [(inner, outer)] channel counts of every level, outermost first. """
+    widths = []
+    for block in generator_levels(netg):
+        down = block.down_lap[_find(block.down_lap, nn.Conv2d)]
+        up = block.up_lap[_find(block.up_lap, nn.ConvTranspose2d)]
+        widths.append((down.out_channels, up.out_channels))
+    return widths
+
+##
+def prune_generator(netg, keep):
+    """ Remove channels of a UnetGenerator_CS in place.
+
+    Args:
+        netg (nn.Module): UnetGenerator_CS, possibly wrapped in DistributedDataParallel.
+        keep (list): [(inner, outer)] LongTensors of the channels kept at every
+            level, outermost first. The outer channels of the outermost level
+            (the image channels) are always kept.
+
+    Returns:
+        [nn.Module]: netg
+    """
+    levels = generator_levels(netg)
+    widths = generator_widths(netg)
+    for i, block in enumerate(levels):
+        inner, outer = keep[i]
+        if block.outermost:
+            outer = torch.arange(widths[i][1])
+        if i == 0:
+            down_in = torch.arange(block.down_lap[_find(block.down_lap, nn.Conv2d)].in_channels)
+        else:
+            down_in = keep[i - 1][0]
+        # The up convolution reads the CS output directly at the innermost
+        # level, and [skip, output of the level below] elsewhere.
+        if block.submodule is None:
+            up_in = inner
+        else:
+            up_in = torch.cat([inner, widths[i][0] + keep[i + 1][1]])
+        for seq in (block.down_lap, block.down_res):
+            j = _find(seq, nn.Conv2d)
+            seq[j] = _slice_conv(seq[j], inner, down_in)
+            j = _find(seq, NORMS)
+            if j is not None:
+                seq[j] = _slice_norm(seq[j], inner)
+        for seq in (block.up_lap, block.up_res):
+            j = _find(seq, nn.ConvTranspose2d)
+            seq[j] = _slice_conv(seq[j], outer, up_in)
+            j = _find(seq, NORMS)
+            if j is not None:
+                seq[j] = _slice_norm(seq[j], outer)
+        cs = block.cs
+        cs.fc = _slice_linear(cs.fc, torch.arange(cs.fc.out_features), inner)
+        for k in range(len(cs.fcs)):
+            cs.fcs[k] = _slice_linear(cs.fcs[k], inner, torch.arange(cs.fc.out_features))
+    return netg
+
+##
+def set_generator_widths(netg, widths):
+    """ Shrink a freshly built UnetGenerator_CS to the widths of a pruned checkpoint.
+
+    The weights are meaningless until the checkpoint is loaded.
+
+    Args:
+        netg (nn.Module): UnetGenerator_CS.
+        widths (list): [(inner, outer)] saved by prune.py.
+    """
+    return prune_generator(netg, [(torch.arange(inner), torch.arange(outer)) for inner, outer in widths])
+
+##
+def cs_channel_importance(netg, batches):
+    """ Importance of the inner and outer channels of every level.
+
+    inner: CS-weighted activation times outgoing weight norm. A forward hook on
+        every CS block averages |a_b * x_b| per channel over `batches`, where
+        a_b is the CS attention of branch b and x_b the down-path activation.
+        That is multiplied by the L1 norm of the weights reading the channel in
+        the next down convolution and the up convolution, summed over branches.
+    outer: |gamma| of the up-path BatchNorm times the L1 norm of the weights
+        reading the channel in the up convolution of the level above, summed
+        over branches.
+
+    Args:
+        netg (nn.Module): Trained UnetGenerator_CS.
+        batches (list): (lap, res) batches on the device of netg.
+
+    Returns:
+        [list]: [(inner, outer)] importance tensors, outermost first.
+    """
+    levels = generator_levels(netg)
+    widths = generator_widths(netg)
+    stats = [torch.zeros(inner) for inner, _ in widths]
+    counts = [0] * len(levels)
+
+    def hook(i):
+        def record(module, input, output):
+            stats[i] += sum(o.detach().float().abs().mean(dim=(2, 3)).sum(0).cpu() for o in output)
+            counts[i] += output[0].size(0)
+        return record
+
+    handles = [block.cs.register_forward_hook(hook(i)) for i, block in enumerate(levels)]
+    was_training = netg.training
+    netg.eval()
+    with torch.no_grad():
+        for lap, res in batches:
+            netg((lap, res))
+    netg.train(was_training)
+    for handle in handles:
+        handle.remove()
+
+    def reads(seq, types, idx):
+        """ L1 norm of the weights of the first `types` layer of seq reading input channels idx. """
+        conv = seq[_find(seq, types)]
+        weight = conv.weight.data.abs().float().cpu()
+        weight = weight if isinstance(conv, nn.ConvTranspose2d) else weight.transpose(0, 1)
+        return weight[idx].flatten(1).sum(1)
+
+    importance = []
+    for i, block in enumerate(levels):
+        inner_nc, outer_nc = widths[i]
+        inner_idx = torch.arange(inner_nc)
+        weights = torch.zeros(inner_nc)
+        for b, seq in enumerate((block.up_lap, block.up_res)):
+            weights += reads(seq, nn.ConvTranspose2d, inner_idx)
+            if block.submodule is not None:
+                child = levels[i + 1]
+                weights += reads((child.down_lap, child.down_res)[b], nn.Conv2d, inner_idx)
+        inner = stats[i] / max(counts[i], 1) * weights
+
+        outer = torch.zeros(outer_nc)
+        if not block.outermost:
+            parent = levels[i - 1]
+            outer_idx = widths[i - 1][0] + torch.arange(outer_nc)
+            for seq, parent_seq in ((block.up_lap, parent.up_lap), (block.up_res, parent.up_res)):
+                j = _find(seq, NORMS)
+                gamma = seq[j].weight.data.abs().float().cpu() if j is not None and seq[j].affine else torch.ones(outer_nc)
+                outer += gamma * reads(parent_seq, nn.ConvTranspose2d, outer_idx)
+        importance.append((inner, outer))
+    return importance
+
+##
+def select_channels(importance, ratio):
+    """ Channels kept when pruning `ratio` of the inner and outer channels of every level.
+
+    At least one channel per set is kept; kept channels stay in their original order.
+    """
+    keep = []
+    for scores in importance:
+        kept = []
+        for score in scores:
+            n = max(1, int(round(len(score) * (1. - ratio))))
+            kept.append(torch.sort(torch.argsort(score, descending=True)[:n])[0])
+        keep.append(tuple(kept))
+    return keep
+
+##
+def count_flops(net, inputs):
+    """ Multiply-accumulates of one forward pass of `net` per sample, over its Conv2d/ConvTranspose2d/Linear layers.
+
+    Args:
+        net (nn.Module): Network.
+        inputs (tuple): Arguments of net.forward.
+
+    Returns:
+        [tuple]: (MACs per sample, number of parameters)
+    """
+    total = [0]
+
+    def hook(module, input, output):
+        batch = output.size(0)
+        if isinstance(module, nn.ConvTranspose2d):
+            kernel = module.kernel_size[0] * module.kernel_size[1]
+            total[0] += input[0].numel() // batch * module.out_channels // module.groups * kernel
+        elif isinstance(module, nn.Conv2d):
+            kernel = module.kernel_size[0] * module.kernel_size[1]
+            total[0] += output.numel() // batch * module.in_channels // module.groups * kernel
+        else:
+            total[0] += output.numel() // batch * module.in_features
+
+    handles = [m.register_forward_hook(hook) for m in net.modules() if isinstance(m, (nn.Conv2d, nn.ConvTranspose2d, nn.Linear))]
+    was_training = net.training
+    net.eval()
+    with torch.no_grad():
+        net(*inputs)
+    net.train(was_training)
+    for handle in handles:
+        handle.remove()
+    return total[0], sum(p.numel() for p in net.parameters())
@@ -0,0 +1,254 @@
+""" Scorer
+
+Inference-only anomaly scoring, as in Ocr_Gan_Aug.test(), without the
+training class: TorchScript (int8) scorers of (lap, res) batches, and ONNX
+graphs of raw normalized images run with ONNX Runtime.
+"""
+
+import copy
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from lib.evaluate import roc
+from lib.models.networks import FrequencyDecomposition, define_G, define_D, migrate_cs_state_dict, strip_module_prefix
+from lib.models.pruning import set_generator_widths
+
+class Scorer(nn.Module):
+    """ Anomaly score of (lap, res) batches from netG and the feature branch of netD.
+
+    score = 0.9 * rec + 0.1 * lat, where rec is the mean squared reconstruction
+    error of lap + res and lat the mean squared distance between the netD
+    features of the input and of its reconstruction.
+
+    Args:
+        netg (nn.Module): Generator, taking and returning (lap, res).
+        feat (nn.Module): netD.feat.
+
+    Returns (from forward):
+        [tuple]: (scores (B,), per-pixel squared error averaged over channels (B, 1, H, W))
+    """
+    def __init__(self, netg, feat):
+        super(Scorer, self).__init__()
+        self.netg = getattr(netg, 'module', netg)
+        self.feat = getattr(feat, 'module', feat)
+
+    def forward(self, lap, res):
+        real = lap + res
+        fake_lap, fake_res = self.netg((lap, res))
+        fake = fake_lap + fake_res
+        error_map = torch.pow(real - fake, 2).mean(dim=1, keepdim=True)
+        lat = torch.pow(self.feat(real) - self.feat(fake), 2).flatten(1).mean(dim=1)
+        rec = error_map.flatten(1).mean(dim=1)
+        return 0.9 * rec + 0.1 * lat, error_map
+
+class ImageScorer(nn.Module):
+    """ Scorer of raw images normalized to [-1, 1], including the Laplacian split.
+
+    Args:
+        scorer (Scorer): Scorer of the (lap, res) planes.
+        nc (int): Image channels.
+
+    Returns (from forward):
+        [tuple]: (scores (B,), error maps (B, 1, H, W)), as Scorer.
+    """
+    def __init__(self, scorer, nc=3):
+        super(ImageScorer, self).__init__()
+        self.fd = FrequencyDecomposition(nc)
+        self.scorer = scorer
+
+    def forward(self, img):
+        lap, res = self.fd(img)
+        return self.scorer(lap, res)
+
+class OnnxScorer():
+    """ ONNX Runtime backend of a graph written by export_onnx().
+
+    Args:
+        path (str): .onnx file.
+        threads (int): Intra-op threads of the session. 0 lets ONNX Runtime use one per core.
+        batchsize (int): Images per session run; larger inputs are split. 0 runs whole inputs.
+
+    Returns (from __call__):
+        [tuple]: (scores (B,), error maps (B, 1, H, W)) as float CPU tensors.
+    """
+    def __init__(self, path, threads=0, batchsize=0):
+        import onnxruntime as ort
+
+        if not os.path.isfile(path):
+            raise IOError("Scorer %s not found" % path)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input = self.session.get_inputs()[0].name
+        self.batchsize = batchsize
+
+    def __call__(self, img):
+        img = np.ascontiguousarray(img.detach().cpu().numpy() if torch.is_tensor(img) else img, dtype=np.float32)
+        step = self.batchsize if self.batchsize > 0 else len(img)
+        outputs = [self.session.run(None, {self.input: img[i:i + step]}) for i in range(0, len(img), step)]
+        scores = np.concatenate([output[0] for output in outputs])
+        error_maps = np.concatenate([output[1] for output in outputs])
+        return torch.from_numpy(scores), torch.from_numpy(error_maps)
+
+##
+def build_scorer(opt, netg_path, netd_path):
+    """ Float CPU Scorer from netG/netD checkpoints, without Ocr_Gan_Aug.
+
+    Args:
+        opt ([type]): Argument Parser. isize, nc, nz, ngf, ndf, extralayers and netg_arch are used.
+        netg_path (str): netG checkpoint (netG_best.pth).
+        netd_path (str): netD checkpoint (netD_best.pth).
+
+    Raises:
+        IOError: Checkpoint not found.
+
+    Returns:
+        [Scorer]: Scorer in eval mode.
+    """
+    opt = copy.copy(opt)
+    opt.gpu_ids, opt.checkpoint_levels = [], 0
+    netg = define_G(opt, norm='batch', use_dropout=False, init_type='normal')
+    netd = define_D(opt, norm='batch', use_sigmoid=False, init_type='normal')
+    for net, path in ((netg, netg_path), (netd, netd_path)):
+        if not os.path.isfile(path):
+            raise IOError("%s not found" % path)
+        checkpoint = torch.load(path, map_location='cpu')
+        state_dict = strip_module_prefix(checkpoint['state_dict'])
+        if net is netg:
+            # Generators written by prune.py record their channel counts.
+            if 'widths' in checkpoint:
+                set_generator_widths(netg, checkpoint['widths'])
+            state_dict = migrate_cs_state_dict(state_dict, netg)
+        net.load_state_dict(state_dict)
+    return Scorer(netg, netd.feat).eval()
+
+##
+def calibration_batches(model, num):
+    """ First `num` (lap, res) batches of the train split, on the model device.
+
+    Args:
+        model (Ocr_Gan_Aug): Model whose train loader and set_input() provide the batches.
+        num (int): Number of batches.
+
+    Returns:
+        [list]: (lap, res) batches.
+    """
+    batches = []
+    for data in model.data.train:
+        model.set_input(data)
+        batches.append((model.input_lap.clone(), model.input_res.clone()))
+        if len(batches) == num:
+            break
+    return batches
+
+##
+def quantize_scorer(scorer, calib_batches, backend='x86'):
+    """ Post-training static int8 quantization of a Scorer, for CPU inference.
+
+    netG and netD.feat are quantized separately with torch.fx: conv and
+    transposed-conv layers (with BatchNorm folded in) and activations run in
+    int8, calibrated on `calib_batches`. The CS attention blocks and the score
+    computation stay in float32.
+
+    Args:
+        scorer (Scorer): Float scorer. Not modified.
+        calib_batches (list): (lap, res) CPU batches of normal images.
+        backend (str): Quantized engine: x86 | fbgemm | qnnpack.
+
+    Returns:
+        [Scorer]: Quantized CPU scorer.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    torch.backends.quantized.engine = backend
+    scorer = copy.deepcopy(scorer).cpu().eval()
+    qconfig_mapping = get_default_qconfig_mapping(backend).set_module_name_regex(r'(.*\.)?cs(\..*)?', None)
+    example = calib_batches[0]
+    netg = prepare_fx(scorer.netg, qconfig_mapping, example_inputs=(example,))
+    feat = prepare_fx(scorer.feat, qconfig_mapping, example_inputs=(example[0] + example[1],))
+    with torch.no_grad():
+        for lap, res in calib_batches:
+            fake_lap, fake_res = netg((lap, res))
+            feat(lap + res)
+            feat(fake_lap + fake_res)
+    return Scorer(convert_fx(netg), convert_fx(feat)).eval()
+
+##
+def save_scorer(scorer, path, example):
+    """ Save a Scorer as TorchScript, loadable without the model code.
+
+    Args:
+        scorer (Scorer): Scorer to save.
+        path (str): Output .pt file.
+        example (tuple): (lap, res) batch used for tracing.
+    """
+    with torch.no_grad():
+        traced = torch.jit.trace(scorer, example, check_trace=False)
+    torch.jit.save(traced, path)
+
+##
+def export_onnx(scorer, path, example, opset=17):
+    """ Export an ImageScorer to ONNX, with a dynamic batch axis.
+
+    The graph takes `image` (B, nc, isize, isize) normalized to [-1, 1] and
+    returns `score` (B,) and `error_map` (B, 1, isize, isize).
+
+    Args:
+        scorer (ImageScorer): Float scorer in eval mode.
+        path (str): Output .onnx file.
+        example (FloatTensor): Image batch used for tracing.
+        opset (int): ONNX opset version.
+    """
+    with torch.no_grad():
+        torch.onnx.export(scorer, (example,), path, opset_version=opset,
+                          input_names=['image'], output_names=['score', 'error_map'],
+                          dynamic_axes={'image': {0: 'batch'}, 'score': {0: 'batch'}, 'error_map': {0: 'batch'}})
+
+##
+def load_scorer(path):
+    """ Load a scorer saved by save_scorer() (TorchScript .pt).
+
+    Args:
+        path (str): Scorer file.
+
+    Returns:
+        [callable]: (lap, res) CPU batches -> (scores, error maps).
+    """
+    if not os.path.isfile(path):
+        raise IOError("Scorer %s not found" % path)
+    return torch.jit.load(path, map_location='cpu').eval()
+
+##
+def evaluate_scorer(model, scorer, device='cpu'):
+    """ AUC and latency of a scorer on the test split of an Ocr_Gan_Aug model.
+
+    Args:
+        model (Ocr_Gan_Aug): Model whose valid loader and set_input() provide the batches.
+        scorer (callable): (lap, res) -> (scores, error maps).
+        device (str): Device the scorer runs on.
+
+    Returns:
+        [tuple]: (AUC, ms/batch, scores)
+    """
+    scores, labels, times = [], [], []
+    with torch.no_grad():
+        for data in model.data.valid:
+            model.set_input(data)
+            lap, res = model.input_lap.to(device), model.input_res.to(device)
+            time_i = time.time()
+            score = scorer(lap, res)[0].float().cpu()
+            time_o = time.time()
+            times.append(time_o - time_i)
+            scores.append(score)
+            # set_input overwrites model.gt in place, and .cpu() of a CPU tensor is the tensor itself.
+            labels.append(model.gt.detach().clone().cpu())
+    scores, labels = torch.cat(scores), torch.cat(labels)
+    return roc(labels, scores), np.mean(times) * 1000, scores
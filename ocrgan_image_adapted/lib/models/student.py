@@ -0,0 +1,97 @@
+""" Student
+
+Small CNN distilled from the Scorer (netG + netD.feat) for low-latency CPU scoring.
+"""
+
+# pylint: disable=C0301,E1101,W0622,C0103,R0902,R0915
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from tqdm import tqdm
+
+class StudentScorer(nn.Module):
+    """ Regresses the score and error map of the teacher Scorer from (lap, res).
+
+    A stack of `depth` stride-2 3x3 conv/BN/ReLU layers (width, 2*width, then
+    4*width) reads the concatenated planes. A 1x1 conv predicts the log error
+    map at 1/2**depth resolution, upsampled bilinearly to the input size, and a
+    linear layer on the pooled features predicts the log score. Same call
+    signature and outputs as Scorer, so it is saved and loaded with
+    save_scorer / load_scorer.
+
+    Args:
+        nc (int): Image channels.
+        width (int): Channels of the first layer.
+        depth (int): Number of stride-2 layers.
+
+    Returns (from forward):
+        [tuple]: (scores (B,), error maps (B, 1, H, W))
+    """
+    def __init__(self, nc=3, width=16, depth=4):
+        super(StudentScorer, self).__init__()
+        layers = []
+        in_nc = 2 * nc
+        for i in range(depth):
+            out_nc = width * 2 ** min(i, 2)
+            layers += [nn.Conv2d(in_nc, out_nc, 3, 2, 1, bias=False), nn.BatchNorm2d(out_nc), nn.ReLU(True)]
+            in_nc = out_nc
+        self.features = nn.Sequential(*layers)
+        self.map_head = nn.Conv2d(in_nc, 1, 1)
+        self.gap = nn.AdaptiveAvgPool2d(1)
+        self.score_head = nn.Linear(in_nc, 1)
+
+    def forward_log(self, lap, res):
+        """ (log scores, log error maps). """
+        x = self.features(torch.cat([lap, res], 1))
+        log_map = F.interpolate(self.map_head(x), size=lap.shape[2:], mode='bilinear', align_corners=False)
+        log_score = self.score_head(self.gap(x).flatten(1)).squeeze(1)
+        return log_score, log_map
+
+    def forward(self, lap, res):
+        log_score, log_map = self.forward_log(lap, res)
+        return log_score.exp(), log_map.exp()
+
+##
+def distill(student, teacher, model, epochs=10, lr=1e-3, w_map=1., eps=1e-8):
+    """ Train a StudentScorer on the teacher outputs over the train split (normal images only, labels unused).
+
+    Scores and error maps span several orders of magnitude, so the student
+    regresses their logarithms with an L2 loss:
+        loss = |log s - log t_s|^2 + w_map * mean |log m - log t_m|^2
+
+    Args:
+        student (StudentScorer): Student, on the model device.
+        teacher (Scorer): Float teacher in eval mode, on the model device.
+        model (Ocr_Gan_Aug): Model whose train loader and set_input() provide the batches.
+        epochs (int): Passes over the train split.
+        lr (float): Adam learning rate, decayed to zero with a cosine schedule.
+        w_map (float): Weight of the error map loss.
+        eps (float): Added to the teacher outputs before the logarithm.
+
+    Returns:
+        [float]: Loss of the last epoch.
+    """
+    optimizer = torch.optim.Adam(student.parameters(), lr=lr)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=max(epochs * len(model.data.train), 1))
+    teacher.eval()
+    student.train()
+    for epoch in range(epochs):
+        total, count = 0., 0
+        for data in tqdm(model.data.train, leave=False, total=len(model.data.train)):
+            model.set_input(data)
+            lap, res = model.input_lap, model.input_res
+            with torch.no_grad():
+                t_score, t_map = teacher(lap, res)
+            log_score, log_map = student.forward_log(lap, res)
+            loss = F.mse_loss(log_score, torch.log(t_score.float() + eps)) + \
+                   w_map * F.mse_loss(log_map, torch.log(t_map.float() + eps))
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
+            total += loss.item() * lap.size(0)
+            count += lap.size(0)
+        print("   Distillation epoch %d/%d: loss %.4f" % (epoch + 1, epochs, total / max(count, 1)))
+    student.eval()
+    return total / max(count, 1)
@@ -0,0 +1,146 @@
+"""
+TILED INFERENCE
+"""
+
+# pylint: disable=C0301,E1101,W0622,C0103,R0902,R0915
+
+import torch
+import torch.nn.functional as F
+
+from lib.data.datasets import cv2_loader
+from lib.models.networks import FrequencyDecomposition
+
+##
+def tile_starts(size, tile, stride):
+    """ Offsets of the tiles covering `size` pixels; the last tile ends at the border. """
+    if size <= tile:
+        return [0]
+    starts = list(range(0, size - tile + 1, stride))
+    if starts[-1] != size - tile:
+        starts.append(size - tile)
+    return starts
+
+##
+def blend_window(tile, blend):
+    """ Per-pixel weight of a tile in the stitched map.
+
+    mean: uniform, hann: raised cosine vanishing towards the tile borders (but
+    never zero, so border pixels covered by a single tile keep their value),
+    max: uniform, the stitched map keeps the largest error instead of averaging.
+    """
+    if blend == 'hann':
+        w = torch.hann_window(tile + 2, periodic=False)[1:-1]
+        return w[:, None] * w[None, :]
+    return torch.ones(tile, tile)
+
+##
+def load_tiled_image(path, tile):
+    """ Image normalized to [-1, 1] as (nc, H, W), padded by replication to at least tile x tile.
+
+    Channels are in the order of the training datasets (cv2.imread).
+
+    Returns:
+        [tuple]: (image, (H, W) before padding)
+    """
+    img = torch.from_numpy(cv2_loader(path)).permute(2, 0, 1).float().div_(127.5).sub_(1.)
+    h, w = img.shape[1:]
+    if h < tile or w < tile:
+        img = F.pad(img[None], (0, max(tile - w, 0), 0, max(tile - h, 0)), mode='replicate')[0]
+    return img, (h, w)
+
+##
+def iter_tiles(paths, tile, stride):
+    """ Lazily yield the tiles of the images in `paths`, one decoded image at a time.
+
+    Yields:
+        [tuple]: (image index, y, x, tile (nc, tile, tile), padded size, size before padding, number of tiles of the image)
+    """
+    for index, path in enumerate(paths):
+        img, size = load_tiled_image(path, tile)
+        ys, xs = tile_starts(img.size(1), tile, stride), tile_starts(img.size(2), tile, stride)
+        for y in ys:
+            for x in xs:
+                yield index, y, x, img[:, y:y + tile, x:x + tile], tuple(img.shape[1:]), size, len(ys) * len(xs)
+
+class TiledScorer():
+    """ Score full-resolution images by overlapping isize tiles.
+
+    Tiles of consecutive images are scored together in batches of `batchsize`.
+    The per-pixel errors of the tiles are stitched into a map of the image
+    size with blend_window(), and the tile scores aggregated per image: the
+    largest one (max) or the mean of the `topk` largest (topk). Memory is
+    bounded by one batch of tiles, one decoded image, and the maps of the
+    images with tiles in the current batch.
+
+    Args:
+        scorer (callable): (lap, res) -> (scores, error maps), e.g. Scorer.
+        isize (int): Tile size, the input size of the networks.
+        device (torch.device): Device of the scorer.
+        stride (int): Tile stride. isize // 2 by default.
+        batchsize (int): Tiles per scorer call.
+        blend (str): mean | hann | max.
+        agg (str): max | topk.
+        topk (int): Tiles averaged by the topk aggregation.
+        nc (int): Image channels.
+    """
+    def __init__(self, scorer, isize, device, stride=0, batchsize=64, blend='hann', agg='max', topk=3, nc=3):
+        self.scorer = scorer
+        self.isize = isize
+        self.device = torch.device(device)
+        self.stride = stride if stride > 0 else isize // 2
+        self.batchsize = batchsize
+        self.blend = blend
+        self.window = blend_window(isize, blend)
+        self.agg = agg
+        self.topk = topk
+        self.fd = FrequencyDecomposition(nc).to(self.device)
+
+    def aggregate(self, scores):
+        """ Image score from its tile scores. """
+        scores = torch.stack(scores)
+        if self.agg == 'topk':
+            return scores.topk(min(self.topk, len(scores)))[0].mean()
+        return scores.max()
+
+    def score(self, paths):
+        """ Score images.
+
+        Args:
+            paths (list): Image files.
+
+        Yields:
+            [tuple]: (image index, score, error map (H, W)), in the order of `paths`.
+        """
+        pending = {}
+        batch = []
+        for item in iter_tiles(paths, self.isize, self.stride):
+            batch.append(item)
+            if len(batch) == self.batchsize:
+                yield from self._run(batch, pending)
+                batch = []
+        if batch:
+            yield from self._run(batch, pending)
+
+    def _run(self, batch, pending):
+        """ Score a batch of tiles and yield the images it completes. """
+        tiles = torch.stack([item[3] for item in batch]).to(self.device)
+        with torch.no_grad():
+            scores, maps = self.scorer(*self.fd(tiles))
+        scores, maps = scores.float().cpu(), maps.float().cpu()[:, 0]
+        t = self.isize
+        for (index, y, x, _, padded, size, num), score, error_map in zip(batch, scores, maps):
+            if index not in pending:
+                fill = -float('inf') if self.blend == 'max' else 0.
+                pending[index] = {'sum': torch.full(padded, fill), 'weight': torch.zeros(padded), 'scores': [], 'left': num}
+            entry = pending[index]
+            if self.blend == 'max':
+                torch.max(entry['sum'][y:y + t, x:x + t], error_map, out=entry['sum'][y:y + t, x:x + t])
+            else:
+                entry['sum'][y:y + t, x:x + t] += error_map * self.window
+                entry['weight'][y:y + t, x:x + t] += self.window
+            entry['scores'].append(score)
+            entry['left'] -= 1
+            if entry['left'] == 0:
+                del pending[index]
+                stitched = entry['sum'] if self.blend == 'max' else entry['sum'] / entry['weight']
+                yield index, self.aggregate(entry['scores']).item(), stitched[:size[0], :size[1]]
@@ -10,6 +10,8 @@ import time
 import numpy as np
 import torchvision.utils as vutils
 
+from lib.distributed import is_main_process
+
 ##
 class Visualizer():
     """ Visualizer wrapper based on Visdom.
@@ -40,13 +42,16 @@ class Visualizer():
         # Path to train and test directories.
         self.img_dir = os.path.join(opt.outf, opt.name, 'train', 'images')
         self.tst_img_dir = os.path.join(opt.outf, opt.name, 'test', 'images')
+        self.log_name = os.path.join(opt.outf, opt.name, 'loss_log.txt')
+        # Only rank 0 of multi-process training writes images and logs.
+        if not is_main_process(opt):
+            return
         if not os.path.exists(self.img_dir):
             os.makedirs(self.img_dir)
         if not os.path.exists(self.tst_img_dir):
             os.makedirs(self.tst_img_dir)
         # --
         # Log file.
-        self.log_name = os.path.join(opt.outf, opt.name, 'loss_log.txt')
         # with open(self.log_name, "a") as log_file:
         #     now = time.strftime("%c")
         #     log_file.write('================ Training Loss (%s) ================\n' % now)
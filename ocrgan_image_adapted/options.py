@@ -2,6 +2,8 @@ import argparse
 import os
 import torch
 
+from lib.distributed import init_distributed, is_main_process, barrier
+
 class Options():
     """Options class
 
@@ -21,16 +23,31 @@ class Options():
         self.parser.add_argument('--path', default='', help='path to the folder or image to be predicted.')
         self.parser.add_argument('--batchsize', type=int, default=32, help='input batch size')
         self.parser.add_argument('--workers', type=int, help='number of data loading workers', default=8)
+        self.parser.add_argument('--prefetch_factor', type=int, default=2, help='number of batches loaded in advance by each worker')
+        self.parser.add_argument('--loader_autotune', action='store_true', help='benchmark worker/prefetch settings on the first batches and keep the fastest.')
+        self.parser.add_argument('--autotune_batches', type=int, default=20, help='number of batches timed per --loader_autotune candidate')
+        self.parser.add_argument('--shm_cache_mb', type=int, default=0, help='size in MB of the decoded-image LRU cache shared by all loader workers. 0 disables it.')
+        self.parser.add_argument('--shm_cache_size', type=int, default=0, help='shorter side of the images kept in the shared cache. 0 keeps the full resolution.')
+        self.parser.add_argument('--batch_aug', type=str, default='off', choices=['off', 'cpu', 'device'], help='CutPaste/Cutout per sample in the dataset | per batch after collation | per batch on the model device.')
+        self.parser.add_argument('--data_format', type=str, default='folder', choices=['folder', 'packed'], help='image tree | single-file packs written by data_creation/pack_dataset.py')
+        self.parser.add_argument('--fd_mode', type=str, default='cv2', choices=['cv2', 'torch', 'fused'], help='lap/res split: per sample with OpenCV in the dataset | batched on the model device | per sample, decoded and resized once to isize.')
+        self.parser.add_argument('--manifest', action='store_true', help='list images through <split>.manifest.json next to each split, rescanning only changed directories.')
+        self.parser.add_argument('--host_dtype', type=str, default='float32', choices=['float32', 'uint8'], help='images produced by the loaders: normalized float32 | raw uint8, normalized on the model device.')
+        self.parser.add_argument('--fd_cache', default='', help='directory of the on-disk lap/res plane cache. Disabled if empty.')
         self.parser.add_argument('--droplast', action='store_true', default=True, help='Drop last batch size.')
         self.parser.add_argument('--isize', type=int, default=32, help='input image size.')
         self.parser.add_argument('--nc', type=int, default=3, help='input image channels')
         self.parser.add_argument('--nz', type=int, default=100, help='size of the latent z vector')
         self.parser.add_argument('--ngf', type=int, default=64)
         self.parser.add_argument('--ndf', type=int, default=64)
+        self.parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help='precision of the netG/netD forward passes. bf16 runs them under autocast; losses and weights stay float32.')
+        self.parser.add_argument('--netg_arch', type=str, default='cs', choices=['cs', 'cs_grouped'], help='generator: UnetGenerator_CS | UnetGenerator_CS_Grouped, both branches as groups=2 convolutions. Checkpoints load into either.')
+        self.parser.add_argument('--checkpoint_levels', type=int, default=0, help='number of outermost generator levels trained with activation checkpointing (recomputed in the backward pass). -1 for all levels.')
         self.parser.add_argument('--extralayers', type=int, default=0, help='Number of extra layers on gen and disc')
         self.parser.add_argument('--device', type=str, default='gpu', help='Device: gpu | cpu')
         self.parser.add_argument('--gpu_ids', type=str, default='0', help='gpu ids: e.g. 0  0,1,2, 0,2. use -1 for CPU')
-        self.parser.add_argument('--ngpu', type=int, default=1, help='number of GPUs to use')
+        self.parser.add_argument('--num_threads', type=int, default=0, help='intra-op threads of torch (torch.set_num_threads). 0 keeps the default, or the share of the cores of each torchrun process.')
+        self.parser.add_argument('--dist_backend', type=str, default='gloo', choices=['gloo', 'nccl'], help='torch.distributed backend of multi-process training (train.py launched by torchrun). gloo runs on CPU.')
         self.parser.add_argument('--name', type=str, default='experiment_name', help='name of the experiment')
         self.parser.add_argument('--model', type=str, default='ocr_gan_aug', help='chooses which model to use. ganomaly')
         self.parser.add_argument('--display_server', type=str, default="http://localhost", help='visdom server of the web display')
@@ -52,7 +69,9 @@ class Options():
         self.parser.add_argument('--print_freq', type=int, default=100, help='frequency of showing training results on console')
         self.parser.add_argument('--save_image_freq', type=int, default=100, help='frequency of saving real and fake images')
         self.parser.add_argument('--save_test_images', action='store_true', help='Save test images for demo.')
+        self.parser.add_argument('--pixel_eval', action='store_true', help='compute pixel AUROC and PRO of the error maps against the masks in <dataroot>/ground_truth (data_creation scripts with --keep_masks), with folders or packs.')
         self.parser.add_argument('--load_weights', action='store_true', help='Load the pretrained weights')
+        self.parser.add_argument('--scorer', default='', help='TorchScript scorer written by quantize.py. test() then computes the scores with it on the CPU instead of netG/netD.')
         self.parser.add_argument('--resume', default='', help="path to checkpoints (to continue training)")
         self.parser.add_argument('--phase', type=str, default='train', help='train, val, test, etc')
         self.parser.add_argument('--iter', type=int, default=0, help='Start from iteration i')
@@ -63,6 +82,11 @@ class Options():
         self.parser.add_argument('--w_adv', type=float, default=1, help='Weight for adversarial loss. default=1')
         self.parser.add_argument('--w_con', type=float, default=50, help='Weight for reconstruction loss. default=50')
         self.parser.add_argument('--w_lat', type=float, default=1, help='Weight for latent space loss. default=1')
+        self.parser.add_argument('--micro_batch', type=int, default=0, help='samples per forward/backward pass; gradients of the micro-batches of a batch are accumulated. 0 uses the whole batch.')
+        self.parser.add_argument('--accum_steps', type=int, default=1, help='loader batches of batchsize / accum_steps accumulated into one optimizer step.')
+        self.parser.add_argument('--probe_batchsize', action='store_true', help='before training, time synthetic steps at growing batch sizes and train with the largest one that fits --probe_budget_mb and raises throughput.')
+        self.parser.add_argument('--probe_budget_mb', type=int, default=0, help='memory budget of --probe_batchsize in MB. 0 uses 90%% of the device memory (CUDA) or of the available RAM (CPU).')
+        self.parser.add_argument('--probe_max_batchsize', type=int, default=512, help='largest batch size tried by --probe_batchsize')
         self.parser.add_argument('--lr_policy', type=str, default='lambda', help='lambda|step|plateau')
         self.parser.add_argument('--lr_decay_iters', type=int, default=50, help='multiply by a gamma every lr_decay_iters iterations')
         self.isTrain = True
@@ -75,20 +99,31 @@ class Options():
         self.opt = self.parser.parse_args()
         self.opt.isTrain = self.isTrain   # train or test
 
-        str_ids = self.opt.gpu_ids.split(',')
+        assert self.opt.batchsize % self.opt.accum_steps == 0, "batchsize has to be a multiple of accum_steps"
+
+        str_ids = self.opt.gpu_ids.split(',') if self.opt.device != 'cpu' else []
         self.opt.gpu_ids = []
         for str_id in str_ids:
             id = int(str_id)
             if id >= 0:
                 self.opt.gpu_ids.append(id)
 
+        # Under torchrun, join the process group; every process then uses
+        # cuda:<local rank> (or its share of the CPU cores).
+        init_distributed(self.opt)
+        # Every process would time its own probe and could pick another batch size.
+        assert not (self.opt.probe_batchsize and self.opt.distributed), \
+            "--probe_batchsize is single-process; under torchrun set --batchsize (per process) instead"
+        if self.opt.num_threads > 0:
+            torch.set_num_threads(self.opt.num_threads)
+
         # set gpu ids
         if len(self.opt.gpu_ids) > 0:
             torch.cuda.set_device(self.opt.gpu_ids[0])
 
         args = vars(self.opt)
 
-        if self.opt.verbose:
+        if self.opt.verbose and is_main_process(self.opt):
             print('------------ Options -------------')
             for k, v in sorted(args.items()):
                 print('%s: %s' % (str(k), str(v)))
@@ -100,15 +135,22 @@ class Options():
         expr_dir = os.path.join(self.opt.outf, self.opt.name, 'train')
         test_dir = os.path.join(self.opt.outf, self.opt.name, 'test')
 
-        if not os.path.isdir(expr_dir):
-            os.makedirs(expr_dir)
-        if not os.path.isdir(test_dir):
-            os.makedirs(test_dir)
+        if is_main_process(self.opt):
+            if not os.path.isdir(expr_dir):
+                os.makedirs(expr_dir)
+            if not os.path.isdir(test_dir):
+                os.makedirs(test_dir)
+            save_options(self.opt)
+        barrier(self.opt)
+        return self.opt
 
-        file_name = os.path.join(expr_dir, 'opt.txt')
-        with open(file_name, 'wt') as opt_file:
-            opt_file.write('------------ Options -------------\n')
-            for k, v in sorted(args.items()):
-                opt_file.write('%s: %s\n' % (str(k), str(v)))
-            opt_file.write('-------------- End ----------------\n')
-        return self.opt
\ No newline at end of file
+##
+def save_options(opt):
+    """ Write the options to <outf>/<name>/train/opt.txt.
+    """
+    file_name = os.path.join(opt.outf, opt.name, 'train', 'opt.txt')
+    with open(file_name, 'wt') as opt_file:
+        opt_file.write('------------ Options -------------\n')
+        for k, v in sorted(vars(opt).items()):
+            opt_file.write('%s: %s\n' % (str(k), str(v)))
+        opt_file.write('-------------- End ----------------\n')
\ No newline at end of file
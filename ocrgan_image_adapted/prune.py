@@ -0,0 +1,97 @@
+"""
+CHANNEL PRUNING
+
+Usage: python prune.py --dataset <class> [train/test options] [--prune_ratios 0.25,0.5,0.75]
+
+Prunes the down/up convolution channels of every level of a trained
+UnetGenerator_CS, ranked by CS attention statistics and weight norms (see
+lib/models/pruning.py: cs_channel_importance), fine-tunes the pruned model for
+--finetune_epochs and writes netG_pruned_<ratio>.pth / netD_pruned_<ratio>.pth.
+Prints MACs, parameters, test run time and AUC for every ratio, next to the
+unpruned model.
+"""
+
+import os
+
+import torch
+import torch.optim as optim
+
+from options import Options
+from lib.data.dataloader import load_data_FD_aug
+from lib.models import load_model
+from lib.models.networks import get_scheduler, migrate_cs_state_dict, strip_module_prefix
+from lib.models.pruning import cs_channel_importance, select_channels, prune_generator, generator_widths, set_generator_widths, count_flops
+from lib.models.scorer import calibration_batches
+
+##
+def load_checkpoints(model, netg_path, netd_path):
+    """ Load netG/netD checkpoints into an Ocr_Gan_Aug model. """
+    for path in (netg_path, netd_path):
+        if not os.path.isfile(path):
+            raise IOError("%s not found" % path)
+    checkpoint = torch.load(netg_path, map_location=model.device)
+    if 'widths' in checkpoint:
+        set_generator_widths(model.netg, checkpoint['widths'])
+    model.netg.load_state_dict(migrate_cs_state_dict(strip_module_prefix(checkpoint['state_dict']), model.netg))
+    model.netd.load_state_dict(strip_module_prefix(torch.load(netd_path, map_location=model.device)['state_dict']))
+
+##
+def main():
+    """ Prune, fine-tune and evaluate the generator at every ratio.
+    """
+    parser = Options().parser
+    parser.add_argument('--netg', default='', help='netG checkpoint. Default: <outf>/<name>/train/weights/netG_best.pth')
+    parser.add_argument('--netd', default='', help='netD checkpoint. Default: <outf>/<name>/train/weights/netD_best.pth')
+    parser.add_argument('--prune_ratios', default='0.25,0.5,0.75', help='comma-separated fractions of the channels of every level to remove')
+    parser.add_argument('--prune_batches', type=int, default=16, help='number of train batches used to collect CS attention statistics')
+    parser.add_argument('--finetune_epochs', type=int, default=1, help='training epochs after pruning')
+    opt = parser.parse_args()
+    opt.isTrain = True
+    opt.gpu_ids = [int(i) for i in opt.gpu_ids.split(',') if int(i) >= 0] if opt.device != 'cpu' else []
+    # Checkpoints of either architecture load into UnetGenerator_CS, the one pruned here.
+    opt.netg_arch, opt.load_weights, opt.scorer = 'cs', False, ''
+    if opt.name == 'experiment_name':
+        opt.name = "%s/%s" % (opt.model, opt.dataset)
+    weights = os.path.join(opt.outf, opt.name, 'train', 'weights')
+    opt.netg = opt.netg or os.path.join(weights, 'netG_best.pth')
+    opt.netd = opt.netd or os.path.join(weights, 'netD_best.pth')
+    ratios = [0.] + [float(r) for r in opt.prune_ratios.split(',')]
+
+    data = load_data_FD_aug(opt, opt.dataset)
+    importance, results = None, {}
+    for ratio in ratios:
+        model = load_model(opt, data, opt.dataset)
+        load_checkpoints(model, opt.netg, opt.netd)
+        batches = calibration_batches(model, opt.prune_batches)
+        if importance is None:
+            importance = cs_channel_importance(model.netg, batches)
+
+        if ratio > 0:
+            print(">> Pruning %.0f%% of the generator channels." % (ratio * 100))
+            prune_generator(model.netg, select_channels(importance, ratio))
+            model.optimizer_g = optim.Adam(model.netg.parameters(), lr=opt.lr, betas=(opt.beta1, 0.999))
+            model.optimizers = [model.optimizer_d, model.optimizer_g]
+            model.schedulers = [get_scheduler(optimizer, opt) for optimizer in model.optimizers]
+            model.total_steps = 0
+            for model.epoch in range(opt.finetune_epochs):
+                model.train_one_epoch()
+            torch.save({'epoch': opt.finetune_epochs, 'state_dict': model.netg.state_dict(), 'widths': generator_widths(model.netg)},
+                       os.path.join(weights, 'netG_pruned_%g.pth' % ratio))
+            torch.save({'epoch': opt.finetune_epochs, 'state_dict': model.netd.state_dict()},
+                       os.path.join(weights, 'netD_pruned_%g.pth' % ratio))
+
+        macs, params = count_flops(model.netg, (batches[0],))
+        model.seed(opt.manualseed)
+        performance = model.test(plot_hist=False)
+        results[ratio] = (macs, params, performance['Avg Run Time (ms/batch)'], performance['AUC'])
+        del model
+
+    base = results[0.]
+    print("ratio  GMACs/img     params   ms/batch       AUC")
+    for ratio, (macs, params, ms, auc) in results.items():
+        print("%5.2f  %9.2f %10d %10.2f    %.4f  (MACs %5.1f%%, params %5.1f%%, time %5.1f%%, AUC %+.4f)" %
+              (ratio, macs / 1e9, params, ms, auc, 100. * macs / base[0], 100. * params / base[1], 100. * ms / base[2], auc - base[3]))
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+INT8 QUANTIZATION
+
+Usage: python quantize.py --dataset <class> [train/test options] [--netg PATH] [--netd PATH]
+
+Quantizes the inference path of a trained Ocr_Gan_Aug model (netG and netD.feat)
+to int8 for CPU inference. The model is calibrated on --calib_batches batches of
+the train split (normal images), then the float and int8 scorers are evaluated
+on the same test split. The int8 scorer is saved as TorchScript, for
+`test.py --scorer <file>`.
+"""
+
+import os
+
+import torch
+
+from options import Options
+from lib.data.dataloader import load_data_FD_aug
+from lib.models import load_model
+from lib.models.scorer import build_scorer, calibration_batches, quantize_scorer, save_scorer, load_scorer, evaluate_scorer
+
+##
+def main():
+    """ Quantize, evaluate and save the scorer.
+    """
+    parser = Options().parser
+    parser.add_argument('--netg', default='', help='netG checkpoint. Default: <outf>/<name>/train/weights/netG_best.pth')
+    parser.add_argument('--netd', default='', help='netD checkpoint. Default: <outf>/<name>/train/weights/netD_best.pth')
+    parser.add_argument('--calib_batches', type=int, default=16, help='number of train batches used for calibration')
+    parser.add_argument('--quant_backend', type=str, default='x86', choices=['x86', 'fbgemm', 'qnnpack'], help='quantized engine: x86/fbgemm for Intel/AMD, qnnpack for ARM')
+    parser.add_argument('--scorer_out', default='', help='output TorchScript file. Default: <outf>/<name>/train/weights/netScorer_int8.pt')
+    opt = parser.parse_args()
+    opt.isTrain = True
+    opt.device, opt.gpu_ids = 'cpu', []
+    opt.precision, opt.scorer = 'fp32', ''
+    if opt.name == 'experiment_name':
+        opt.name = "%s/%s" % (opt.model, opt.dataset)
+    weights = os.path.join(opt.outf, opt.name, 'train', 'weights')
+    opt.netg = opt.netg or os.path.join(weights, 'netG_best.pth')
+    opt.netd = opt.netd or os.path.join(weights, 'netD_best.pth')
+    opt.scorer_out = opt.scorer_out or os.path.join(weights, 'netScorer_int8.pt')
+    torch.manual_seed(opt.manualseed)
+
+    data = load_data_FD_aug(opt, opt.dataset)
+    model = load_model(opt, data, opt.dataset)
+    scorer = build_scorer(opt, opt.netg, opt.netd)
+
+    print(">> Calibrating on %d train batches (%s)." % (opt.calib_batches, opt.quant_backend))
+    calib = calibration_batches(model, opt.calib_batches)
+    qscorer = quantize_scorer(scorer, calib, opt.quant_backend)
+
+    results = {}
+    for name, net in (('fp32', scorer), ('int8', qscorer)):
+        auc, ms, _ = evaluate_scorer(model, net)
+        results[name] = (auc, ms)
+        print("%5s: AUC %.4f  %8.2f ms/batch" % (name, auc, ms))
+    print("AUC delta (int8 - fp32): %+.4f, speedup %.2fx" %
+          (results['int8'][0] - results['fp32'][0], results['fp32'][1] / results['int8'][1]))
+
+    save_scorer(qscorer, opt.scorer_out, calib[0])
+    auc, _, _ = evaluate_scorer(model, load_scorer(opt.scorer_out))
+    print(">> Saved %s (reloaded AUC %.4f)." % (opt.scorer_out, auc))
+    return results
+
+if __name__ == '__main__':
+    main()
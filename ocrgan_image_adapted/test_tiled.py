@@ -0,0 +1,73 @@
+"""
+TILED TEST
+
+Usage: python test_tiled.py --dataset <class> [test options] [--tile_stride S] [--tile_blend hann] [--tile_agg max]
+
+Scores the test split at full resolution: every image is cut into overlapping
+isize tiles instead of being squashed to isize (see lib/tiling.py:
+TiledScorer). Prints the AUC and images/s, and with --tile_save_maps writes
+the stitched error maps to <outf>/<name>/test/tiled_maps.
+"""
+
+import os
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from options import Options
+from lib.data.datasets import scan_split
+from lib.evaluate import roc
+from lib.models.scorer import build_scorer
+from lib.tiling import TiledScorer
+
+##
+def main():
+    """ Tiled scoring of the test split.
+    """
+    parser = Options().parser
+    parser.add_argument('--netg', default='', help='netG checkpoint. Default: <outf>/<name>/train/weights/netG_best.pth')
+    parser.add_argument('--netd', default='', help='netD checkpoint. Default: <outf>/<name>/train/weights/netD_best.pth')
+    parser.add_argument('--tile_stride', type=int, default=0, help='tile stride in pixels. 0: isize // 2')
+    parser.add_argument('--tile_batchsize', type=int, default=64, help='tiles per netG/netD batch, across images')
+    parser.add_argument('--tile_blend', type=str, default='hann', choices=['mean', 'hann', 'max'], help='stitching of overlapping tile errors: average | cosine-weighted average | maximum')
+    parser.add_argument('--tile_agg', type=str, default='max', choices=['max', 'topk'], help='image score: largest tile score | mean of the --tile_topk largest')
+    parser.add_argument('--tile_topk', type=int, default=3, help='tiles averaged by --tile_agg topk')
+    parser.add_argument('--tile_save_maps', action='store_true', help='save the stitched error maps as 16-bit PNGs')
+    opt = parser.parse_args()
+    opt.gpu_ids = []
+    if opt.name == 'experiment_name':
+        opt.name = "%s/%s" % (opt.model, opt.dataset)
+    if opt.dataroot == '':
+        opt.dataroot = './data/{}'.format(opt.dataset)
+    weights = os.path.join(opt.outf, opt.name, 'train', 'weights')
+    opt.netg = opt.netg or os.path.join(weights, 'netG_best.pth')
+    opt.netd = opt.netd or os.path.join(weights, 'netD_best.pth')
+    device = torch.device("cuda:0" if opt.device != 'cpu' else "cpu")
+
+    _, _, images = scan_split(os.path.join(opt.dataroot, 'test'), opt.manifest)
+    paths, labels = [path for path, _ in images], torch.tensor([target for _, target in images])
+    scorer = build_scorer(opt, opt.netg, opt.netd).to(device)
+    tiled = TiledScorer(scorer, opt.isize, device, opt.tile_stride, opt.tile_batchsize,
+                        opt.tile_blend, opt.tile_agg, opt.tile_topk, opt.nc)
+    dst = os.path.join(opt.outf, opt.name, 'test', 'tiled_maps')
+    if opt.tile_save_maps and not os.path.isdir(dst):
+        os.makedirs(dst)
+
+    print(">> Tiled scoring of %d images (tile %d, stride %d)." % (len(paths), opt.isize, tiled.stride))
+    scores = torch.zeros(len(paths))
+    time_i = time.time()
+    for index, score, error_map in tiled.score(paths):
+        scores[index] = score
+        if opt.tile_save_maps:
+            # Error maps are in [0, 4] (squared differences of [-1, 1] images).
+            png = (error_map.clamp(0., 4.) / 4. * 65535).numpy().astype(np.uint16)
+            cv2.imwrite(os.path.join(dst, '%05d.png' % index), png)
+    elapsed = time.time() - time_i
+    auc = roc(labels, scores)
+    print("   AUC %.4f  %.1f images/s" % (auc, len(paths) / elapsed))
+    return auc
+
+if __name__ == '__main__':
+    main()
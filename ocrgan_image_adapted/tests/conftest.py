@@ -0,0 +1,44 @@
+""" Run the tests from any directory with the package root on sys.path. """
+
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class FakeModel():
+    """ The parts of Ocr_Gan_Aug read by the scorer tools: loaders of (lap, res, gt)
+    batches, and set_input() writing into the same tensors every batch, as
+    BaseModel_Aug.set_input does.
+    """
+    def __init__(self, valid, train=()):
+        import torch
+        self.data = types.SimpleNamespace(valid=list(valid), train=list(train))
+        self.input_lap = torch.empty(0)
+        self.input_res = torch.empty(0)
+        self.gt = torch.empty(0, dtype=torch.long)
+
+    def set_input(self, data):
+        lap, res, gt = data
+        self.input_lap.resize_(lap.size()).copy_(lap)
+        self.input_res.resize_(res.size()).copy_(res)
+        self.gt.resize_(gt.size()).copy_(gt)
+
+@pytest.fixture
+def fake_model():
+    return FakeModel
+
+@pytest.fixture
+def captured_roc(monkeypatch):
+    """ Replace roc() of lib.models.scorer by one recording the labels and scores it gets. """
+    scorer_module = pytest.importorskip("lib.models.scorer")
+    seen = {}
+
+    def roc(labels, scores):
+        seen['labels'], seen['scores'] = labels.clone(), scores.clone()
+        return 0.5
+
+    monkeypatch.setattr(scorer_module, 'roc', roc)
+    return seen
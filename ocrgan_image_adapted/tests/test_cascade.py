@@ -0,0 +1,64 @@
+""" Tests of lib/models/cascade.py. """
+
+import math
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("numpy")
+from lib.models.cascade import CascadeScorer
+
+def first(lap, res):
+    return lap.abs().flatten(1).mean(1) + 0.1, None
+
+def full(lap, res):
+    # log(full) = 1.5 * log(first) + log(2): calibrate() must recover it exactly.
+    return 2. * first(lap, res)[0] ** 1.5, None
+
+class Recorder():
+    """ Stand-in full scorer returning -1, recording the images it scores. """
+    def __init__(self):
+        self.inputs = []
+
+    def __call__(self, lap, res):
+        self.inputs.append(lap.clone())
+        return -torch.ones(len(lap)), None
+
+def good_batches(num=4):
+    torch.manual_seed(0)
+    return [(torch.randn(8, 3, 8, 8), torch.randn(8, 3, 8, 8)) for _ in range(num)]
+
+def test_calibration_maps_stage1_to_full_scores():
+    calib = good_batches()
+    cascade = CascadeScorer(first, full, low=0.8, high=1.5).calibrate(calib)
+
+    assert cascade.a == pytest.approx(1.5, rel=1e-5)
+    assert cascade.b == pytest.approx(math.log(2.), rel=1e-5)
+    lap, res = torch.randn(8, 3, 8, 8) * 3, torch.randn(8, 3, 8, 8)
+    assert torch.allclose(cascade.stage1(lap, res), full(lap, res)[0], rtol=1e-4)
+
+    good = torch.cat([full(lap, res)[0] for lap, res in calib])
+    assert torch.allclose(cascade.good, good, rtol=1e-4)
+    assert cascade.low == pytest.approx(torch.quantile(good, 0.8).item(), rel=1e-4)
+    assert cascade.high == pytest.approx(1.5 * good.max().item(), rel=1e-4)
+    assert CascadeScorer(first, full).calibrate(calib).high == float('inf')
+
+def test_only_images_in_the_band_get_the_full_score():
+    cascade = CascadeScorer(first, full).calibrate(good_batches()).set_band(0.5, 3.)
+    cascade.full = recorder = Recorder()
+    # Contrasts from well below the good images to far above them.
+    lap = torch.randn(16, 3, 8, 8) * torch.linspace(0.1, 3., 16).view(16, 1, 1, 1)
+    res = torch.randn(16, 3, 8, 8)
+
+    stage1 = cascade.stage1(lap, res)
+    band = (stage1 >= cascade.low) & (stage1 <= cascade.high)
+    assert band.any() and not band.all()
+    scores, _ = cascade(lap, res)
+
+    assert torch.equal(scores[band], -torch.ones(int(band.sum())))
+    assert torch.allclose(scores[~band], stage1[~band])
+    assert len(recorder.inputs) == 1 and torch.equal(recorder.inputs[0], lap[band])
+    assert (cascade.escalated, cascade.seen) == (int(band.sum()), 16)
+
+    cascade.set_band(0.5, 3.)
+    assert (cascade.escalated, cascade.seen) == (0, 0)
@@ -0,0 +1,43 @@
+""" Tests of lib/data/dataloader.py. """
+
+import types
+
+import pytest
+
+pytest.importorskip("torch")
+Image = pytest.importorskip("PIL.Image")
+dataloader = pytest.importorskip("lib.data.dataloader")
+
+def test_shm_cache_slots_fit_the_largest_image(tmp_path):
+    sizes = [(32, 24)] * 20 + [(96, 80)]
+    imgs = []
+    for i, size in enumerate(sizes):
+        path = str(tmp_path / ("%02d.png" % i))
+        Image.new('RGB', size).save(path)
+        imgs.append((path, 0))
+    train = types.SimpleNamespace(imgs=imgs[:10], shm_cache=None)
+    valid = types.SimpleNamespace(imgs=imgs[10:], shm_cache=None)
+    opt = types.SimpleNamespace(shm_cache_mb=1, shm_cache_size=0)
+
+    dataloader.attach_shm_cache(opt, [train, valid])
+
+    # The largest image is the last one of the valid set.
+    assert train.shm_cache is valid.shm_cache
+    assert train.shm_cache.slot_bytes == 96 * 80 * 3
+
+def test_shm_cache_slots_come_from_the_manifest(tmp_path, monkeypatch):
+    from lib.data.datasets import ImageFolder
+
+    for i, size in enumerate([(32, 24), (96, 80), (40, 40)]):
+        (tmp_path / 'train' / 'good').mkdir(parents=True, exist_ok=True)
+        Image.new('RGB', size).save(str(tmp_path / 'train' / 'good' / ("%d.png" % i)))
+    train = ImageFolder(str(tmp_path / 'train'), manifest=True)
+    opt = types.SimpleNamespace(shm_cache_mb=1, shm_cache_size=0, manifest=True)
+
+    # No image header is read once the manifest is written.
+    def no_open(path):
+        raise AssertionError("header of %s read" % path)
+    monkeypatch.setattr(dataloader.Image, 'open', no_open)
+    dataloader.attach_shm_cache(opt, [train])
+
+    assert train.shm_cache.slot_bytes == 96 * 80 * 3
@@ -0,0 +1,40 @@
+""" Tests of lib/models/networks.py. """
+
+import pytest
+
+torch = pytest.importorskip("torch")
+ocr_gan_aug = pytest.importorskip("lib.models.ocr_gan_aug")
+from options import Options
+
+def make_model(tmp_path, netg_arch, checkpoint_levels):
+    opt = Options().parser.parse_args(['--device', 'cpu', '--isize', '32', '--ngf', '8', '--ndf', '8', '--nz', '16',
+                                       '--batchsize', '4', '--outf', str(tmp_path), '--name', 'test',
+                                       '--netg_arch', netg_arch, '--checkpoint_levels', str(checkpoint_levels)])
+    opt.isTrain, opt.gpu_ids = True, []
+    return ocr_gan_aug.Ocr_Gan_Aug(opt, None, 'test')
+
+def norm_stats(net):
+    return {name: buf.clone() for name, buf in net.named_buffers()
+            if name.endswith(('running_mean', 'running_var', 'num_batches_tracked'))}
+
+@pytest.mark.parametrize('netg_arch', ['cs', 'cs_grouped'])
+def test_checkpointing_updates_norm_stats_once(tmp_path, netg_arch):
+    plain = make_model(tmp_path, netg_arch, 0)
+    checkpointed = make_model(tmp_path, netg_arch, -1)
+    checkpointed.netg.load_state_dict(plain.netg.state_dict())
+    checkpointed.netd.load_state_dict(plain.netd.state_dict())
+
+    torch.manual_seed(0)
+    batch = tuple(torch.randn(4, 3, 32, 32) for _ in range(3)) + (torch.zeros(4, dtype=torch.long),)
+    for model in (plain, checkpointed):
+        model.set_input(batch)
+        model.noise.zero_()
+        model.optimize_params()
+
+    expected, stats = norm_stats(plain.netg), norm_stats(checkpointed.netg)
+    assert expected.keys() == stats.keys()
+    for name in expected:
+        if name.endswith('num_batches_tracked'):
+            assert torch.equal(stats[name], expected[name]), name
+        else:
+            assert torch.allclose(stats[name], expected[name], atol=1e-6), name
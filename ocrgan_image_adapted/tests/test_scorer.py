@@ -0,0 +1,60 @@
+""" Tests of lib/models/scorer.py. """
+
+import pytest
+
+torch = pytest.importorskip("torch")
+scorer_module = pytest.importorskip("lib.models.scorer")
+from lib.models.networks import define_G, define_D
+from options import Options
+
+def make_scorer():
+    opt = Options().parser.parse_args(['--device', 'cpu', '--isize', '32', '--ngf', '8', '--ndf', '8', '--nz', '16'])
+    opt.isTrain, opt.gpu_ids = True, []
+    torch.manual_seed(0)
+    netg, netd = define_G(opt), define_D(opt)
+    return scorer_module.Scorer(netg, netd.feat).eval()
+
+def batches(num, batchsize=4):
+    """ (lap, res) batches whose images differ in contrast, so that their scores spread. """
+    scale = torch.linspace(0.2, 2., num * batchsize).view(num, batchsize, 1, 1, 1)
+    return [(torch.randn(batchsize, 3, 32, 32) * s, torch.randn(batchsize, 3, 32, 32) * s) for s in scale]
+
+def quantized_engine():
+    engines = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in engines:
+            return engine
+    pytest.skip("no quantized engine")
+
+def test_evaluate_scorer_keeps_the_labels_of_every_batch(fake_model, captured_roc):
+    labels = [torch.tensor([0, 0, 1]), torch.tensor([0, 1, 0]), torch.tensor([1, 1, 1])]
+    data = [(torch.randn(3, 3, 4, 4), torch.randn(3, 3, 4, 4), gt) for gt in labels]
+    scorer = lambda lap, res: (lap.flatten(1).mean(1), None)
+    auc, _, scores = scorer_module.evaluate_scorer(fake_model(data), scorer, 'cpu')
+
+    assert auc == 0.5
+    assert torch.equal(captured_roc['labels'], torch.cat(labels))
+    assert torch.allclose(scores, torch.cat([lap.flatten(1).mean(1) for lap, _, _ in data]))
+
+def test_quantized_scores_match_the_float_scores():
+    scorer = make_scorer()
+    calib, test = batches(8), batches(4)
+    qscorer = scorer_module.quantize_scorer(scorer, calib, quantized_engine())
+
+    with torch.no_grad():
+        scores = torch.cat([scorer(lap, res)[0] for lap, res in test])
+        qscores = torch.cat([qscorer(lap, res)[0] for lap, res in test])
+    relative = ((qscores - scores).abs() / scores.abs()).mean().item()
+    corr = torch.corrcoef(torch.stack([scores.log(), qscores.log()]))[0, 1].item()
+    assert relative < 0.2
+    assert corr > 0.95
+
+def test_cs_blocks_stay_float():
+    qscorer = scorer_module.quantize_scorer(make_scorer(), batches(2), quantized_engine())
+    modules = dict(qscorer.netg.named_modules())
+    cs = {name: m for name, m in modules.items() if '.cs.' in '.%s.' % name and len(list(m.children())) == 0}
+    assert cs, "no CS layer in the quantized generator"
+    for name, module in cs.items():
+        assert 'quantized' not in type(module).__module__, name
+    # The convolutions around them are int8.
+    assert any('quantized' in type(m).__module__ and 'Conv' in type(m).__name__ for m in modules.values())
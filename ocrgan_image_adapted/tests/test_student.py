@@ -0,0 +1,37 @@
+""" Tests of lib/models/student.py. """
+
+import pytest
+
+torch = pytest.importorskip("torch")
+from lib.models.student import StudentScorer, distill
+
+class Teacher(torch.nn.Module):
+    """ Scorer-like teacher: squared image as error map, its mean as score. """
+    def forward(self, lap, res):
+        error_map = torch.pow(lap + res, 2).mean(dim=1, keepdim=True)
+        return error_map.flatten(1).mean(1), error_map
+
+def batches(num, batchsize=8):
+    """ (lap, res, gt) batches whose images differ in contrast, so that their scores spread over two decades. """
+    scale = torch.logspace(-1, 0, num * batchsize)[torch.randperm(num * batchsize)].view(num, batchsize, 1, 1, 1)
+    return [(torch.randn(batchsize, 3, 16, 16) * s, torch.randn(batchsize, 3, 16, 16) * s,
+             torch.zeros(batchsize, dtype=torch.long)) for s in scale]
+
+def test_student_scores_track_the_teacher(fake_model):
+    torch.manual_seed(0)
+    model = fake_model(valid=batches(2), train=batches(8))
+    teacher, student = Teacher(), StudentScorer(nc=3, width=8, depth=2)
+
+    first = distill(student, teacher, model, epochs=1, lr=1e-2)
+    last = distill(student, teacher, model, epochs=30, lr=1e-2)
+    assert last < first
+
+    with torch.no_grad():
+        expected = torch.cat([teacher(lap, res)[0] for lap, res, _ in model.data.valid])
+        scores = torch.cat([student(lap, res)[0] for lap, res, _ in model.data.valid])
+        error_map = student(*model.data.valid[0][:2])[1]
+    assert not student.training
+    assert error_map.shape == (8, 1, 16, 16)
+    # Unseen images keep the teacher's ranking.
+    corr = torch.corrcoef(torch.stack([expected.log(), scores.log()]))[0, 1].item()
+    assert corr > 0.9
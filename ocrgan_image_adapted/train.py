@@ -1,32 +1,25 @@
 from options import Options
 from lib.data.dataloader import load_data_FD_aug
 from lib.models import load_model
-import numpy as np
-import torch  # Required for torch.cuda.empty_cache()
+from lib.batch_probe import probe_batchsize
+from lib.distributed import is_main_process
 
 def train(opt, class_name):
-    while True:
-        try:
-            data = load_data_FD_aug(opt, class_name)
-            model = load_model(opt, data, class_name)
-            auc = model.train()
-            return auc
-        except RuntimeError as e:
-            if "out of memory" in str(e):
-                if opt.batchsize <= 1:
-                    raise RuntimeError("Out of memory at batch size 1 — cannot proceed.")
-                print(f"[OOM] Reducing batch size from {opt.batchsize} to {opt.batchsize // 2}")
-                opt.batchsize = opt.batchsize // 2
-                torch.cuda.empty_cache()  # clear memory before retry
-            else:
-                raise e
+    # Out-of-memory errors lower --micro_batch in place (see
+    # BaseModel_Aug.train_one_epoch): the effective batch size never changes.
+    if opt.probe_batchsize:
+        probe_batchsize(opt)
+    data = load_data_FD_aug(opt, class_name)
+    model = load_model(opt, data, class_name)
+    auc = model.train()
+    return auc
 
 def main():
     opt = Options().parse()
     auc = train(opt, opt.dataset)
-    print(f"Trained on {opt.dataset} - AUC: {auc}")
+    # Under torchrun, only rank 0 tests the model.
+    if is_main_process(opt):
+        print(f"Trained on {opt.dataset} - AUC: {auc}")
 
 if __name__ == '__main__':
     main()
-
-
@@ -8,11 +8,13 @@ ISIZE=256
 NITER=100
 MODEL="ocr_gan_aug"
 BATCHSIZE=64
-GPU_ID=2
+DEVICE="cpu"
+JOBS=4        # classes trained concurrently, each pinned to its own share of the cores
+RETRIES=1     # times a failed class is trained again
 
-# Get current date in YYYYMMDD format
-DATE=$(date +%Y%m%d)
-HISTORY_FILE="output/history/training_history_${DATE}.log"
+# Run tag in YYYYMMDD format. Rerun with the same RUN_TAG to resume: trained
+# classes are skipped.
+RUN_TAG=${RUN_TAG:-$(date +%Y%m%d)}
 
 CLASSES=(
 dagm_1
@@ -27,40 +29,20 @@ dagm_9
 dagm_10
 )
 
-# Ensure the log directory exists
-mkdir -p "$(dirname "$HISTORY_FILE")"
-
-# Write history header if file doesn't exist
-if [ ! -f "$HISTORY_FILE" ]; then
-    echo -e "DATE\tCLASS\tMODEL\tBATCHSIZE\tISIZE\tNITER\tGPU_ID\tSTART_TIME\tEND_TIME\tDURATION_SEC\tTRAIN_SCRIPT\tDATAROOT\tRUN_NAME" > "$HISTORY_FILE"
-fi
-
-# ==== Training loop ====
-for CLASS in "${CLASSES[@]}"; do
-    CLASS_DATAROOT="$DATAROOT/$CLASS"
-    NAME="${MODEL}_${CLASS}_${DATE}"
-
-    START_TIME=$(date '+%Y-%m-%d %H:%M:%S')
-    START_SEC=$(date +%s)
-    echo "=== Training on class: $CLASS === [$START_TIME]"
-
-    $PYTHON_EXEC $TRAIN_SCRIPT \
-      --dataset "$CLASS" \
-      --dataroot "$CLASS_DATAROOT" \
-      --isize "$ISIZE" \
-      --niter "$NITER" \
-      --model "$MODEL" \
-      --batchsize "$BATCHSIZE" \
-      --gpu_ids "$GPU_ID" \
-      --name "$NAME" \
-      --save_test_images
-
-    END_TIME=$(date '+%Y-%m-%d %H:%M:%S')
-    END_SEC=$(date +%s)
-    DURATION=$((END_SEC - START_SEC))
-
-    # Save to history file
-    echo -e "${DATE}\t${CLASS}\t${MODEL}\t${BATCHSIZE}\t${ISIZE}\t${NITER}\t${GPU_ID}\t${START_TIME}\t${END_TIME}\t${DURATION}\t${TRAIN_SCRIPT}\t${CLASS_DATAROOT}\t${NAME}" >> "$HISTORY_FILE"
-
-    echo "=== Done: $CLASS === [$END_TIME] Duration: ${DURATION}s"
-done
\ No newline at end of file
+# ==== Training, JOBS classes at a time (see train_all.py) ====
+# History (durations, AUC, CPU time, peak RSS): output/history/schedule_${RUN_TAG}.jsonl
+# Run names: ${MODEL}_<class>_${RUN_TAG}
+$PYTHON_EXEC train_all.py \
+  --python "$PYTHON_EXEC" \
+  --script "$TRAIN_SCRIPT" \
+  --dataroot "$DATAROOT" \
+  --classes "$(IFS=,; echo "${CLASSES[*]}")" \
+  --model "$MODEL" \
+  --jobs "$JOBS" \
+  --retries "$RETRIES" \
+  --run_tag "$RUN_TAG" \
+  --isize "$ISIZE" \
+  --niter "$NITER" \
+  --batchsize "$BATCHSIZE" \
+  --device "$DEVICE" \
+  --save_test_images
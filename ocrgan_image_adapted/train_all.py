@@ -0,0 +1,230 @@
+"""
+MULTI-CLASS TRAINING SCHEDULER
+
+Usage: python train_all.py --dataroot <folder of class folders> [--classes a,b,...] [--jobs K]
+                           [--retries R] [--run_tag TAG] [train options]
+
+Trains one model per class with train.py, --jobs classes at a time. Every job
+is pinned to its own disjoint set of CPU cores (os.sched_setaffinity) and runs
+as many torch threads (--num_threads). The other classes wait in a queue, and
+failed classes go back to its end up to --retries times.
+
+Every start and end of a job is appended as one JSON line to the history file
+(output/history/schedule_<run_tag>.jsonl by default), with the class, attempt,
+cores, times, duration, exit code, final AUC, CPU time and peak RSS. The output
+of every attempt goes to <history without .jsonl>/<class>_<attempt>.log.
+Running the same command again (same --run_tag) resumes the schedule: trained
+classes are skipped, and a class interrupted with the scheduler starts over.
+Options not known here are passed on to train.py.
+"""
+
+import argparse
+import collections
+import ctypes
+import datetime
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+
+AUC_LINE = re.compile(r"^Trained on .* - AUC: (\S+)")
+
+##
+def core_sets(jobs, cores_per_job=0):
+    """ Disjoint sets of the cores available to this process, one per job slot.
+
+    Args:
+        jobs (int): Number of concurrent jobs.
+        cores_per_job (int): Cores of every job. 0 splits the cores evenly.
+
+    Returns:
+        [list]: `jobs` lists of core ids.
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    size = cores_per_job if cores_per_job > 0 else len(cores) // jobs
+    if size < 1 or size * jobs > len(cores):
+        raise ValueError("%d jobs of %d cores do not fit the %d available cores" % (jobs, size, len(cores)))
+    return [cores[i * size:(i + 1) * size] for i in range(jobs)]
+
+##
+def read_history(path):
+    """ Records of a history file ([] if missing). A truncated last line is skipped. """
+    records = []
+    if os.path.isfile(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass
+    return records
+
+def append_history(path, record):
+    """ Append one record to the history file, on disk before returning. """
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+##
+def final_auc(log_path):
+    """ AUC of the "Trained on ..." line printed by train.py at the end, or None. """
+    auc = None
+    with open(log_path, errors='replace') as f:
+        for line in f:
+            match = AUC_LINE.match(line)
+            if match:
+                try:
+                    auc = float(match.group(1))
+                except ValueError:
+                    pass
+    return auc
+
+##
+def pinned(cores):
+    """ preexec_fn of a job: run on `cores` only, and get SIGTERM if the scheduler dies. """
+    def preexec():
+        os.sched_setaffinity(0, cores)
+        try:
+            # prctl(PR_SET_PDEATHSIG, SIGTERM)
+            ctypes.CDLL(None).prctl(1, signal.SIGTERM)
+        except (OSError, AttributeError):
+            pass
+    return preexec
+
+def now():
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+##
+def start_job(opt, extra, cls, attempt, cores, log_dir):
+    """ Launch train.py on one class.
+
+    Returns:
+        [dict]: Job: process, class, attempt, cores, log, start times.
+    """
+    name = "%s_%s_%s" % (opt.model, cls, opt.run_tag)
+    log = os.path.join(log_dir, "%s_%d.log" % (cls, attempt))
+    cmd = [opt.python, opt.script,
+           '--dataset', cls,
+           '--dataroot', os.path.join(opt.dataroot, cls),
+           '--model', opt.model,
+           '--name', name,
+           '--num_threads', str(len(cores))] + extra
+    env = dict(os.environ, OMP_NUM_THREADS=str(len(cores)), MKL_NUM_THREADS=str(len(cores)))
+    with open(log, 'w') as f:
+        proc = subprocess.Popen(cmd, stdout=f, stderr=subprocess.STDOUT, env=env, preexec_fn=pinned(cores))
+    return dict(proc=proc, cls=cls, attempt=attempt, cores=cores, log=log, name=name, cmd=cmd,
+                start=now(), start_sec=time.time())
+
+def exit_code(status):
+    """ Exit code of a wait status, -signal if the process was killed. """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+##
+def main():
+    """ Train all classes, --jobs at a time.
+    """
+    # No abbreviations: unknown options are passed on to train.py as they are.
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, allow_abbrev=False)
+    parser.add_argument('--dataroot', required=True, help='folder of the class folders, e.g. data/processed/mvtec_processed')
+    parser.add_argument('--classes', default='', help='comma-separated classes. Empty for every folder of --dataroot with a train split.')
+    parser.add_argument('--model', default='ocr_gan_aug', help='model trained, part of the run names')
+    parser.add_argument('--jobs', type=int, default=4, help='classes trained concurrently')
+    parser.add_argument('--cores_per_job', type=int, default=0, help='cores pinned to every job. 0 splits the available cores evenly.')
+    parser.add_argument('--retries', type=int, default=1, help='times a failed class is trained again')
+    parser.add_argument('--run_tag', default=datetime.date.today().strftime('%Y%m%d'), help='suffix of the run names and the history file. Reuse it to resume.')
+    parser.add_argument('--history', default='', help='JSON lines history file. Defaults to output/history/schedule_<run_tag>.jsonl.')
+    parser.add_argument('--python', default=sys.executable, help='python executable of the jobs')
+    parser.add_argument('--script', default='train.py', help='training script')
+    opt, extra = parser.parse_known_args()
+
+    classes = [c for c in opt.classes.split(',') if c] or \
+              sorted(c for c in os.listdir(opt.dataroot) if os.path.isdir(os.path.join(opt.dataroot, c, 'train')))
+    history = opt.history or os.path.join('output', 'history', 'schedule_%s.jsonl' % opt.run_tag)
+    log_dir = os.path.splitext(history)[0]
+    os.makedirs(log_dir, exist_ok=True)
+    slots = core_sets(opt.jobs, opt.cores_per_job)
+
+    # Resume: skip the trained classes, keep counting the failed attempts.
+    done, failures = set(), collections.Counter()
+    for record in read_history(history):
+        if record.get('event') != 'end':
+            continue
+        if record['status'] == 'done':
+            done.add(record['class'])
+        elif record['status'] == 'failed':
+            failures[record['class']] += 1
+    pending = collections.deque()
+    for cls in classes:
+        if cls in done:
+            print(">> %s: already trained, skipped" % cls)
+        elif failures[cls] > opt.retries:
+            print(">> %s: failed %d times, skipped (raise --retries to try again)" % (cls, failures[cls]))
+        else:
+            pending.append(cls)
+    print(">> Training %d classes, %d at a time on %d cores each. History: %s" % (len(pending), opt.jobs, len(slots[0]), history))
+
+    free = list(range(len(slots)))
+    running = {}
+    given_up = []
+    try:
+        while pending or running:
+            while pending and free:
+                slot = free.pop(0)
+                cls = pending.popleft()
+                job = start_job(opt, extra, cls, failures[cls] + 1, slots[slot], log_dir)
+                job['slot'] = slot
+                running[job['proc'].pid] = job
+                append_history(history, {'event': 'start', 'class': cls, 'attempt': job['attempt'], 'run_name': job['name'],
+                                         'cores': job['cores'], 'start_time': job['start'], 'log': job['log'], 'cmd': job['cmd']})
+                print("=== Training on class: %s === [%s] attempt %d, cores %d-%d" % (cls, job['start'], job['attempt'], job['cores'][0], job['cores'][-1]))
+
+            pid, status, usage = os.wait4(-1, 0)
+            job = running.pop(pid, None)
+            if job is None:
+                continue
+            code = exit_code(status)
+            job['proc'].returncode = code
+            free.append(job['slot'])
+            duration = time.time() - job['start_sec']
+            cpu = usage.ru_utime + usage.ru_stime
+            auc = final_auc(job['log']) if code == 0 else None
+            status = 'done' if code == 0 and auc is not None else 'failed'
+            cls = job['cls']
+            append_history(history, {'event': 'end', 'class': cls, 'attempt': job['attempt'], 'run_name': job['name'],
+                                     'status': status, 'exit_code': code, 'auc': auc,
+                                     'start_time': job['start'], 'end_time': now(), 'duration_sec': round(duration, 1),
+                                     'cores': job['cores'], 'cpu_sec': round(cpu, 1),
+                                     'cpu_util': round(cpu / max(duration * len(job['cores']), 1e-9), 3),
+                                     'max_rss_mb': round(usage.ru_maxrss / 1024., 1), 'log': job['log']})
+            if status == 'done':
+                print("=== Done: %s === [%s] Duration: %ds, AUC: %.4f" % (cls, now(), duration, auc))
+                continue
+            failures[cls] += 1
+            if failures[cls] <= opt.retries:
+                print("=== Failed: %s === exit code %d, queued again (see %s)" % (cls, code, job['log']))
+                pending.append(cls)
+            else:
+                print("=== Failed: %s === exit code %d, giving up (see %s)" % (cls, code, job['log']))
+                given_up.append(cls)
+    except KeyboardInterrupt:
+        print(">> Interrupted: stopping %d jobs. Run the same command to resume." % len(running))
+        for job in running.values():
+            job['proc'].terminate()
+        for job in running.values():
+            job['proc'].wait()
+            append_history(history, {'event': 'end', 'class': job['cls'], 'attempt': job['attempt'], 'run_name': job['name'],
+                                     'status': 'interrupted', 'start_time': job['start'], 'end_time': now(),
+                                     'duration_sec': round(time.time() - job['start_sec'], 1), 'log': job['log']})
+        sys.exit(130)
+
+    print(">> Training [Done]%s" % (", failed: " + ", ".join(given_up) if given_up else ""))
+    sys.exit(1 if given_up else 0)
+
+if __name__ == '__main__':
+    main()